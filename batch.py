@@ -0,0 +1,360 @@
+"""フォルダ・ワイルドカード指定による一括変換。
+
+画像ジョブは CPU コア数に合わせたプロセスプールで、動画ジョブは FFmpeg が
+CPU を奪い合わないように少数のスレッドで並列実行する。
+
+ジャーナル (JobJournal) を指定すると、終わったジョブを1行ずつ記録し、
+中断した一括処理をやり直すときに完了済みのジョブを飛ばす。
+"""
+import glob
+import json
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+from cache import cache_dir, cache_key
+from capabilities import check_ffmpeg
+from engine import (
+    IMAGE_FORMATS, PARTIAL_MARKER, VIDEO_FORMATS, ConversionEngine, ConversionJob, file_category
+)
+from formats import ANIMATION_SOURCE_FORMATS
+
+
+def default_image_workers():
+    return os.cpu_count() or 1
+
+
+def default_video_workers():
+    # FFmpeg (libx264) は1プロセスで複数コアを使うので、同時実行数は少なめにする
+    return max(1, min(4, (os.cpu_count() or 1) // 4))
+
+
+@dataclass
+class BatchResult:
+    """一括処理の1ファイル分の結果"""
+    job: ConversionJob
+    # 複数の形式に出力したジョブ (targets) では出力パスのリスト
+    output_path: str = None
+    error: str = None
+    warnings: list = field(default_factory=list)
+    # ジョブの処理にかかった時間 (秒)
+    wall_time: float = None
+    # ジョブの計測値 (metrics.JobMetrics.to_dict の結果)
+    metrics: dict = None
+    # ジャーナルに完了済みと記録されていたため、処理せずに飛ばした
+    resumed: bool = False
+
+    @property
+    def ok(self):
+        return self.error is None and self.output_path is not None
+
+
+def list_input_files(source, recursive=False):
+    """フォルダまたはワイルドカードから対応ファイルの一覧を返す"""
+    if os.path.isdir(source):
+        pattern = os.path.join(glob.escape(source), "**", "*") if recursive else os.path.join(glob.escape(source), "*")
+        paths = glob.glob(pattern, recursive=recursive)
+    elif glob.has_magic(source):
+        paths = glob.glob(source, recursive=True)
+    else:
+        paths = [source]
+    # 中断された処理の書きかけの出力 (*.part.*) は対象外にする
+    return sorted(p for p in paths if os.path.isfile(p) and file_category(p)
+                  and os.path.splitext(os.path.splitext(p)[0])[1] != PARTIAL_MARKER)
+
+
+def collect_jobs(source, mode, target_format=None, recursive=False, **options):
+    """一括処理するジョブの一覧を作成する。
+
+    変換モードでは target_format と同じ種類 (画像/動画) のファイルだけを対象にする
+    (動画に変換する場合は、動画にできるアニメーション画像 (GIF / WebP) も対象にする)。
+    圧縮モードでは以前の出力 (*_compressed.*) を対象外にする。
+    options (target_size_mb, encoder など) はそのまま ConversionJob に渡す。
+    """
+    if mode == "convert":
+        if not target_format:
+            raise ValueError("変換後のフォーマットが選択されていません。")
+        target_category = "image" if target_format in IMAGE_FORMATS else "video" if target_format in VIDEO_FORMATS else None
+        if target_category is None:
+            raise ValueError(f"対応していない変換後フォーマットです: {target_format}")
+
+        # 入力と同じ名前で出力することになる (=上書きしてしまう) ファイルは対象外にする
+        same_name_formats = {target_format}
+        for target in options.get("targets") or []:
+            if isinstance(target, str):
+                same_name_formats.add(target)
+            elif not target.get("max_dimension"):
+                same_name_formats.add(target.get("format"))
+
+    jobs = []
+    for path in list_input_files(source, recursive=recursive):
+        name, ext = os.path.splitext(os.path.basename(path))
+        if mode == "convert":
+            category = file_category(path)
+            animation_to_video = target_category == "video" and ext[1:].lower() in ANIMATION_SOURCE_FORMATS
+            if (category != target_category and not animation_to_video) or ext[1:].lower() in same_name_formats:
+                continue
+            jobs.append(ConversionJob(input_path=path, mode="convert", target_format=target_format, **options))
+        else:
+            if name.endswith("_compressed"):
+                continue
+            jobs.append(ConversionJob(input_path=path, mode="compress", **options))
+    return jobs
+
+
+def job_category(job):
+    """ジョブを実行するプールの種類。入力か出力が動画なら FFmpeg を使うので "video"、それ以外は "image"。"""
+    if file_category(job.input_path) == "video":
+        return "video"
+    if not job.targets:
+        try:
+            if file_category(job.resolve_output_path()) == "video":
+                return "video"
+        except ValueError:
+            # 指定の誤りは実行時にエラーになる
+            pass
+    return "image"
+
+
+def journal_key(job):
+    """ジャーナルでジョブを識別するキー。入力ファイルが変わったら別のジョブとみなす。"""
+    try:
+        stat = os.stat(job.input_path)
+        source = (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        source = None
+    try:
+        outputs = [os.path.abspath(target.resolve_output_path())
+                   for target in (job.split_targets() if job.targets else [job])]
+    except ValueError:
+        # 指定の誤りは実行時にエラーになる
+        outputs = []
+    return cache_key(os.path.abspath(job.input_path), source, *sorted(job.cache_parameters().items()), *outputs)
+
+
+class JobJournal:
+    """一括処理の各ジョブの結果を1行1件の JSON で追記するジャーナル。
+
+    行は {"key": journal_key, "state": "done" / "failed", "output": 出力パス, "time": 時刻}。
+    同じキーの行は後のものが優先される。書き込みは1行ごとにディスクへ反映するので、
+    クラッシュや再起動で中断しても、それまでに終わったジョブの記録は残る。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self):
+        """キーごとの最後の記録を返す。壊れた行 (書き込み中の中断など) は無視する。"""
+        entries = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        entries[entry["key"]] = entry
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except OSError:
+            pass
+        return entries
+
+    def completed_output(self, entries, key):
+        """完了済みで出力も残っているジョブなら出力パスを返す。そうでなければ None。"""
+        entry = entries.get(key)
+        if not entry or entry.get("state") != "done" or not entry.get("output"):
+            return None
+        output = entry["output"]
+        paths = output if isinstance(output, list) else [output]
+        if not all(isinstance(p, str) and os.path.exists(p) for p in paths):
+            return None
+        return output
+
+    def record(self, key, state, output=None):
+        # 別のフォルダから再実行しても出力を確認できるように絶対パスで記録する
+        if isinstance(output, list):
+            output = [os.path.abspath(p) for p in output]
+        elif output:
+            output = os.path.abspath(output)
+        line = json.dumps({"key": key, "state": state, "output": output, "time": time.time()}, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def default_journal(source, **options):
+    """フォルダと設定ごとにキャッシュフォルダに置くジャーナル (GUI の一括処理用)"""
+    name = cache_key(os.path.abspath(source), *sorted((key, repr(value)) for key, value in options.items()))
+    return JobJournal(os.path.join(cache_dir("journals"), f"{name}.jsonl"))
+
+
+def _collect_events():
+    """警告と計測値を集める on_event と、それぞれのリストを返す"""
+    warnings, metrics = [], []
+
+    def on_event(msg_type, payload):
+        if msg_type == "warning":
+            warnings.append(payload)
+        elif msg_type == "metrics":
+            metrics.append(payload)
+
+    return on_event, warnings, metrics
+
+
+def _execute(engine, job, warnings, metrics):
+    """ジョブを実行して (出力パス, エラー, 警告, 処理時間, 計測値) を返す"""
+    started = time.perf_counter()
+    try:
+        output_path = engine.run(job)
+        error = None if output_path is not None else "中止されました。"
+    except Exception as e:
+        output_path, error = None, str(e) or e.__class__.__name__
+    return output_path, error, warnings, time.perf_counter() - started, (metrics[-1] if metrics else None)
+
+
+def ignore_interrupt():
+    """プロセスプールのワーカーの初期化処理。
+
+    Ctrl+C はワーカーにも届くので、ワーカーでは無視して親プロセスの中止の処理に任せる。
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_image_job(job):
+    """プロセスプールで実行される画像ジョブ (pickle できるようにトップレベルに置く)"""
+    on_event, warnings, metrics = _collect_events()
+    engine = ConversionEngine(on_event=on_event, ffmpeg_available=False)
+    return _execute(engine, job, warnings, metrics)
+
+
+class BatchRunner:
+    """ジョブ一覧を並列実行する。
+
+    on_event には ("batch_progress", (完了数, 総数, 失敗数)) と、ジョブが終わるごとに
+    ("metrics", dict) が送られる。個々のファイルの警告やエラーは BatchResult にまとめて返す。
+    """
+
+    def __init__(self, jobs, on_event=None, image_workers=None, video_workers=None, ffmpeg_available=None,
+                 journal=None):
+        self.jobs = list(jobs)
+        # 完了したジョブを記録し、完了済みのジョブを飛ばすための JobJournal
+        self.journal = journal
+        self.on_event = on_event
+        self.image_workers = image_workers or default_image_workers()
+        self.video_workers = video_workers or default_video_workers()
+        self.ffmpeg_available = ffmpeg_available
+        self._cancel_event = threading.Event()
+        self._engines = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        """未着手のジョブを取り消し、実行中の動画ジョブを中断する"""
+        self._cancel_event.set()
+        with self._lock:
+            engines = list(self._engines)
+        for engine in engines:
+            engine.cancel()
+
+    def emit(self, msg_type, payload):
+        if self.on_event:
+            self.on_event(msg_type, payload)
+
+    def _run_video_job(self, job):
+        on_event, warnings, metrics = _collect_events()
+        engine = ConversionEngine(on_event=on_event, ffmpeg_available=self.ffmpeg_available)
+        with self._lock:
+            if self.cancel_requested:
+                return None, "中止されました。", warnings, 0.0, None
+            self._engines.add(engine)
+        try:
+            return _execute(engine, job, warnings, metrics)
+        finally:
+            with self._lock:
+                self._engines.discard(engine)
+
+    def run(self):
+        """全ジョブを実行し、入力順の BatchResult のリストを返す。
+
+        ジャーナルに完了済みと記録されているジョブは実行せず、resumed=True の結果にする。
+        """
+        results = {id(job): BatchResult(job=job) for job in self.jobs}
+        keys = {}
+        if self.journal is not None:
+            entries = self.journal.load()
+            for job in self.jobs:
+                keys[id(job)] = journal_key(job)
+                output = self.journal.completed_output(entries, keys[id(job)])
+                if output is not None:
+                    results[id(job)].output_path = output
+                    results[id(job)].resumed = True
+        remaining = [job for job in self.jobs if not results[id(job)].resumed]
+
+        image_jobs = [job for job in remaining if job_category(job) == "image"]
+        video_jobs = [job for job in remaining if job_category(job) == "video"]
+        if video_jobs and self.ffmpeg_available is None:
+            self.ffmpeg_available = check_ffmpeg()
+
+        total = len(self.jobs)
+        done = total - len(remaining)
+        failed = 0
+        self.emit("batch_progress", (done, total, failed))
+
+        image_pool = (ProcessPoolExecutor(max_workers=min(self.image_workers, len(image_jobs)), initializer=ignore_interrupt)
+                      if image_jobs else None)
+        video_pool = ThreadPoolExecutor(max_workers=min(self.video_workers, len(video_jobs))) if video_jobs else None
+        try:
+            futures = {}
+            for job in image_jobs:
+                futures[image_pool.submit(run_image_job, job)] = job
+            for job in video_jobs:
+                futures[video_pool.submit(self._run_video_job, job)] = job
+
+            for future in as_completed(futures):
+                result = results[id(futures[future])]
+                if future.cancelled():
+                    result.error = "中止されました。"
+                else:
+                    try:
+                        (result.output_path, result.error, result.warnings, result.wall_time,
+                         result.metrics) = future.result()
+                    except Exception as e:
+                        # プロセスプールが異常終了した場合など
+                        result.error = str(e) or e.__class__.__name__
+                if result.metrics is not None:
+                    self.emit("metrics", result.metrics)
+                # 中止で終わらなかったジョブは、やり直すときに処理し直す
+                if self.journal is not None and not (self.cancel_requested and not result.ok):
+                    self.journal.record(keys[id(result.job)], "done" if result.ok else "failed", result.output_path)
+                done += 1
+                if not result.ok:
+                    failed += 1
+                self.emit("batch_progress", (done, total, failed))
+
+                if self.cancel_requested:
+                    for pending in futures:
+                        pending.cancel()
+        except KeyboardInterrupt:
+            # 実行中の FFmpeg を止めてから、プールの終了を待つ
+            self.cancel()
+            raise
+        finally:
+            for pool in (image_pool, video_pool):
+                if pool:
+                    pool.shutdown(wait=True, cancel_futures=True)
+
+        return [results[id(job)] for job in self.jobs]
@@ -0,0 +1,252 @@
+"""画像・動画処理のベンチマーク。
+
+ネットワークや GPU を使わずに、決まった内容のテスト用ファイル (Pillow で
+作るノイズ＋グラデーション画像と、FFmpeg の testsrc2 / sine で作る動画) を
+生成し、モード・フォーマット・エンコーダーの組み合わせごとに処理時間などを
+計測して JSON に書き出す。コミット間で結果を比較するために使う。
+
+    python benchmark.py --output bench.json
+    python benchmark.py --quick --only image
+
+各ケースは新しいプロセスで実行し、次の値を記録する。
+wall_time (秒), cpu_time (秒, 子プロセスの FFmpeg を含む), peak_rss_mb,
+encode_count (画像のエンコード回数 + FFmpeg の実行回数), output_size,
+size_error (目標サイズに対する誤差の割合, 圧縮モードのみ)。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from capabilities import CREATE_NO_WINDOW, ffmpeg_binary, load_capabilities
+
+try:
+    import resource
+except ImportError:
+    # Windows には resource モジュールが無い
+    resource = None
+
+
+SEED = 1234
+IMAGE_MEGAPIXELS = [1, 12, 40]
+QUICK_IMAGE_MEGAPIXELS = [1, 4]
+VIDEO_SECONDS = 60
+QUICK_VIDEO_SECONDS = 10
+VIDEO_SIZE = "1280x720"
+
+
+def fixture_image(directory, megapixels):
+    """決まった内容の RGB 画像 (PNG) を作る。同じ名前のファイルがあれば再利用する。"""
+    from PIL import Image, ImageFilter
+
+    path = os.path.join(directory, f"image_{megapixels}mp.png")
+    if os.path.exists(path):
+        return path
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    rng = random.Random(SEED + megapixels)
+
+    # 写真に近づけるため、ぼかしたノイズ (質感) をグラデーションに重ねる
+    noise = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+    noise = noise.filter(ImageFilter.GaussianBlur(1.5))
+    gradient = Image.merge("RGB", [
+        Image.linear_gradient("L").resize((width, height)),
+        Image.radial_gradient("L").resize((width, height)),
+        Image.linear_gradient("L").rotate(90).resize((width, height)),
+    ])
+    Image.blend(gradient, noise, 0.35).save(path)
+    return path
+
+
+def fixture_video(directory, seconds):
+    """FFmpeg の testsrc2 と sine で H.264/AAC の MP4 を作る"""
+    path = os.path.join(directory, f"video_{seconds}s.mp4")
+    if os.path.exists(path):
+        return path
+    command = [
+        ffmpeg_binary() or "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={VIDEO_SIZE}:rate=30:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={seconds}",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "18",
+        "-c:a", "aac", "-b:a", "192k", "-shortest", path
+    ]
+    subprocess.run(command, check=True, capture_output=True, creationflags=CREATE_NO_WINDOW)
+    return path
+
+
+def image_cases(path, megapixels):
+    cases = []
+    for fmt in ("png", "jpg", "webp"):
+        cases.append({"name": f"image/convert/{megapixels}mp/{fmt}", "input": path,
+                      "job": {"mode": "convert", "target_format": fmt}})
+    # 1MP あたり約 0.15MB を目標にする (q=80 前後になる程度)
+    target_mb = round(megapixels * 0.15, 2)
+    for fmt in ("jpg", "webp"):
+        cases.append({"name": f"image/compress/{megapixels}mp/{fmt}", "input": path,
+                      "job": {"mode": "compress", "target_size_mb": target_mb}, "output_ext": fmt})
+    return cases
+
+
+def video_cases(path, seconds, encoders):
+    cases = [
+        {"name": "video/convert/mkv-copy", "input": path, "job": {"mode": "convert", "target_format": "mkv"}},
+        {"name": "video/convert/avi", "input": path, "job": {"mode": "convert", "target_format": "avi"}},
+    ]
+    # 1秒あたり約 1Mbps を目標にする
+    target_mb = round(seconds * 1000 / 8 / 1024, 2)
+    for encoder in encoders:
+        for rate_control in ("two_pass", "single_pass"):
+            cases.append({"name": f"video/compress/{encoder}/{rate_control}", "input": path,
+                          "job": {"mode": "compress", "target_size_mb": target_mb,
+                                  "encoder": encoder, "rate_control": rate_control}})
+    if seconds >= 60:
+        cases.append({"name": "video/compress/libx264/segments", "input": path,
+                      "job": {"mode": "compress", "target_size_mb": target_mb, "encoder": "libx264",
+                              "rate_control": "single_pass", "segments": 2}})
+    return cases
+
+
+def _rusage():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def run_case(case, output_dir):
+    """新しいプロセスの中で1ケースを実行して計測する"""
+    from engine import ConversionEngine, ConversionJob
+
+    name, ext = os.path.splitext(os.path.basename(case["input"]))
+    output_ext = case.get("output_ext") or case["job"].get("target_format") or ext[1:]
+    output_path = os.path.join(output_dir, f"{case['name'].replace('/', '_')}.{output_ext}")
+    # 変換結果のキャッシュを使うと2回目以降の計測が意味を持たないので無効にする
+    job = ConversionJob(input_path=case["input"], output_path=output_path, use_cache=False, **case["job"])
+    engine = ConversionEngine()
+
+    before = _rusage()
+    cpu_before = time.process_time()
+    started = time.perf_counter()
+    error = None
+    try:
+        engine.run(job)
+    except Exception as e:
+        error = str(e).splitlines()[0] if str(e) else e.__class__.__name__
+    wall_time = time.perf_counter() - started
+
+    record = {
+        "name": case["name"],
+        "wall_time": round(wall_time, 4),
+        "cpu_time": round(time.process_time() - cpu_before, 4),
+        "peak_rss_mb": None,
+        "encode_count": engine.encode_count,
+        "output_size": os.path.getsize(output_path) if os.path.exists(output_path) else None,
+        "size_error": None,
+        "error": error,
+    }
+    after = _rusage()
+    if after is not None:
+        self_before, children_before = before
+        self_after, children_after = after
+        children_cpu = (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime)
+        record["cpu_time"] = round(record["cpu_time"] + children_cpu, 4)
+        # Linux では KB 単位、macOS ではバイト単位
+        scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+        record["peak_rss_mb"] = round(max(self_after.ru_maxrss, children_after.ru_maxrss) / scale, 1)
+    target_mb = case["job"].get("target_size_mb")
+    if target_mb and record["output_size"]:
+        target_bytes = target_mb * 1024 * 1024
+        record["size_error"] = round((record["output_size"] - target_bytes) / target_bytes, 4)
+    return record
+
+
+def environment_info():
+    info = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "commit": None,
+        "pillow": None,
+        "ffmpeg": None,
+    }
+    try:
+        info["commit"] = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), creationflags=CREATE_NO_WINDOW
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    try:
+        import PIL
+        info["pillow"] = PIL.__version__
+    except ImportError:
+        pass
+    ffmpeg = ffmpeg_binary()
+    if ffmpeg:
+        try:
+            info["ffmpeg"] = subprocess.run(
+                [ffmpeg, "-version"], capture_output=True, text=True, check=True, creationflags=CREATE_NO_WINDOW
+            ).stdout.splitlines()[0]
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            pass
+    return info
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="画像・動画処理のベンチマーク")
+    parser.add_argument("--output", default="bench.json", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--fixtures", default=os.path.join("bench_fixtures"), help="テスト用ファイルを置くフォルダ")
+    parser.add_argument("--only", choices=["image", "video"], help="画像または動画だけを計測する")
+    parser.add_argument("--quick", action="store_true", help="小さなファイルだけで短時間に計測する")
+    parser.add_argument("--repeat", type=int, default=1, help="各ケースの繰り返し回数")
+    parser.add_argument("--filter", help="名前にこの文字列を含むケースだけを実行する")
+    args = parser.parse_args(argv)
+
+    fixtures = os.path.abspath(args.fixtures)
+    output_dir = os.path.join(fixtures, "output")
+    os.makedirs(output_dir, exist_ok=True)
+
+    cases = []
+    if args.only != "video":
+        for megapixels in (QUICK_IMAGE_MEGAPIXELS if args.quick else IMAGE_MEGAPIXELS):
+            print(f"テスト画像を準備しています ({megapixels}MP)...", file=sys.stderr)
+            cases += image_cases(fixture_image(fixtures, megapixels), megapixels)
+    if args.only != "image":
+        capabilities = load_capabilities()
+        if not capabilities.ffmpeg_available:
+            print("FFmpegが見つからないため、動画のベンチマークを省略します。", file=sys.stderr)
+        else:
+            seconds = QUICK_VIDEO_SECONDS if args.quick else VIDEO_SECONDS
+            print(f"テスト動画を準備しています ({seconds}秒)...", file=sys.stderr)
+            # 自動選択は実際のエンコーダーのどれかと同じ結果になるので計測しない
+            encoders = [codec for label, codec in capabilities.encoder_choices() if codec != "auto"]
+            cases += video_cases(fixture_video(fixtures, seconds), seconds, encoders)
+    if args.filter:
+        cases = [c for c in cases if args.filter in c["name"]]
+
+    results = []
+    # 最大メモリ使用量をケースごとに測るため、毎回新しいプロセスで実行する
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        for i in range(args.repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                record = pool.submit(run_case, case, output_dir).result()
+            record["repeat"] = i
+            results.append(record)
+            status = f"エラー: {record['error']}" if record["error"] else f"{record['wall_time']:.2f}s"
+            print(f"{record['name']}: {status}", file=sys.stderr)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"environment": environment_info(), "results": results}, f, ensure_ascii=False, indent=2)
+    print(f"結果を書き出しました: {args.output}", file=sys.stderr)
+    return 1 if any(r["error"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
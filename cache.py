@@ -0,0 +1,221 @@
+"""変換処理で使うディスクキャッシュ。
+
+キャッシュは CONVERTER_CACHE_DIR 環境変数、なければ OS ごとのユーザー用
+キャッシュフォルダ (Windows は %LOCALAPPDATA%) の下に作成する。
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+
+APP_NAME = "movie-imageConverter"
+# ファイル内容のハッシュには先頭と末尾のこのバイト数だけを使う
+FINGERPRINT_SAMPLE_BYTES = 1024 * 1024
+# 変換結果のキャッシュの既定の上限 (MB)。CONVERTER_OUTPUT_CACHE_MB で変更できる
+DEFAULT_OUTPUT_CACHE_MB = 2048
+# 上限のこの割合より大きい出力はキャッシュしない (1件で他のキャッシュをすべて追い出さないように)
+MAX_OUTPUT_ENTRY_RATIO = 0.25
+OUTPUT_META_NAME = "meta.json"
+
+
+def cache_dir(*parts):
+    """キャッシュフォルダのパスを返す (存在しなければ作成する)"""
+    base = os.environ.get("CONVERTER_CACHE_DIR")
+    if not base:
+        if os.name == "nt":
+            base = os.path.join(os.environ.get("LOCALAPPDATA") or os.path.expanduser("~"), APP_NAME, "cache")
+        else:
+            base = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), APP_NAME)
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_fingerprint(path):
+    """ファイルを識別するハッシュを返す。
+
+    巨大な動画を丸ごと読まないように、サイズ・更新日時と先頭・末尾の
+    FINGERPRINT_SAMPLE_BYTES バイトだけをハッシュする。
+    """
+    stat = os.stat(path)
+    digest = hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_SAMPLE_BYTES))
+        if stat.st_size > FINGERPRINT_SAMPLE_BYTES * 2:
+            f.seek(-FINGERPRINT_SAMPLE_BYTES, os.SEEK_END)
+            digest.update(f.read(FINGERPRINT_SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+def temp_path(path):
+    """path に置き換える前に書き込む一時ファイル (フォルダ) のパス。
+
+    同じキーを別のプロセスやスレッドが同時に書き込んでも重ならないように、
+    プロセス ID とスレッド ID を付ける。
+    """
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def cache_key(*parts):
+    return hashlib.sha256("\0".join(str(p) for p in parts).encode()).hexdigest()
+
+
+class PassLogCache:
+    """2パスエンコードの1パス目のログを保存して再利用する。
+
+    1パス目のログは目標ビットレートが変わっても2パス目で使えるので、
+    キーは入力ファイルとエンコーダー (と1パス目の映像フィルタ) だけにする。
+    """
+
+    def __init__(self, root=None, max_entries=32):
+        self.root = root or cache_dir("passlog")
+        self.max_entries = max_entries
+
+    def _entry_dir(self, key_parts):
+        return os.path.join(self.root, cache_key(*key_parts))
+
+    def lookup(self, key_parts, log_name):
+        """キャッシュされたログの -passlogfile 用プレフィックスを返す。無ければ None。"""
+        entry = self._entry_dir(key_parts)
+        prefix = os.path.join(entry, log_name)
+        if not os.path.isdir(entry) or not any(n.startswith(log_name) for n in os.listdir(entry)):
+            return None
+        os.utime(entry)
+        return prefix
+
+    def store(self, key_parts, log_prefix):
+        """log_prefix で書き出されたログファイル一式をキャッシュにコピーする"""
+        directory, log_name = os.path.split(log_prefix)
+        entry = self._entry_dir(key_parts)
+        tmp_entry = temp_path(entry)
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        for name in os.listdir(directory):
+            if name.startswith(log_name):
+                shutil.copy2(os.path.join(directory, name), tmp_entry)
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # 別のプロセスが同じログを先に登録した
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        entries = [os.path.join(self.root, n) for n in os.listdir(self.root) if not n.endswith(".tmp")]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def _link_or_copy(source, destination):
+    """source を destination にハードリンクする。できなければコピーする。"""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class OutputCache:
+    """変換・圧縮の結果をキャッシュして、同じ入力と設定の再実行では再利用する。
+
+    キーは入力ファイルの fingerprint と出力に影響するジョブの設定。
+    出力はキャッシュとハードリンクで共有する (別のドライブならコピーする)。共有している
+    出力はその場で書き換えられることがあるので、file_fingerprint (サイズ・更新日時と先頭・末尾の
+    内容) を記録して再利用の前に確かめる。
+    max_bytes の MAX_OUTPUT_ENTRY_RATIO より大きい出力はキャッシュせず、合計サイズが
+    max_bytes を超えたら、最後に使ってから長いものから削除する。
+    """
+
+    def __init__(self, root=None, max_bytes=DEFAULT_OUTPUT_CACHE_MB * 1024 * 1024):
+        self._root = root
+        self.max_bytes = max_bytes
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = cache_dir("outputs")
+        return self._root
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def restore(self, key, output_path):
+        """キャッシュされた出力を output_path に置き、記録されていた警告のリストを返す。無ければ None。"""
+        entry = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry, OUTPUT_META_NAME), encoding="utf-8") as f:
+                meta = json.load(f)
+            cached = os.path.join(entry, meta["name"])
+            # 共有している出力がその場で書き換えられていたら使わない
+            if os.path.getsize(cached) != meta["size"] or file_fingerprint(cached) != meta["fingerprint"]:
+                shutil.rmtree(entry, ignore_errors=True)
+                return None
+            if not (os.path.exists(output_path) and os.path.samefile(cached, output_path)):
+                tmp_path = temp_path(output_path)
+                _link_or_copy(cached, tmp_path)
+                os.replace(tmp_path, output_path)
+            os.utime(entry)
+            return list(meta.get("warnings", []))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def store(self, key, output_path, warnings=()):
+        """output_path をキャッシュに登録する (大きすぎる出力は登録しない)"""
+        size = os.path.getsize(output_path)
+        if size > self.max_bytes * MAX_OUTPUT_ENTRY_RATIO:
+            return
+        entry = self._entry_dir(key)
+        tmp_entry = temp_path(entry)
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        name = "output" + os.path.splitext(output_path)[1]
+        cached = os.path.join(tmp_entry, name)
+        _link_or_copy(output_path, cached)
+        meta = {"name": name, "size": size, "fingerprint": file_fingerprint(cached), "warnings": list(warnings),
+                "stored": time.time()}
+        with open(os.path.join(tmp_entry, OUTPUT_META_NAME), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # 別のプロセスが同じ結果を先に登録した
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            entry = os.path.join(self.root, name)
+            if name.endswith(".tmp") or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, n)) for n in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+            total += size
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def default_output_cache():
+    """環境変数の設定に従った OutputCache を返す。CONVERTER_OUTPUT_CACHE=0 なら None。"""
+    if os.environ.get("CONVERTER_OUTPUT_CACHE", "1") == "0":
+        return None
+    try:
+        max_mb = float(os.environ.get("CONVERTER_OUTPUT_CACHE_MB", DEFAULT_OUTPUT_CACHE_MB))
+    except ValueError:
+        max_mb = DEFAULT_OUTPUT_CACHE_MB
+    return OutputCache(max_bytes=int(max_mb * 1024 * 1024))
@@ -0,0 +1,162 @@
+"""FFmpeg の検出と利用可能なエンコーダーの判定。
+
+ffmpeg -encoders の結果に含まれていても、ドライバーや GPU が無いと
+ハードウェアエンコーダーは初期化に失敗する。そのため小さな映像を実際に
+エンコードして確認し、結果を FFmpeg の実行ファイル (パス・更新日時・サイズ)
+ごとにディスクへキャッシュする。起動時に毎回 FFmpeg を実行しなくて済む。
+"""
+import json
+import os
+import shutil
+import subprocess
+from dataclasses import asdict, dataclass, field
+
+from cache import cache_dir
+from encoders import AUTO_ENCODER, ENCODERS
+
+
+# CREATE_NO_WINDOW は Windows 専用なので、他のOSでは 0 を使う
+CREATE_NO_WINDOW = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+
+# キャッシュの形式や判定方法を変えたら上げる
+CACHE_VERSION = 2
+CACHE_FILE_NAME = "ffmpeg_capabilities.json"
+# ハードウェアエンコーダーの動作確認1回あたりの制限時間 (秒)
+VERIFY_TIMEOUT = 20
+
+
+def ffmpeg_binary(name="ffmpeg"):
+    """FFmpeg (または ffprobe) の実行ファイルのパスを返す。見つからなければ None。
+
+    環境変数 CONVERTER_FFMPEG / CONVERTER_FFPROBE で明示的に指定できる。
+    install_ffmpeg.py はカレントディレクトリに展開するので、そこも探す。
+    """
+    override = os.environ.get(f"CONVERTER_{name.upper()}")
+    if override:
+        return override
+    found = shutil.which(name)
+    if found:
+        return found
+    for candidate in (f"{name}.exe", name):
+        local = os.path.join(os.getcwd(), candidate)
+        if os.path.isfile(local):
+            return local
+    return None
+
+
+def check_ffmpeg():
+    """FFmpegが利用可能ならTrueを返す"""
+    return ffmpeg_binary() is not None
+
+
+def parse_encoder_list(output):
+    """ffmpeg -encoders の出力からエンコーダー名の集合を返す"""
+    names = set()
+    in_list = False
+    for line in output.splitlines():
+        if line.strip().startswith("------"):
+            in_list = True
+            continue
+        parts = line.split()
+        if in_list and len(parts) >= 2:
+            names.add(parts[1])
+    return names
+
+
+@dataclass
+class Capabilities:
+    """FFmpeg の検出結果"""
+    ffmpeg_path: str = None
+    compiled_encoders: list = field(default_factory=list)
+    # 実際にエンコードできることを確認したエンコーダー
+    usable_encoders: list = field(default_factory=list)
+
+    @property
+    def ffmpeg_available(self):
+        return self.ffmpeg_path is not None
+
+    def encoder_choices(self):
+        """UI に表示する (表示名, エンコーダー名) の一覧。
+
+        libx264 は常に先頭、その次に自動選択 ("auto") を置く。
+        """
+        choices = [("CPU (libx264)", "libx264"), ("自動 (速さと画質で選択)", AUTO_ENCODER)]
+        for spec in ENCODERS:
+            if spec.name != "libx264" and spec.name in self.usable_encoders:
+                choices.append((spec.label, spec.name))
+        return choices
+
+
+def _binary_signature(path):
+    stat = os.stat(path)
+    return {"version": CACHE_VERSION, "path": os.path.abspath(path), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def verify_encoder(ffmpeg, encoder):
+    """小さな映像を実際にエンコードして、エンコーダーが使えるか確認する"""
+    command = [
+        ffmpeg, "-hide_banner", "-v", "error",
+        "-f", "lavfi", "-i", "color=c=black:s=256x256:r=30:d=0.2",
+        "-frames:v", "2", "-c:v", encoder, "-f", "null", "-"
+    ]
+    try:
+        subprocess.run(
+            command, check=True, capture_output=True, timeout=VERIFY_TIMEOUT,
+            creationflags=CREATE_NO_WINDOW
+        )
+        return True
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return False
+
+
+def probe_capabilities(ffmpeg):
+    """FFmpeg を実行してエンコーダーを調べる (キャッシュは使わない)"""
+    try:
+        result = subprocess.run(
+            [ffmpeg, "-hide_banner", "-encoders"],
+            capture_output=True, text=True, check=True,
+            creationflags=CREATE_NO_WINDOW
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return Capabilities()
+
+    compiled = parse_encoder_list(result.stdout)
+    usable = []
+    for spec in ENCODERS:
+        if spec.name not in compiled:
+            continue
+        if not spec.hardware or verify_encoder(ffmpeg, spec.name):
+            usable.append(spec.name)
+    return Capabilities(ffmpeg_path=ffmpeg, compiled_encoders=sorted(compiled), usable_encoders=usable)
+
+
+def load_capabilities(refresh=False):
+    """FFmpeg の検出結果を返す。FFmpeg が変わっていなければキャッシュを使う。"""
+    ffmpeg = ffmpeg_binary()
+    if ffmpeg is None:
+        return Capabilities()
+    try:
+        signature = _binary_signature(ffmpeg)
+    except OSError:
+        # PATH 上の名前だけが分かっている場合など
+        return probe_capabilities(ffmpeg)
+
+    cache_path = os.path.join(cache_dir(), CACHE_FILE_NAME)
+    if not refresh:
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached.get("signature") == signature:
+                return Capabilities(**cached["capabilities"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    capabilities = probe_capabilities(ffmpeg)
+    if capabilities.ffmpeg_available:
+        try:
+            with open(cache_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"signature": signature, "capabilities": asdict(capabilities)}, f)
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError:
+            pass
+    return capabilities
@@ -0,0 +1,495 @@
+"""コマンドラインから変換・圧縮を実行する (表示環境は不要)。
+
+    python cli.py convert INPUT... --to webp
+    python cli.py compress INPUT... --size 10 [--encoder libx264]
+    python cli.py compress INPUT... --min-ssim 0.97
+    python cli.py batch --manifest jobs.jsonl [--results results.json]
+    python cli.py probe INPUT...
+    python cli.py watch FOLDER... --to webp | --size 10 [--output-dir DIR]
+    python cli.py watch --rules rules.json
+
+INPUT にはファイル、フォルダ、ワイルドカードを指定できる。
+マニフェストは ConversionJob のフィールドを持つオブジェクトの JSON 配列、
+または1行1ジョブの JSONL。監視モードのルールファイルも同じ形式で、各項目は
+folder (監視するフォルダ), output_dir, recursive と ConversionJob のフィールドを持つ。
+
+終了コード:
+    0   すべてのジョブが成功した
+    1   失敗したジョブがある
+    2   引数やマニフェストが不正
+    130 中断された (Ctrl+C)
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from dataclasses import fields
+
+import media_info
+import metrics
+from batch import BatchRunner, JobJournal, collect_jobs, default_journal, list_input_files
+from engine import DEFAULT_IMAGE_MEMORY_LIMIT_MB, ConversionJob, file_category
+from formats import IMAGE_FORMATS, VIDEO_FORMATS
+from quality import validate_quality_target
+from watch import DEFAULT_POLL_INTERVAL, DEFAULT_SETTLE_SECONDS, WatchRule, WatchService
+
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_INTERRUPTED = 130
+
+JOB_FIELDS = {f.name for f in fields(ConversionJob)}
+# 監視モードのルールで指定できる ConversionJob のフィールド (入出力のパスはファイルごとに決まる)
+RULE_JOB_FIELDS = JOB_FIELDS - {"input_path", "output_path", "mode"}
+
+
+class UsageError(ValueError):
+    """引数やマニフェストの誤り (終了コード 2)"""
+
+
+def _load_entries(path, label):
+    """JSON 配列または JSONL のファイルから項目の一覧を読み込む"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+    except OSError as e:
+        raise UsageError(f"{label}を読み込めません: {e}")
+
+    try:
+        stripped = text.lstrip()
+        if stripped.startswith("["):
+            return json.loads(stripped)
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    except ValueError as e:
+        raise UsageError(f"{label}の形式が正しくありません: {e}")
+
+
+def load_manifest(path):
+    """JSON 配列または JSONL のマニフェストからジョブの一覧を読み込む"""
+    entries = _load_entries(path, "マニフェスト")
+    base_dir = os.path.dirname(os.path.abspath(path))
+    return [job_from_dict(entry, base_dir) for entry in entries]
+
+
+def load_rules(path):
+    """JSON 配列または JSONL のルールファイルから監視モードのルールの一覧を読み込む"""
+    entries = _load_entries(path, "ルールファイル")
+    base_dir = os.path.dirname(os.path.abspath(path))
+    return [rule_from_dict(entry, base_dir) for entry in entries]
+
+
+def rule_from_dict(entry, base_dir="."):
+    """ルールファイルの1項目を WatchRule に変換する。相対パスはルールファイルの場所から解決する。"""
+    if not isinstance(entry, dict):
+        raise UsageError(f"ルールはオブジェクトで指定してください: {entry!r}")
+    options = dict(entry)
+    folder = options.pop("folder", None)
+    if not folder:
+        raise UsageError(f"folder が指定されていないルールがあります: {entry!r}")
+    mode = options.pop("mode", "convert")
+    output_dir = options.pop("output_dir", None)
+    recursive = bool(options.pop("recursive", False))
+    unknown = set(options) - RULE_JOB_FIELDS
+    if unknown:
+        raise UsageError(f"不明なルールの項目です: {', '.join(sorted(unknown))}")
+    if mode not in ("convert", "compress"):
+        raise UsageError(f"不明なモードです: {mode}")
+    if mode == "convert" and not options.get("target_format"):
+        raise UsageError(f"変換モードのルールには target_format を指定してください: {folder}")
+    if mode == "compress" and not options.get("target_size_mb") and options.get("target_quality") is None:
+        raise UsageError(f"圧縮モードのルールには target_size_mb か target_quality を指定してください: {folder}")
+    return WatchRule(folder=os.path.join(base_dir, folder), mode=mode,
+                     output_dir=os.path.join(base_dir, output_dir) if output_dir else None,
+                     recursive=recursive, options=options)
+
+
+def job_from_dict(entry, base_dir="."):
+    """マニフェストの1項目を ConversionJob に変換する。相対パスはマニフェストの場所から解決する。"""
+    if not isinstance(entry, dict):
+        raise UsageError(f"ジョブはオブジェクトで指定してください: {entry!r}")
+    entry = dict(entry)
+    if "input" in entry:
+        entry["input_path"] = entry.pop("input")
+    if "output" in entry:
+        entry["output_path"] = entry.pop("output")
+    unknown = set(entry) - JOB_FIELDS
+    if unknown:
+        raise UsageError(f"不明なジョブの項目です: {', '.join(sorted(unknown))}")
+    if "input_path" not in entry:
+        raise UsageError(f"input_path が指定されていないジョブがあります: {entry!r}")
+    for key in ("input_path", "output_path"):
+        if entry.get(key):
+            entry[key] = os.path.join(base_dir, entry[key])
+    job = ConversionJob(**entry)
+    if job.mode not in ("convert", "compress"):
+        raise UsageError(f"不明なモードです: {job.mode}")
+    return job
+
+
+def expand_inputs(inputs, mode, target_format=None, recursive=False, **options):
+    """ファイル・フォルダ・ワイルドカードの指定からジョブの一覧を作る"""
+    jobs = []
+    for source in inputs:
+        if os.path.isdir(source) or not os.path.exists(source):
+            found = collect_jobs(source, mode, target_format=target_format, recursive=recursive, **options)
+            if not found and not os.path.isdir(source):
+                raise UsageError(f"入力ファイルが見つかりません: {source}")
+            jobs.extend(found)
+        elif file_category(source) is None:
+            raise UsageError(f"対応していないファイル形式です: {source}")
+        else:
+            job = ConversionJob(input_path=source, mode=mode, target_format=target_format, **options)
+            try:
+                # 入力ファイルを上書きすることになる指定 (同じ形式への変換など) はここで拒否する
+                for target in job.split_targets() if job.targets else [job]:
+                    target.resolve_output_path()
+            except ValueError as e:
+                raise UsageError(f"{source}: {e}")
+            jobs.append(job)
+    return jobs
+
+
+def parse_targets(value):
+    """--to の "webp" や "png,webp:800" (形式:長辺の最大値) を (形式, targets) にする"""
+    targets = []
+    for item in value.split(","):
+        fmt, _, dimension = item.strip().lower().partition(":")
+        if fmt not in IMAGE_FORMATS + VIDEO_FORMATS:
+            raise UsageError(f"対応していない変換後フォーマットです: {fmt}")
+        if not dimension:
+            targets.append(fmt)
+            continue
+        try:
+            targets.append({"format": fmt, "max_dimension": int(dimension)})
+        except ValueError:
+            raise UsageError(f"長辺の最大値には整数を指定してください: {item}")
+    if len(targets) == 1 and isinstance(targets[0], str):
+        return targets[0], None
+    first = targets[0] if isinstance(targets[0], str) else targets[0]["format"]
+    return first, targets
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def result_record(result):
+    """結果ファイルに書き出す1ジョブ分の記録。複数形式に出力したジョブは output と output_size がリストになる。"""
+    job = result.job
+    # 自動選択や出力できないコンテナでの置き換えがあるので、実際に使ったエンコーダーを優先する
+    encoder = (result.metrics or {}).get("encoder")
+    if encoder is None and file_category(job.input_path) == "video":
+        encoder = job.encoder
+    record = {
+        "input": job.input_path,
+        "output": result.output_path,
+        "mode": job.mode,
+        "status": "ok" if result.ok else "failed",
+        "input_size": None,
+        "output_size": None,
+        "duration": None,
+        "encoder": encoder,
+        "wall_time": round(result.wall_time, 3) if result.wall_time is not None else None,
+        "error": result.error,
+        "warnings": result.warnings,
+        "metrics": result.metrics,
+        "resumed": result.resumed,
+    }
+    record["input_size"] = _file_size(job.input_path)
+    if isinstance(result.output_path, list):
+        record["output_size"] = [_file_size(path) for path in result.output_path]
+    elif result.output_path:
+        record["output_size"] = _file_size(result.output_path)
+        if file_category(result.output_path) == "video":
+            try:
+                record["duration"] = media_info.probe(result.output_path).duration
+            except (RuntimeError, OSError):
+                pass
+    return record
+
+
+def write_results(path, results):
+    records = [result_record(r) for r in results]
+    if path == "-":
+        json.dump(records, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False, indent=2)
+
+
+def run_jobs(jobs, args):
+    """ジョブを並列実行し、結果を書き出して終了コードを返す"""
+    if not jobs:
+        print("処理対象のファイルがありません。", file=sys.stderr)
+        return EXIT_OK
+    if args.no_cache:
+        for job in jobs:
+            job.use_cache = False
+
+    metrics_log = metrics.MetricsLog(args.metrics_log) if args.metrics_log else None
+
+    def on_event(msg_type, payload):
+        if msg_type == "batch_progress" and not args.quiet:
+            done, total, failed = payload
+            print(f"\r[{done}/{total}] 失敗: {failed}", end="", file=sys.stderr, flush=True)
+        elif msg_type == "metrics" and metrics_log:
+            metrics_log.write(payload)
+
+    journal = JobJournal(args.journal) if args.journal else None
+    runner = BatchRunner(jobs, on_event=on_event, image_workers=args.image_workers, video_workers=args.video_workers,
+                         journal=journal)
+    try:
+        results = runner.run()
+    except KeyboardInterrupt:
+        # 実行中のジョブは runner.run() が中断してから戻る
+        print("\n中断されました。", file=sys.stderr)
+        return EXIT_INTERRUPTED
+    if not args.quiet:
+        print(file=sys.stderr)
+        resumed = sum(1 for r in results if r.resumed)
+        if resumed:
+            print(f"ジャーナルで完了済みのため飛ばしたジョブ: {resumed}件", file=sys.stderr)
+
+    for result in results:
+        if not result.ok:
+            print(f"失敗: {result.job.input_path}: {result.error}", file=sys.stderr)
+    if args.results:
+        write_results(args.results, results)
+    if args.prometheus:
+        metrics.write_prometheus(args.prometheus, [r.metrics for r in results if r.metrics])
+    return EXIT_OK if all(r.ok for r in results) else EXIT_FAILED
+
+
+def image_options(args):
+    if args.max_dimension is not None and args.max_dimension <= 0:
+        raise UsageError("--max-dimension には0より大きい値を指定してください。")
+    return {"max_dimension": args.max_dimension, "memory_limit_mb": args.memory_limit_mb}
+
+
+def compress_options(args):
+    if args.min_ssim is not None and args.min_psnr is not None:
+        raise UsageError("--min-ssim と --min-psnr は同時に指定できません。")
+    target_quality, quality_metric = (args.min_ssim, "ssim") if args.min_psnr is None else (args.min_psnr, "psnr")
+    if target_quality is not None:
+        if args.size is not None:
+            raise UsageError("--size と --min-ssim / --min-psnr は同時に指定できません。")
+        validate_quality_target(quality_metric, target_quality)
+    elif args.size is None or args.size <= 0:
+        raise UsageError("--size には0より大きい値 (MB) を指定するか、--min-ssim / --min-psnr で目標画質を指定してください。")
+    return {
+        "target_size_mb": args.size,
+        "target_quality": target_quality,
+        "quality_metric": quality_metric,
+        "encoder": args.encoder,
+        "rate_control": args.rate_control,
+        "segments": args.segments,
+        "auto_resize": args.auto_resize,
+        "hwaccel": args.hwaccel,
+        **image_options(args),
+    }
+
+
+def cmd_convert(args):
+    target_format, targets = parse_targets(args.to)
+    jobs = expand_inputs(args.inputs, "convert", target_format=target_format, recursive=args.recursive,
+                         targets=targets, **image_options(args))
+    return run_jobs(jobs, args)
+
+
+def cmd_compress(args):
+    jobs = expand_inputs(args.inputs, "compress", recursive=args.recursive, **compress_options(args))
+    return run_jobs(jobs, args)
+
+
+def cmd_batch(args):
+    jobs = []
+    if args.manifest:
+        jobs.extend(load_manifest(args.manifest))
+    if args.inputs:
+        if args.mode == "convert":
+            if not args.to:
+                raise UsageError("--mode convert には --to を指定してください。")
+            target_format, targets = parse_targets(args.to)
+            jobs.extend(expand_inputs(args.inputs, "convert", target_format=target_format, recursive=args.recursive,
+                                      targets=targets, **image_options(args)))
+        else:
+            jobs.extend(expand_inputs(args.inputs, "compress", recursive=args.recursive, **compress_options(args)))
+    if not args.manifest and not args.inputs:
+        raise UsageError("--manifest または入力ファイルを指定してください。")
+    return run_jobs(jobs, args)
+
+
+def cmd_probe(args):
+    status = EXIT_OK
+    records = []
+    for source in args.inputs:
+        for path in (list_input_files(source, recursive=args.recursive) if not os.path.isfile(source) else [source]):
+            try:
+                records.append(media_info.probe(path).to_dict())
+            except (RuntimeError, OSError) as e:
+                records.append({"path": path, "error": str(e)})
+                status = EXIT_FAILED
+    json.dump(records, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+    return status
+
+
+def cmd_watch(args):
+    rules = load_rules(args.rules) if args.rules else []
+    if args.folders:
+        if args.mode == "convert":
+            if not args.to:
+                raise UsageError("--mode convert には --to を指定してください。")
+            target_format, targets = parse_targets(args.to)
+            options = {"target_format": target_format, "targets": targets, **image_options(args)}
+        else:
+            options = compress_options(args)
+        rules.extend(WatchRule(folder=folder, mode=args.mode, output_dir=args.output_dir, recursive=args.recursive,
+                               options=dict(options)) for folder in args.folders)
+    if not rules:
+        raise UsageError("--rules または監視するフォルダを指定してください。")
+    if args.no_cache:
+        for rule in rules:
+            rule.options["use_cache"] = False
+
+    metrics_log = metrics.MetricsLog(args.metrics_log) if args.metrics_log else None
+
+    def on_event(msg_type, payload):
+        if msg_type == "status" and not args.quiet:
+            print(payload, file=sys.stderr)
+        elif msg_type == "metrics" and metrics_log:
+            metrics_log.write(payload)
+        elif msg_type == "watch_result":
+            if not payload.ok:
+                print(f"失敗: {payload.job.input_path}: {payload.error}", file=sys.stderr)
+            elif not args.quiet:
+                print(f"完了: {payload.job.input_path} -> {payload.output_path}", file=sys.stderr)
+
+    # 再起動しても処理済みのファイルを処理し直さないように、常にジャーナルに記録する
+    if args.journal:
+        journal = JobJournal(args.journal)
+    else:
+        journal = default_journal(",".join(os.path.abspath(rule.folder) for rule in rules), rules=repr(rules))
+    service = WatchService(rules, on_event=on_event, image_workers=args.image_workers,
+                           video_workers=args.video_workers, journal=journal,
+                           settle_seconds=args.settle, poll_interval=args.poll_interval,
+                           use_inotify=not args.poll)
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        # 実行中のジョブは service.run() が中断してから戻る
+        print("\n監視を終了しました。", file=sys.stderr)
+        return EXIT_INTERRUPTED
+    return EXIT_OK
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="ファイルコンバーター＆圧縮ツール (コマンドライン版)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_common(p):
+        p.add_argument("-r", "--recursive", action="store_true", help="フォルダ内を再帰的に探す")
+        p.add_argument("--image-workers", type=int, default=None, help="画像ジョブの同時実行数 (既定: CPUコア数)")
+        p.add_argument("--video-workers", type=int, default=None, help="動画ジョブの同時実行数")
+        p.add_argument("--results", help="結果をJSONで書き出すファイル (- で標準出力)")
+        p.add_argument("-q", "--quiet", action="store_true", help="進捗を表示しない")
+        p.add_argument("--no-cache", action="store_true", help="前回の変換結果を再利用せずに必ず処理し直す")
+        p.add_argument("--metrics-log", help="ジョブごとの計測値 (処理時間・サイズなど) を1行1件のJSONで追記するファイル (- で標準エラー出力)")
+        p.add_argument("--prometheus", help="計測値の集計を Prometheus のテキスト形式で書き出すファイル")
+        p.add_argument("--journal", help="ジョブの完了を記録するファイル (JSONL)。再実行時は完了済みのジョブを飛ばす")
+
+    def add_image_options(p):
+        p.add_argument("--max-dimension", type=int, default=None, help="長辺の最大値 (ピクセル)。超える画像と圧縮する動画は縮小する")
+        p.add_argument("--memory-limit-mb", type=int, default=DEFAULT_IMAGE_MEMORY_LIMIT_MB,
+                       help=f"画像1枚を展開するメモリの上限 (MB, 既定: {DEFAULT_IMAGE_MEMORY_LIMIT_MB})")
+
+    def add_compress_options(p):
+        p.add_argument("--size", type=float, help="目標ファイルサイズ (MB)")
+        p.add_argument("--min-ssim", type=float,
+                       help="目標サイズの代わりに画質の下限を SSIM (0〜1, 例: 0.97) で指定し、それを満たす最も小さい出力にする")
+        p.add_argument("--min-psnr", type=float, help="画質の下限を PSNR (dB, 例: 40) で指定する")
+        p.add_argument("--encoder", default="libx264", help="動画エンコーダー (既定: libx264)。auto なら出力形式に合うものから速さと画質で自動選択")
+        p.add_argument("--rate-control", choices=["auto", "two_pass", "single_pass"], default="auto")
+        p.add_argument("--segments", type=int, default=1, help="動画を分割して並列エンコードする区間数")
+        p.add_argument("--no-auto-resize", dest="auto_resize", action="store_false",
+                       help="目標サイズに合わせて解像度を下げない (品質・ビットレートだけで調整する)")
+        p.add_argument("--no-hwaccel", dest="hwaccel", action="store_false",
+                       help="ハードウェアエンコーダーでも、デコードと縮小は CPU で行う")
+
+    p = subparsers.add_parser("convert", help="拡張子を変換する")
+    p.add_argument("inputs", nargs="+")
+    p.add_argument("--to", required=True,
+                   help="変換後のフォーマット (例: webp, mp4)。png,webp:800 のようにカンマ区切りで複数指定すると1回の読み込みで出力する")
+    add_image_options(p)
+    add_common(p)
+    p.set_defaults(func=cmd_convert)
+
+    p = subparsers.add_parser("compress", help="目標サイズに圧縮する")
+    p.add_argument("inputs", nargs="+")
+    add_compress_options(p)
+    add_image_options(p)
+    add_common(p)
+    p.set_defaults(func=cmd_compress)
+
+    p = subparsers.add_parser("batch", help="マニフェストやフォルダのジョブをまとめて実行する")
+    p.add_argument("inputs", nargs="*")
+    p.add_argument("--manifest", help="ジョブの JSON / JSONL ファイル")
+    p.add_argument("--mode", choices=["convert", "compress"], default="convert")
+    p.add_argument("--to", help="変換後のフォーマット (--mode convert, カンマ区切りで複数指定可)")
+    add_compress_options(p)
+    add_image_options(p)
+    add_common(p)
+    p.set_defaults(func=cmd_batch)
+
+    p = subparsers.add_parser("watch", help="フォルダを監視して、置かれたファイルを自動で処理する (Ctrl+C で終了)")
+    p.add_argument("folders", nargs="*")
+    p.add_argument("--rules", help="フォルダごとの処理方法の JSON / JSONL ファイル")
+    p.add_argument("--mode", choices=["convert", "compress"], default="convert")
+    p.add_argument("--to", help="変換後のフォーマット (--mode convert, カンマ区切りで複数指定可)")
+    p.add_argument("--output-dir", help="出力先のフォルダ (既定: 入力ファイルと同じフォルダ)")
+    p.add_argument("--settle", type=float, default=DEFAULT_SETTLE_SECONDS,
+                   help=f"サイズと更新日時がこの秒数変わらなくなったら処理する (既定: {DEFAULT_SETTLE_SECONDS:g})")
+    p.add_argument("--poll", action="store_true", help="inotify を使わずに一定間隔でフォルダを調べる")
+    p.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                   help=f"フォルダを調べる間隔 (秒, 既定: {DEFAULT_POLL_INTERVAL:g})")
+    add_compress_options(p)
+    add_image_options(p)
+    p.add_argument("-r", "--recursive", action="store_true", help="フォルダ内を再帰的に監視する")
+    p.add_argument("--image-workers", type=int, default=None, help="画像ジョブの同時実行数 (既定: CPUコア数)")
+    p.add_argument("--video-workers", type=int, default=None, help="動画ジョブの同時実行数")
+    p.add_argument("-q", "--quiet", action="store_true", help="完了したファイルを表示しない")
+    p.add_argument("--no-cache", action="store_true", help="前回の変換結果を再利用せずに必ず処理し直す")
+    p.add_argument("--metrics-log", help="ジョブごとの計測値を1行1件のJSONで追記するファイル (- で標準エラー出力)")
+    p.add_argument("--journal", help="処理済みのファイルを記録するファイル (既定: キャッシュフォルダ)")
+    p.set_defaults(func=cmd_watch)
+
+    p = subparsers.add_parser("probe", help="メディア情報をJSONで表示する")
+    p.add_argument("inputs", nargs="+")
+    p.add_argument("-r", "--recursive", action="store_true", help="フォルダ内を再帰的に探す")
+    p.set_defaults(func=cmd_probe)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except ValueError as e:
+        # UsageError や ConversionJob の設定の誤り
+        print(f"エラー: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""動画エンコーダーの登録表。
+
+エンコーダーをコーデックの系統 (H.264 / HEVC / VP9 / AV1) ごとにまとめ、
+エンコーダーごとのプリセット・レート制御の引数、格納できるコンテナ、
+GPU でのデコード方法を持つ。エンコーダーに "auto" を指定すると、使える
+エンコーダーの中から目標のビットレートで画質を保てる最も速いものを選ぶ。
+"""
+from dataclasses import dataclass
+
+from formats import can_copy, can_encode
+
+
+AUTO_ENCODER = "auto"
+# 登録されていないエンコーダーをハードウェアエンコーダーとみなす名前の末尾
+HARDWARE_ENCODER_SUFFIXES = ("_nvenc", "_qsv", "_amf")
+# 1画素1フレームあたりのビット数 (H.264 換算) がこれ以上なら画質を保てるとみなす
+GOOD_BITS_PER_PIXEL = 0.1
+# 圧縮効率の差がこの割合以内のエンコーダーは同程度とみなし、速いほうを選ぶ
+EFFICIENCY_TOLERANCE = 0.1
+# 変換モードの画質指定 (quality) の段階
+QUALITY_LEVELS = ("High", "Medium", "Low")
+# 目標画質圧縮で -crf を探索する範囲を、画質指定の High / Low の値からどれだけ広げるか
+CRF_SEARCH_MARGIN = (8, 12)
+
+# ハードウェアエンコーダーの前段で使うデコード方法:
+# (-hwaccel, -hwaccel_output_format, GPU 上で縮小するフィルタ)
+_NVENC_PIPELINE = ("cuda", "cuda", "scale_cuda={width}:{height}")
+_QSV_PIPELINE = ("qsv", "qsv", "scale_qsv=w={width}:h={height}")
+# AMF は D3D11 のフレームを直接受け取れる (Windows のみ)
+_AMF_PIPELINE = ("d3d11va", "d3d11", None)
+
+
+@dataclass(frozen=True)
+class EncoderSpec:
+    """1つの動画エンコーダーの設定"""
+    name: str
+    # コーデックの系統 (ffprobe の codec_name と同じ名前)。不明なら None
+    family: str
+    label: str
+    hardware: bool = False
+    # 同じ画質に必要なビットレートの比 (H.264 = 1.0)
+    efficiency: float = 1.0
+    # おおよその相対的な速さ (libx264 の既定のプリセット = 1.0)
+    speed: float = 1.0
+    # 速度と画質のプリセットの引数
+    preset_args: tuple = ()
+    # -pass 1 / -pass 2 の2パスエンコードに対応しているか
+    two_pass: bool = True
+    # -maxrate / -bufsize で最大ビットレートを制限できるか
+    vbv: bool = True
+    # 変換モードの画質指定 (High, Medium, Low) に対応する -crf の値。空なら対応しない
+    crf: tuple = ()
+    # -crf を固定画質として使うために必要な引数
+    crf_args: tuple = ()
+    # GPU でデコード・縮小する方法 (上の _*_PIPELINE)
+    hwaccel: tuple = None
+
+    def supports_container(self, container):
+        """container に出力できるか (系統が不明なエンコーダーは確認しない)"""
+        return self.family is None or can_encode(container, self.family)
+
+    def video_args(self, bitrate_kbps, maxrate_factor=None, bufsize_factor=None):
+        """目標ビットレートでエンコードする -c:v からの引数。
+
+        maxrate_factor を指定すると、対応するエンコーダーでは最大ビットレートも制限する。
+        """
+        args = ["-c:v", self.name, *self.preset_args, "-b:v", f"{int(bitrate_kbps)}k"]
+        if maxrate_factor and self.vbv:
+            args += ["-maxrate", f"{int(bitrate_kbps * maxrate_factor)}k",
+                     "-bufsize", f"{int(bitrate_kbps * (bufsize_factor or maxrate_factor))}k"]
+        return args
+
+    def quality_args(self, quality):
+        """画質指定 (High / Medium / Low) でエンコードする -c:v からの引数"""
+        return self.crf_video_args(dict(zip(QUALITY_LEVELS, self.crf)).get(quality, self.crf[1]))
+
+    def crf_video_args(self, crf):
+        """固定画質 (-crf) でエンコードする -c:v からの引数"""
+        return ["-c:v", self.name, *self.preset_args, "-crf", str(crf), *self.crf_args]
+
+    @property
+    def crf_search_range(self):
+        """目標画質圧縮で探索する -crf の範囲 (画質指定の High より高画質から Low より低画質まで)"""
+        return max(0, self.crf[0] - CRF_SEARCH_MARGIN[0]), self.crf[-1] + CRF_SEARCH_MARGIN[1]
+
+    def container_args(self, container):
+        """コンテナに合わせて追加する引数"""
+        if self.family == "hevc" and container in ("mp4", "mov"):
+            # Apple の機器で再生できるように hvc1 タグを付ける
+            return ["-tag:v", "hvc1"]
+        return []
+
+
+ENCODERS = [
+    # H.264
+    EncoderSpec("libx264", "h264", "CPU (libx264)", crf=(20, 25, 30)),
+    EncoderSpec("h264_nvenc", "h264", "Nvidia GPU (nvenc)", hardware=True, speed=6.0, efficiency=1.1,
+                two_pass=False, hwaccel=_NVENC_PIPELINE),
+    EncoderSpec("h264_qsv", "h264", "Intel GPU (qsv)", hardware=True, speed=5.0, efficiency=1.1,
+                two_pass=False, hwaccel=_QSV_PIPELINE),
+    EncoderSpec("h264_amf", "h264", "AMD GPU (amf)", hardware=True, speed=5.0, efficiency=1.15,
+                two_pass=False, hwaccel=_AMF_PIPELINE),
+    # HEVC
+    EncoderSpec("libx265", "hevc", "CPU HEVC (libx265)", speed=0.3, efficiency=0.65,
+                preset_args=("-preset", "medium"), two_pass=False, crf=(22, 27, 32)),
+    EncoderSpec("hevc_nvenc", "hevc", "Nvidia GPU HEVC (nvenc)", hardware=True, speed=5.0, efficiency=0.75,
+                two_pass=False, hwaccel=_NVENC_PIPELINE),
+    EncoderSpec("hevc_qsv", "hevc", "Intel GPU HEVC (qsv)", hardware=True, speed=4.0, efficiency=0.75,
+                two_pass=False, hwaccel=_QSV_PIPELINE),
+    EncoderSpec("hevc_amf", "hevc", "AMD GPU HEVC (amf)", hardware=True, speed=4.0, efficiency=0.8,
+                two_pass=False, hwaccel=_AMF_PIPELINE),
+    # VP9 (libvpx の既定の設定は非常に遅いので、速度を優先した設定にする)
+    EncoderSpec("libvpx-vp9", "vp9", "CPU VP9 (libvpx-vp9)", speed=0.3, efficiency=0.7,
+                preset_args=("-deadline", "good", "-cpu-used", "4", "-row-mt", "1"),
+                crf=(31, 36, 41), crf_args=("-b:v", "0")),
+    # AV1
+    EncoderSpec("libsvtav1", "av1", "CPU AV1 (SVT-AV1)", speed=0.6, efficiency=0.55,
+                preset_args=("-preset", "8"), two_pass=False, vbv=False, crf=(30, 35, 40)),
+    EncoderSpec("libaom-av1", "av1", "CPU AV1 (libaom)", speed=0.15, efficiency=0.5,
+                preset_args=("-cpu-used", "6", "-row-mt", "1"), crf=(30, 35, 40), crf_args=("-b:v", "0")),
+    EncoderSpec("av1_nvenc", "av1", "Nvidia GPU AV1 (nvenc)", hardware=True, speed=4.0, efficiency=0.6,
+                two_pass=False, hwaccel=_NVENC_PIPELINE),
+    EncoderSpec("av1_qsv", "av1", "Intel GPU AV1 (qsv)", hardware=True, speed=4.0, efficiency=0.6,
+                two_pass=False, hwaccel=_QSV_PIPELINE),
+    EncoderSpec("av1_amf", "av1", "AMD GPU AV1 (amf)", hardware=True, speed=4.0, efficiency=0.65,
+                two_pass=False, hwaccel=_AMF_PIPELINE),
+]
+_ENCODERS_BY_NAME = {spec.name: spec for spec in ENCODERS}
+
+
+def get_encoder(name):
+    """エンコーダー名の EncoderSpec を返す。登録されていない名前は既定の設定で扱う。"""
+    spec = _ENCODERS_BY_NAME.get(name)
+    if spec is not None:
+        return spec
+    hardware = any(name.endswith(suffix) for suffix in HARDWARE_ENCODER_SUFFIXES)
+    return EncoderSpec(name, None, name, hardware=hardware, two_pass=not hardware)
+
+
+def bits_per_pixel(bitrate_kbps, width, height, fps):
+    """1画素1フレームあたりのビット数。解像度やフレームレートが不明なら None。"""
+    if not width or not height or not fps:
+        return None
+    return bitrate_kbps * 1000 / (width * height * fps)
+
+
+def choose_encoder(available, container, bitrate_kbps, width=None, height=None, fps=None):
+    """available (エンコーダー名の一覧) から container に出力するエンコーダーを選ぶ。
+
+    H.264 換算のビット数が GOOD_BITS_PER_PIXEL 以上になるエンコーダーのうち最も速いもの、
+    どれも届かなければ最も圧縮効率の良いもの (と同程度のもの) のうち最も速いものを返す。
+    container が格納できると分かっている系統のものを優先し、分からなければ H.264 から選ぶ。
+    出力できるものが無ければ None。
+    """
+    supported = [_ENCODERS_BY_NAME[name] for name in available
+                 if name in _ENCODERS_BY_NAME and _ENCODERS_BY_NAME[name].supports_container(container)]
+    candidates = ([spec for spec in supported if can_copy(container, "video", spec.family)]
+                  or [spec for spec in supported if spec.family == "h264"] or supported)
+    if not candidates:
+        return None
+    bpp = bits_per_pixel(bitrate_kbps, width, height, fps)
+    good = [spec for spec in candidates if bpp is None or bpp / spec.efficiency >= GOOD_BITS_PER_PIXEL]
+    if good:
+        return max(good, key=lambda spec: spec.speed)
+    best = min(spec.efficiency for spec in candidates)
+    close = [spec for spec in candidates if spec.efficiency <= best * (1 + EFFICIENCY_TOLERANCE)]
+    return max(close, key=lambda spec: spec.speed)
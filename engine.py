@@ -0,0 +1,1457 @@
+"""GUIに依存しない変換・圧縮エンジン。
+
+tkinter や表示環境が無くても変換・圧縮を実行できるように、処理本体を
+ConverterApp から切り離したモジュール。進捗やエラーは on_event コールバック
+(msg_type, payload) で通知し、cancel() で処理を中断できる。
+"""
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
+from io import BytesIO
+
+import image_io
+import media_info
+from cache import PassLogCache, cache_key, default_output_cache, file_fingerprint
+from capabilities import CREATE_NO_WINDOW, check_ffmpeg, ffmpeg_binary, load_capabilities
+from encoders import AUTO_ENCODER, choose_encoder, get_encoder
+from formats import (
+    CONTAINER_DEFAULT_ENCODERS, IMAGE_FORMATS, VIDEO_FORMATS, VIDEO_TO_ANIMATION_FORMATS, plan_stream_codecs
+)
+from metrics import JobMetrics
+from quality import (
+    ffmpeg_quality_filter, format_quality_score, measure_image_quality, parse_ffmpeg_quality, quality_sample_ranges,
+    validate_quality_target
+)
+
+
+# 目標サイズ圧縮で探索する画像品質の範囲
+MIN_IMAGE_QUALITY = 5
+MAX_IMAGE_QUALITY = 95
+# 変換モードの画質指定 (High / Medium / Low) に対応する画像の品質
+IMAGE_QUALITY_LEVELS = {"High": 90, "Medium": 75, "Low": 50}
+# この画素数以上の画像は、約 PROXY_PIXELS 画素に縮小した画像で品質の見当を付ける
+PROXY_MIN_PIXELS = 4_000_000
+PROXY_PIXELS = 1_000_000
+PROXY_SEARCH_WINDOW = 8
+# 目標サイズ圧縮で解像度を決めるときに基準にする画像品質
+RESIZE_IMAGE_QUALITY = 75
+# この割合以上に画素数を減らせる場合だけ縮小する (わずかな縮小は品質の調整で足りる)
+RESIZE_MIN_PIXEL_RATIO = 0.9
+# 1件の画像ジョブで展開を許すメモリ量の既定値 (MB)
+DEFAULT_IMAGE_MEMORY_LIMIT_MB = 2048
+
+# FFmpegのエラー表示用に保持する stderr の行数
+STDERR_TAIL_LINES = 200
+# 処理中の出力のファイル名に付ける印。成功したら本来の名前に置き換える
+PARTIAL_MARKER = ".part"
+
+# 目標サイズ圧縮 (動画) の設定
+SINGLE_PASS_MAXRATE_FACTOR = 1.5
+SINGLE_PASS_BUFSIZE_FACTOR = 2.0
+# 再エンコード時は目標より少し低いビットレートを狙う
+CORRECTION_MARGIN = 0.97
+PASSLOG_NAME = "ffmpeg2pass"
+# 動画の目標サイズ圧縮で、1画素1フレームあたりのビット数がこれを下回る場合は解像度を下げる
+MIN_VIDEO_BITS_PER_PIXEL = 0.05
+# 解像度を下げるときの候補 (短辺のピクセル数)
+VIDEO_RESIZE_SHORT_SIDES = (2160, 1440, 1080, 720, 540, 480, 360, 240)
+# 動画から GIF / WebP アニメーションを作るときのフレームレートの上限と、既定の長辺の最大値
+ANIMATION_MAX_FPS = 15
+ANIMATION_DEFAULT_MAX_DIMENSION = 480
+# FFmpeg で直接読み込めるアニメーション画像 (WebP などは Pillow でフレームを書き出す)
+FFMPEG_ANIMATION_FORMATS = ("GIF", "PNG")
+# 目標サイズ圧縮の音声ビットレートの範囲 (元の音声のビットレートを上限にする)
+MIN_AUDIO_BITRATE_KBPS = 32
+MAX_AUDIO_BITRATE_KBPS = 128
+
+def _parse_ffmpeg_time(value):
+    """"HH:MM:SS.ffffff" 形式の時刻を秒に変換する"""
+    try:
+        hours, minutes, seconds = value.split(":")
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+
+def parse_ffmpeg_progress(values, duration=None, stage=(1, 1), encoder=None, elapsed=None):
+    """FFmpeg の -progress 出力1ブロック分 (key=value の辞書) を進捗情報に変換する。
+
+    percent と eta は duration (秒) が分かっている場合のみ計算する。
+    """
+    out_time = None
+    # out_time_ms も実際にはマイクロ秒単位で出力される
+    for key in ("out_time_us", "out_time_ms"):
+        try:
+            out_time = int(values[key]) / 1_000_000
+            break
+        except (KeyError, ValueError):
+            continue
+    if out_time is None and "out_time" in values:
+        out_time = _parse_ffmpeg_time(values["out_time"])
+
+    try:
+        fps = float(values.get("fps", ""))
+    except ValueError:
+        fps = None
+    try:
+        speed = float(values.get("speed", "").rstrip("x"))
+    except ValueError:
+        speed = None
+
+    finished = values.get("progress") == "end"
+    stage_index, stage_count = stage
+    percent = eta = None
+    if duration and out_time is not None:
+        fraction = 1.0 if finished else min(max(out_time / duration, 0.0), 1.0)
+        percent = (stage_index - 1 + fraction) / stage_count * 100
+        remaining_media = duration * (stage_count - stage_index + 1 - fraction)
+        if speed:
+            eta = remaining_media / speed
+        elif elapsed and out_time > 0:
+            eta = remaining_media * elapsed / out_time
+
+    return {
+        "percent": percent,
+        "eta": eta,
+        "fps": fps,
+        "speed": speed,
+        "out_time": out_time,
+        "stage": stage,
+        "encoder": encoder,
+        "finished": finished,
+    }
+
+
+def audio_args(audio_bitrate_kbps, container=None):
+    """目標サイズ圧縮の音声エンコード引数。ビットレートが 0 なら音声を出力しない。
+
+    エンコーダーはコンテナの既定 (webm なら Opus) を使う。
+    """
+    if not audio_bitrate_kbps:
+        return ["-an"]
+    encoder = CONTAINER_DEFAULT_ENCODERS.get(container, {}).get("audio", "aac")
+    return ["-c:a", encoder, "-b:a", f"{int(audio_bitrate_kbps)}k"]
+
+
+def quality_video_args(quality, container):
+    """変換モードの画質指定 (High / Medium / Low) で再エンコードする映像の引数。
+
+    コンテナの既定のエンコーダーが -crf に対応していなければ libx264 を使う。
+    """
+    spec = get_encoder(CONTAINER_DEFAULT_ENCODERS.get(container, {}).get("video", "libx264"))
+    if not spec.crf:
+        spec = get_encoder("libx264")
+    return spec.quality_args(quality)
+
+
+def image_quality_value(quality):
+    """変換モードの画質指定 (High / Medium / Low) に対応する画像の品質"""
+    return IMAGE_QUALITY_LEVELS.get(quality, IMAGE_QUALITY_LEVELS["Medium"])
+
+
+def _even(value):
+    # yuv420p は幅・高さが偶数である必要がある
+    return max(2, int(value) // 2 * 2)
+
+
+def plan_video_size(width, height, fps, video_bitrate_kbps, max_dimension=None, auto_resize=True, efficiency=1.0):
+    """目標ビットレートと長辺の最大値から出力解像度 (幅, 高さ) を決める。縮小しない場合は None。
+
+    1画素1フレームあたりのビット数 (efficiency で割った H.264 換算) が
+    MIN_VIDEO_BITS_PER_PIXEL を下回る場合は、VIDEO_RESIZE_SHORT_SIDES の中から
+    収まる最大の解像度を選ぶ。
+    """
+    if not width or not height:
+        return None
+    scale = 1.0
+    if max_dimension and max(width, height) > max_dimension:
+        scale = max_dimension / max(width, height)
+    if auto_resize and fps:
+        pixels = width * height * scale * scale
+        allowed_pixels = video_bitrate_kbps / efficiency * 1000 / (fps * MIN_VIDEO_BITS_PER_PIXEL)
+        if allowed_pixels < pixels:
+            short_side = min(width, height) * scale * (allowed_pixels / pixels) ** 0.5
+            candidates = [s for s in VIDEO_RESIZE_SHORT_SIDES if s <= short_side]
+            fitted = candidates[0] if candidates else VIDEO_RESIZE_SHORT_SIDES[-1]
+            scale = min(scale, fitted / min(width, height))
+    if scale >= 1.0:
+        return None
+    return _even(width * scale), _even(height * scale)
+
+
+def video_pipeline_args(encoder, size=None, hwaccel=True):
+    """エンコーダーに合わせた (入力の前に置く引数, 映像フィルタの引数) を返す。
+
+    ハードウェアエンコーダーでは、デコードしたフレームを GPU のメモリに置いたまま
+    縮小・エンコードする。対応する方法が無ければ CPU でデコードする引数を返す。
+    """
+    pipeline = get_encoder(encoder).hwaccel if hwaccel else None
+    if pipeline is None or (pipeline[0] == "d3d11va" and os.name != "nt"):
+        return [], scale_args(size)
+    accel, output_format, scale_filter = pipeline
+    if size is not None and scale_filter is None:
+        # GPU で縮小できない場合は、デコードだけ GPU で行いフレームをメモリに戻す
+        return ["-hwaccel", accel], scale_args(size)
+    input_args = ["-hwaccel", accel, "-hwaccel_output_format", output_format]
+    if size is None:
+        return input_args, []
+    return input_args, ["-vf", scale_filter.format(width=size[0], height=size[1])]
+
+
+def scale_args(size):
+    """plan_video_size の結果を FFmpeg の引数にする"""
+    if size is None:
+        return []
+    return ["-vf", f"scale={size[0]}:{size[1]}:flags=bilinear"]
+
+
+def resolve_rate_control(rate_control, encoder):
+    """"auto" をエンコーダーに応じた方式に解決する。
+
+    ハードウェアエンコーダーなど -pass に対応しないエンコーダーは1パスにする。
+    """
+    if rate_control not in (None, "auto", "two_pass", "single_pass"):
+        raise ValueError(f"不明なレート制御方式です: {rate_control}")
+    if rate_control == "single_pass" or not get_encoder(encoder).two_pass:
+        return "single_pass"
+    return "two_pass"
+
+
+def _same_path(path, other):
+    """2つのパスが同じファイルを指すか (大文字・小文字を区別しないファイルシステムやリンクも考慮する)"""
+    if os.path.normcase(os.path.abspath(path)) == os.path.normcase(os.path.abspath(other)):
+        return True
+    try:
+        return os.path.samefile(path, other)
+    except OSError:
+        return False
+
+
+def partial_output_path(output_path):
+    """処理中の出力を書き込む一時ファイルのパス (拡張子は出力形式の判定に使われるので残す)"""
+    root, ext = os.path.splitext(output_path)
+    return f"{root}{PARTIAL_MARKER}{ext}"
+
+
+def file_category(path):
+    """拡張子から "image" / "video" / None を返す"""
+    ext = path.split('.')[-1].lower()
+    if ext in IMAGE_FORMATS:
+        return "image"
+    if ext in VIDEO_FORMATS:
+        return "video"
+    return None
+
+
+@dataclass
+class ConversionJob:
+    """1件の変換・圧縮ジョブ。
+
+    mode は "convert" (拡張子変換) か "compress" (目標サイズ圧縮)。
+    output_path を省略すると入力ファイルと同じフォルダに出力する。
+    """
+    input_path: str
+    mode: str = "convert"
+    target_format: str = None
+    target_size_mb: float = None
+    # 圧縮モードで目標サイズの代わりに指定する画質の下限。指定すると quality_metric の値が
+    # これ以上になる最も小さい出力にする (target_size_mb は使わない)
+    target_quality: float = None
+    # target_quality の指標: "ssim" (0〜1) / "psnr" (dB)
+    quality_metric: str = "ssim"
+    # 動画の目標サイズ圧縮のエンコーダー。"auto" なら使えるものから自動で選ぶ
+    encoder: str = "libx264"
+    quality: str = None
+    output_path: str = None
+    # 動画の目標サイズ圧縮: "auto" / "two_pass" / "single_pass"
+    rate_control: str = "auto"
+    # 1パス圧縮で再エンコードせずに許容する目標サイズ超過の割合
+    size_tolerance: float = 0.05
+    # 動画の目標サイズ圧縮で、2以上なら区間に分割して並列エンコードする
+    segments: int = 1
+    # 長辺の最大値 (ピクセル)。超える画像 (と圧縮モードの動画) は縮小して出力する
+    max_dimension: int = None
+    # 圧縮モードで、目標サイズに対して画素数が多すぎる場合は解像度を下げる
+    auto_resize: bool = True
+    # ハードウェアエンコーダーを使うときに、デコードと縮小も GPU で行う
+    hwaccel: bool = True
+    # False なら変換結果のキャッシュを使わずに必ず処理し直す
+    use_cache: bool = True
+    # 変換モードで1回の読み込みから複数の形式に出力する場合の出力先の一覧。
+    # 各要素は形式名 ("webp") か {"format": "webp", "max_dimension": 800, "output_path": ...}
+    targets: list = None
+    # 画像を展開するメモリの上限 (MB)。超える画像はエラーにする
+    memory_limit_mb: int = DEFAULT_IMAGE_MEMORY_LIMIT_MB
+
+    def cache_parameters(self):
+        """出力に影響する設定 (変換結果のキャッシュのキーに使う)"""
+        params = asdict(self)
+        for name in ("input_path", "output_path", "use_cache", "memory_limit_mb", "targets"):
+            params.pop(name)
+        return params
+
+    def resolve_output_path(self):
+        """出力先のパス。入力ファイルを上書きすることになる場合は ValueError を送出する。"""
+        output_path = self.output_path or self._default_output_path()
+        if _same_path(output_path, self.input_path):
+            raise ValueError(f"出力先が入力ファイルと同じです: {output_path}")
+        return output_path
+
+    def _default_output_path(self):
+        directory, filename = os.path.split(self.input_path)
+        name, ext = os.path.splitext(filename)
+        if self.mode == "convert":
+            if not self.target_format:
+                raise ValueError("変換後のフォーマットが選択されていません。")
+            return os.path.join(directory, f"{name}.{self.target_format}")
+        return os.path.join(directory, f"{name}_compressed{ext}")
+
+    def split_targets(self):
+        """targets の各出力先を1件ずつの変換ジョブにする。
+
+        max_dimension を指定した出力のファイル名は "{名前}_{max_dimension}px.{形式}"。
+        """
+        directory, filename = os.path.split(self.input_path)
+        name = os.path.splitext(filename)[0]
+        jobs = []
+        for target in self.targets or []:
+            if isinstance(target, str):
+                target = {"format": target}
+            if not isinstance(target, dict) or not target.get("format"):
+                raise ValueError(f"出力先の指定が正しくありません: {target!r}")
+            unknown = set(target) - {"format", "max_dimension", "output_path"}
+            if unknown:
+                raise ValueError(f"不明な出力先の項目です: {', '.join(sorted(unknown))}")
+            fmt = target["format"].lower()
+            max_dimension = target.get("max_dimension", self.max_dimension)
+            output_path = target.get("output_path")
+            if not output_path:
+                suffix = f"_{max_dimension}px" if target.get("max_dimension") else ""
+                output_path = os.path.join(directory, f"{name}{suffix}.{fmt}")
+            jobs.append(replace(self, mode="convert", target_format=fmt, max_dimension=max_dimension,
+                                output_path=output_path, targets=None))
+        return jobs
+
+
+class ConversionEngine:
+    """ConversionJob を実行する。
+
+    on_event(msg_type, payload) には "status" / "warning" のメッセージが
+    ワーカースレッドから送られる。cancel() は別スレッドから呼び出してよい。
+    """
+
+    def __init__(self, on_event=None, ffmpeg_available=None, output_cache=None):
+        self.on_event = on_event
+        # None の場合は動画処理が必要になった時点で確認する
+        self.ffmpeg_available = ffmpeg_available
+        # 変換結果のキャッシュ (CONVERTER_OUTPUT_CACHE=0 で無効)
+        self.output_cache = output_cache if output_cache is not None else default_output_cache()
+        # 実行中のジョブで通知した警告 (変換結果と一緒にキャッシュする)
+        self._warnings = []
+        # 実行中のFFmpegプロセス (分割並列エンコードでは複数になる)
+        self._processes = set()
+        self._process_lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        # 画像のエンコードと FFmpeg の実行の回数 (ベンチマーク用)
+        self.encode_count = 0
+        self.ffmpeg_runs = 0
+        # 実行中のジョブの計測値 (終了時に ("metrics", dict) で通知する)
+        self.metrics = None
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        """処理を中断し、実行中のFFmpegプロセスをすべて終了する"""
+        self._cancel_event.set()
+        self.kill_processes()
+
+    def kill_processes(self):
+        """実行中のFFmpegプロセスをすべて終了する (中断フラグは立てない)"""
+        with self._process_lock:
+            processes = list(self._processes)
+        for process in processes:
+            try:
+                process.kill()
+            except Exception:
+                pass
+
+    def emit(self, msg_type, payload):
+        if msg_type == "warning":
+            self._warnings.append(payload)
+        if self.on_event:
+            self.on_event(msg_type, payload)
+
+    def run(self, job):
+        """ジョブを実行して出力パスを返す。中断された場合は None を返す。
+
+        同じ入力と設定の結果がキャッシュにあれば、処理せずにそれを出力する。
+        変換モードで targets を指定した場合は出力パスのリストを返す。
+        終了時 (失敗・中断を含む) にはジョブの計測値を ("metrics", dict) で通知する。
+        """
+        self.metrics = self._start_metrics(job)
+        counts = (self.encode_count, self.ffmpeg_runs)
+        started = time.perf_counter()
+        output_path = None
+        try:
+            output_path = self._run_job(job)
+            self.metrics.status = "ok" if output_path is not None else "cancelled"
+            return output_path
+        except Exception as e:
+            self.metrics.status = "cancelled" if self.cancel_requested else "failed"
+            self.metrics.error = str(e).strip().splitlines()[0] if str(e).strip() else e.__class__.__name__
+            raise
+        finally:
+            self._finish_metrics(output_path, counts, time.perf_counter() - started)
+
+    def _start_metrics(self, job):
+        category = file_category(job.input_path)
+        try:
+            if job.targets:
+                output_format = ",".join(target.target_format for target in job.split_targets())
+            else:
+                output_format = job.resolve_output_path().split('.')[-1].lower()
+        except ValueError:
+            # 指定の誤りは処理の中でエラーにする
+            output_format = None
+        metrics = JobMetrics(
+            input_path=job.input_path,
+            mode=job.mode,
+            input_format=job.input_path.split('.')[-1].lower(),
+            output_format=output_format,
+            encoder=job.encoder if category == "video" and job.mode == "compress" else None,
+        )
+        if job.mode == "compress" and job.target_quality is not None:
+            metrics.quality_metric = job.quality_metric
+        elif job.mode == "compress" and job.target_size_mb:
+            metrics.target_bytes = int(job.target_size_mb * 1024 * 1024)
+        try:
+            metrics.bytes_in = os.path.getsize(job.input_path)
+        except OSError:
+            pass
+        return metrics
+
+    def _finish_metrics(self, output_path, counts, wall_time):
+        metrics = self.metrics
+        metrics.wall_time = wall_time
+        metrics.ffmpeg_runs = self.ffmpeg_runs - counts[1]
+        metrics.image_encodes = self.encode_count - counts[0] - metrics.ffmpeg_runs
+        paths = output_path if isinstance(output_path, list) else [output_path] if output_path else []
+        try:
+            if paths:
+                metrics.bytes_out = sum(os.path.getsize(path) for path in paths)
+        except OSError:
+            pass
+        self.emit("metrics", metrics.to_dict())
+
+    def _add_time(self, phase, seconds):
+        if self.metrics is not None:
+            self.metrics.add_time(phase, seconds)
+
+    def _run_job(self, job):
+        if job.mode == "convert":
+            if job.targets:
+                return self.convert_targets(job)
+            process = self.convert_file
+        elif job.mode == "compress":
+            process = self.compress_file
+        else:
+            raise ValueError(f"不明なモードです: {job.mode}")
+
+        key = self._output_cache_key(job)
+        if self._restore_output(job, key):
+            self.metrics.cached = True
+            return job.resolve_output_path()
+
+        self._warnings = []
+        output_path = process(job)
+        if output_path is not None:
+            self._store_output(key, output_path)
+        return output_path
+
+    def convert_targets(self, job):
+        """入力を1回だけ読み込み (デコードし)、targets のすべての形式に出力する。
+
+        キャッシュにある出力は再利用し、残りだけを処理する。出力パスのリストを返す。
+        """
+        category = file_category(job.input_path)
+        formats = IMAGE_FORMATS if category == "image" else VIDEO_FORMATS if category == "video" else None
+        if formats is None:
+            raise ValueError("対応していないファイル形式です。")
+        jobs = job.split_targets()
+        for target in jobs:
+            if target.target_format not in formats:
+                raise ValueError(f"対応していない変換後フォーマットです: {target.target_format}")
+            # 入力ファイルと同じ出力先なら ValueError になる
+            target.resolve_output_path()
+
+        keys = [self._output_cache_key(target) for target in jobs]
+        pending = [(target, key) for target, key in zip(jobs, keys) if not self._restore_output(target, key)]
+        self.metrics.cached = not pending
+        if pending:
+            self.emit("status", f"変換中... -> {', '.join(os.path.basename(t.resolve_output_path()) for t, k in pending)}")
+            self._warnings = []
+            outputs = [(partial_output_path(t.resolve_output_path()), t.resolve_output_path()) for t, k in pending]
+            partial_jobs = [replace(t, output_path=partial) for (t, k), (partial, final) in zip(pending, outputs)]
+            try:
+                if category == "image":
+                    self._convert_image_targets(job, partial_jobs)
+                else:
+                    self._require_ffmpeg()
+                    self._convert_video_targets(job, partial_jobs)
+                if self.cancel_requested:
+                    return None
+                for partial, final in outputs:
+                    os.replace(partial, final)
+            finally:
+                for partial, final in outputs:
+                    self._remove_partial(partial)
+            for target, key in pending:
+                self._store_output(key, target.resolve_output_path())
+        return [target.resolve_output_path() for target in jobs]
+
+    def _restore_output(self, job, key):
+        """キャッシュにある出力を job の出力先に置く。置けたら True。"""
+        if key is None:
+            return False
+        output_path = job.resolve_output_path()
+        warnings = self.output_cache.restore(key, output_path)
+        if warnings is None:
+            return False
+        self.emit("status", f"前回の結果を再利用しました: {os.path.basename(output_path)}")
+        for warning in warnings:
+            self.emit("warning", warning)
+        return True
+
+    def _store_output(self, key, output_path):
+        if key is None or not os.path.exists(output_path):
+            return
+        try:
+            self.output_cache.store(key, output_path, self._warnings)
+        except OSError:
+            # キャッシュに保存できなくても変換は成功している
+            pass
+
+    def _output_cache_key(self, job):
+        if not job.use_cache or self.output_cache is None:
+            return None
+        try:
+            fingerprint = file_fingerprint(job.input_path)
+        except OSError:
+            # 入力が無い場合のエラーは処理の中で通知する
+            return None
+        ext = os.path.splitext(job.resolve_output_path())[1].lower()
+        return cache_key(fingerprint, ext, *sorted(job.cache_parameters().items()))
+
+    def convert_file(self, job):
+        output_path = job.resolve_output_path()
+
+        self.emit("status", f"変換中... -> {os.path.basename(output_path)}")
+
+        self._run_process(job, output_path)
+
+        if self.cancel_requested:
+            return None
+        return output_path
+
+    def compress_file(self, job):
+        target_size = job.target_size_mb
+        if job.target_quality is not None:
+            validate_quality_target(job.quality_metric, job.target_quality)
+        elif target_size is None or target_size <= 0:
+            raise ValueError("目標ファイルサイズは0より大きい値を入力してください。")
+
+        output_path = job.resolve_output_path()
+
+        self.emit("status", f"圧縮中... -> {os.path.basename(output_path)}")
+
+        self._run_process(job, output_path)
+
+        if self.cancel_requested:
+            return None
+
+        if not os.path.exists(output_path):
+            raise RuntimeError("圧縮ファイルの生成に失敗しました。詳細は警告メッセージを確認してください。")
+
+        final_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+        self.emit("status", f"圧縮完了: {os.path.basename(output_path)} ({final_size_mb:.2f}MB)")
+        return output_path
+
+    def _run_process(self, job, output_path):
+        """一時ファイルに出力し、成功した場合だけ output_path に置き換える。
+
+        中断や失敗で途中まで書き込まれたファイルが output_path に残らず、以前の出力も失われない。
+        os.replace は名前を付け替えるだけなので、以前の出力をキャッシュとハードリンクで
+        共有していても、キャッシュの内容は書き換わらない。
+        """
+        partial_path = partial_output_path(output_path)
+        try:
+            self._dispatch(job, partial_path)
+            if not self.cancel_requested and os.path.exists(partial_path):
+                os.replace(partial_path, output_path)
+        finally:
+            self._remove_partial(partial_path)
+
+    def _remove_partial(self, partial_path):
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+
+    def _dispatch(self, job, output_path):
+        category = file_category(job.input_path)
+        output_category = file_category(output_path)
+        if category == "image" and output_category == "video":
+            self._require_ffmpeg()
+            self._animation_to_video(job, output_path)
+        elif category == "video" and output_category == "image":
+            self._require_ffmpeg()
+            self._video_to_animation(job, output_path)
+        elif category == "image":
+            self._process_image(job, output_path)
+        elif category == "video":
+            self._require_ffmpeg()
+            self._process_video(job, output_path)
+        else:
+            raise ValueError("対応していないファイル形式です。")
+
+    def _require_ffmpeg(self):
+        if self.ffmpeg_available is None:
+            self.ffmpeg_available = check_ffmpeg()
+        if not self.ffmpeg_available:
+            raise RuntimeError("FFmpegが利用できないため、動画処理を実行できません。")
+
+    def _process_image(self, job, output_path):
+        input_path = job.input_path
+        target_size_mb = job.target_size_mb if job.mode == "compress" else None
+        target_quality = job.target_quality if job.mode == "compress" else None
+        output_ext = output_path.split('.')[-1].lower()
+
+        # 中断は画像を開いた後と、品質の探索のエンコード1回ごとに確認する
+        started = time.perf_counter()
+        img = source = image_io.load_image(input_path, max_dimension=job.max_dimension, memory_limit_mb=job.memory_limit_mb)
+        self._add_time("decode", time.perf_counter() - started)
+        started = time.perf_counter()
+        try:
+            if self.cancel_requested: return
+            if image_io.is_animated(img):
+                if output_ext in image_io.ANIMATED_FORMATS:
+                    self._process_animation(job, img, output_path, output_ext)
+                    return
+                self.emit("warning", f".{output_ext} 形式はアニメーション・複数ページに対応していないため、最初のフレームだけを出力します。")
+                img = image_io.first_frame(img, job.max_dimension)
+
+            if target_quality is not None:
+                self._compress_image_to_quality(job, img, output_path, output_ext)
+                return
+
+            if target_size_mb is not None:
+                target_bytes = target_size_mb * 1024 * 1024
+
+                if output_ext not in ('jpg', 'jpeg', 'webp'):
+                    self.emit("warning", "目標サイズ指定圧縮はJPG/JPEG/WEBP形式でのみ有効です。他の形式ではファイルサイズが変わりません。\nファイルをそのままコピーします。")
+                    self._save_image(img, output_path)
+                    return
+
+                img = image_io.prepare_for_format(img, output_ext)
+                img_format = 'JPEG' if output_ext in ('jpg', 'jpeg') else output_ext.upper()
+                try:
+                    buffer = self._search_image_quality(img, img_format, target_bytes)
+                    if buffer is None and job.auto_resize and not self.cancel_requested:
+                        # 元の解像度では最低品質でも収まらない場合だけ、解像度を下げる
+                        resized = self._fit_image_resolution(img, img_format, target_bytes)
+                        if resized is not img:
+                            img = resized
+                            buffer = self._search_image_quality(img, img_format, target_bytes)
+                except Exception as e:
+                    self.emit("warning", f".{output_ext} 形式は品質指定による圧縮に失敗しました。\n{e}")
+                    self._save_image(img, output_path)
+                    return
+                if self.cancel_requested: return
+
+                if buffer is not None:
+                    with open(output_path, 'wb') as f:
+                        f.write(buffer.getbuffer())
+                    return
+
+                self._save_image(img, output_path, format=img_format, quality=MIN_IMAGE_QUALITY)
+                final_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+                self.emit("warning", f"目標サイズ({target_size_mb:.2f}MB)に到達できませんでした。可能な限り低い品質で圧縮しました (結果: {final_size_mb:.2f}MB)。")
+                return
+
+            options = {}
+            if job.quality:
+                options['quality'] = image_quality_value(job.quality)
+
+            img = image_io.prepare_for_format(img, output_ext)
+            self._save_image(img, output_path, **options)
+        finally:
+            # アニメーションのフレームは保存時に読み込むので、読み込みもエンコードに含まれる
+            self._add_time("encode", time.perf_counter() - started)
+            source.close()
+
+    def _process_animation(self, job, img, output_path, output_ext):
+        """複数フレームの画像を、フレームの表示時間とループ回数を保ったまま出力する"""
+        loop = img.info.get("loop")
+        if output_ext in ("gif", "png", "webp") and not image_io.has_frame_durations(img):
+            self.emit("warning", f"表示時間が記録されていないため、各ページを {image_io.DEFAULT_FRAME_DURATION_MS}ms ずつ表示するアニメーションとして出力します。")
+        animation = image_io.resize_frames(img, job.max_dimension, job.memory_limit_mb)
+        target_size_mb = job.target_size_mb if job.mode == "compress" else None
+
+        if target_size_mb is not None and output_ext == "webp":
+            # フレーム全体のサイズが目標になるので、縮小画像での見積もりは使わずに全フレームで探索する
+            target_bytes = target_size_mb * 1024 * 1024
+            _, buffer = self._bisect_image_quality(
+                (animation, loop), "WEBP", target_bytes, MIN_IMAGE_QUALITY, MAX_IMAGE_QUALITY)
+            if self.cancel_requested: return
+            if buffer is not None:
+                with open(output_path, 'wb') as f:
+                    f.write(buffer.getbuffer())
+                return
+            self._save_animation(animation, output_path, output_ext, loop, quality=MIN_IMAGE_QUALITY)
+            final_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+            self.emit("warning", f"目標サイズ({target_size_mb:.2f}MB)に到達できませんでした。可能な限り低い品質で圧縮しました (結果: {final_size_mb:.2f}MB)。")
+            return
+        if job.mode == "compress" and job.target_quality is not None:
+            self.emit("warning", "アニメーションは目標画質を指定した圧縮に対応していません。既定の品質で出力します。")
+        elif target_size_mb is not None:
+            self.emit("warning", "アニメーションの目標サイズ指定圧縮はWEBP形式でのみ有効です。他の形式ではファイルサイズが変わりません。\n"
+                                 "GIFを大幅に小さくするには、MP4などの動画形式に変換してください。")
+
+        options = {}
+        if job.quality and output_ext == "webp":
+            options['quality'] = image_quality_value(job.quality)
+        self._save_animation(animation, output_path, output_ext, loop, **options)
+
+    def _compress_image_to_quality(self, job, img, output_path, output_ext):
+        """画質の指標が target_quality 以上になる最も低い品質で img を出力する"""
+        metric, floor = job.quality_metric, job.target_quality
+        if output_ext not in ('jpg', 'jpeg', 'webp'):
+            self.emit("warning", "目標画質を指定した圧縮はJPG/JPEG/WEBP形式でのみ有効です。他の形式では可逆圧縮で出力します。")
+            self._save_image(image_io.prepare_for_format(img, output_ext), output_path)
+            return
+
+        img = image_io.prepare_for_format(img, output_ext)
+        img_format = 'JPEG' if output_ext in ('jpg', 'jpeg') else output_ext.upper()
+        q, buffer, score = self._search_image_quality_floor(img, img_format, metric, floor)
+        if self.cancel_requested: return
+        if buffer is None:
+            q = MAX_IMAGE_QUALITY
+            buffer = self._encode_image(img, img_format, q)
+            score = self._measure_image(img, buffer, metric)
+            self.emit("warning", f"目標画質 ({format_quality_score(metric, floor)}) に到達できませんでした。"
+                                 f"最も高い品質で圧縮しました (結果: {format_quality_score(metric, score)})。")
+        else:
+            self.emit("status", f"品質 {q} で {format_quality_score(metric, score)} になりました。")
+        if self.metrics is not None:
+            self.metrics.quality_score = score
+        with open(output_path, 'wb') as f:
+            f.write(buffer.getbuffer())
+
+    def _measure_image(self, img, buffer, metric):
+        """エンコード結果 buffer をデコードし、img に対する画質の指標を返す"""
+        from PIL import Image
+
+        with Image.open(BytesIO(buffer.getvalue())) as candidate:
+            candidate.load()
+            return measure_image_quality(metric, img, candidate)
+
+    def _search_image_quality_floor(self, img, img_format, metric, floor):
+        """画質の指標が floor 以上になる最も低い品質を二分探索する。
+
+        (品質, エンコード結果, 指標の値) を返す。最高品質でも届かなければ (None, None, None)。
+        """
+        low, high = MIN_IMAGE_QUALITY, MAX_IMAGE_QUALITY
+        best = (None, None, None)
+        while low <= high:
+            if self.cancel_requested:
+                break
+            q = (low + high) // 2
+            buffer = self._encode_image(img, img_format, q)
+            score = self._measure_image(img, buffer, metric)
+            if score >= floor:
+                best = (q, buffer, score)
+                high = q - 1
+            else:
+                low = q + 1
+        return best
+
+    def _convert_image_targets(self, job, jobs):
+        """画像を1回だけデコードし、jobs の各形式に並列にエンコードする"""
+        from PIL import Image
+
+        # すべての出力に最大サイズがあれば、その最大値までは縮小して読み込んでよい
+        dimensions = [target.max_dimension for target in jobs]
+        load_dimension = max(dimensions) if all(dimensions) else None
+        options = {}
+        if job.quality:
+            options['quality'] = image_quality_value(job.quality)
+
+        started = time.perf_counter()
+        source = image_io.load_image(job.input_path, max_dimension=load_dimension, memory_limit_mb=job.memory_limit_mb)
+        try:
+            source.load()
+            self._add_time("decode", time.perf_counter() - started)
+            started = time.perf_counter()
+
+            if image_io.is_animated(source):
+                # フレームを読み進めながら保存するので、1つずつ順に出力する
+                for target in jobs:
+                    self._save_frames(target, source, target.resolve_output_path(), target.target_format, options)
+                self._add_time("encode", time.perf_counter() - started)
+                return
+
+            def encode(target):
+                output_path = target.resolve_output_path()
+                img = source
+                size = image_io.scaled_size(img.size, target.max_dimension)
+                if size != img.size:
+                    img = img.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+                img = image_io.prepare_for_format(img, target.target_format)
+                if img is source:
+                    # save() は Image オブジェクトに設定を書き込むので、スレッドごとに別のオブジェクトを使う
+                    img = source.copy()
+                self._save_image(img, output_path, **options)
+
+            # Pillow はエンコード中に GIL を解放するので、スレッドで並列に実行できる
+            with ThreadPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as pool:
+                for future in [pool.submit(encode, target) for target in jobs]:
+                    future.result()
+            self._add_time("encode", time.perf_counter() - started)
+        finally:
+            source.close()
+
+    def _save_frames(self, job, img, output_path, output_ext, options):
+        """複数フレームの画像を、形式が対応していればアニメーションのまま、そうでなければ最初のフレームだけ出力する"""
+        img.seek(0)
+        if output_ext in image_io.ANIMATED_FORMATS:
+            self._process_animation(job, img, output_path, output_ext)
+            return
+        self.emit("warning", f".{output_ext} 形式はアニメーション・複数ページに対応していないため、最初のフレームだけを出力します。")
+        frame = image_io.prepare_for_format(image_io.first_frame(img, job.max_dimension), output_ext)
+        self._save_image(frame, output_path, **options)
+
+    def _encode_image(self, img, img_format, quality):
+        """img を quality でエンコードした BytesIO を返す。
+
+        アニメーションは (resize_frames の結果, ループ回数) のタプルで渡す。
+        """
+        buffer = BytesIO()
+        if isinstance(img, tuple):
+            animation, loop = img
+            self._save_animation(animation, buffer, img_format.lower(), loop, quality=quality)
+        else:
+            self._save_image(img, buffer, format=img_format, quality=quality)
+        return buffer
+
+    def _save_image(self, img, output, **params):
+        """img を保存する。画像のエンコードはすべてここか _save_animation を通して数える。"""
+        with self._process_lock:
+            self.encode_count += 1
+        img.save(output, **params)
+
+    def _save_animation(self, animation, output, output_ext, loop=None, **options):
+        """image_io.save_animation で保存し、1回のエンコードとして数える"""
+        with self._process_lock:
+            self.encode_count += 1
+        image_io.save_animation(animation, output, output_ext, loop, **options)
+
+    def _bisect_image_quality(self, img, img_format, target_bytes, low, high):
+        """low..high の範囲で target_bytes 以下になる最も高い品質を二分探索する。
+
+        (品質, エンコード結果) を返す。範囲内に条件を満たす品質が無ければ (None, None)。
+        """
+        best_quality, best_buffer = None, None
+        while low <= high:
+            if self.cancel_requested:
+                break
+            q = (low + high) // 2
+            buffer = self._encode_image(img, img_format, q)
+            if buffer.tell() <= target_bytes:
+                best_quality, best_buffer = q, buffer
+                low = q + 1
+            else:
+                high = q - 1
+        return best_quality, best_buffer
+
+    def _fit_image_resolution(self, img, img_format, target_bytes):
+        """RESIZE_IMAGE_QUALITY で target_bytes に収まる解像度まで縮小した画像を返す。
+
+        縮小したプロキシ画像を1回エンコードして1画素あたりのバイト数を見積もる。
+        縮小が不要なら img をそのまま返す。
+        """
+        from PIL import Image
+
+        pixels = img.width * img.height
+        factor = max(1, int((pixels / PROXY_PIXELS) ** 0.5))
+        try:
+            proxy = img.reduce(factor) if factor > 1 else img
+        except (ValueError, OSError):
+            return img
+        buffer = self._encode_image(proxy, img_format, RESIZE_IMAGE_QUALITY)
+        allowed_pixels = target_bytes * (proxy.width * proxy.height) / max(1, buffer.tell())
+        if allowed_pixels >= pixels * RESIZE_MIN_PIXEL_RATIO:
+            return img
+
+        scale = (allowed_pixels / pixels) ** 0.5
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        self.emit("status", f"目標サイズに合わせて解像度を {size[0]}x{size[1]} に縮小します...")
+        return img.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+    def _search_image_quality(self, img, img_format, target_bytes):
+        """target_bytes 以下になる最も高い品質でエンコードした BytesIO を返す。
+
+        大きな画像では縮小したプロキシ画像で品質の見当を付けてから、
+        フル解像度ではその前後だけを探索する。最低品質でも収まらなければ None。
+        """
+        low, high = MIN_IMAGE_QUALITY, MAX_IMAGE_QUALITY
+        pixels = img.width * img.height
+        if pixels >= PROXY_MIN_PIXELS:
+            factor = max(2, int((pixels / PROXY_PIXELS) ** 0.5))
+            try:
+                proxy = img.reduce(factor)
+            except (ValueError, OSError):
+                proxy = None
+            if proxy is not None:
+                proxy_target = target_bytes * (proxy.width * proxy.height) / pixels
+                estimate, _ = self._bisect_image_quality(proxy, img_format, proxy_target, low, high)
+                estimate = estimate or low
+                buffer = self._encode_image(img, img_format, estimate)
+                if buffer.tell() <= target_bytes:
+                    q, better = self._bisect_image_quality(
+                        img, img_format, target_bytes, estimate + 1, min(high, estimate + PROXY_SEARCH_WINDOW))
+                    return better if q is not None else buffer
+                if estimate == low:
+                    return None
+                q, buffer = self._bisect_image_quality(
+                    img, img_format, target_bytes, max(low, estimate - PROXY_SEARCH_WINDOW), estimate - 1)
+                if q is not None or estimate - PROXY_SEARCH_WINDOW <= low:
+                    return buffer
+                high = estimate - PROXY_SEARCH_WINDOW - 1
+
+        _, buffer = self._bisect_image_quality(img, img_format, target_bytes, low, high)
+        return buffer
+
+    def _probe(self, input_path):
+        """メディア情報を取得する (ffprobe の結果はキャッシュされる)"""
+        started = time.perf_counter()
+        try:
+            return media_info.probe(input_path)
+        finally:
+            self._add_time("probe", time.perf_counter() - started)
+
+    def _stream_copy_args(self, input_path, output_path):
+        """コンテナを変えるだけで済むストリームを再エンコードしないための引数を返す。
+
+        ストリーム情報が取得できない場合は空のリスト (FFmpeg の既定の変換) を返す。
+        """
+        container = output_path.split('.')[-1].lower()
+        try:
+            streams = self._probe(input_path).streams
+        except (RuntimeError, OSError):
+            return []
+        args, copied, transcoded = plan_stream_codecs(streams, container)
+        if not copied:
+            return []
+        if transcoded:
+            self.emit("status", f"変換中... ({copied}ストリームをコピー, {transcoded}ストリームを再エンコード)")
+        else:
+            self.emit("status", "変換中... (再エンコードせずにコンテナを変換)")
+        return args
+
+    def run_ffmpeg(self, command, error_label, duration=None, stage=(1, 1), encoder=None, on_progress=None,
+                   phase="encode"):
+        """FFmpegを実行し、失敗した場合は RuntimeError を送出する。
+
+        -progress pipe:1 の出力を1行ずつ読み取り、("progress", dict) を通知する。
+        stage は (何番目のパスか, パス数) で、進捗率は全パスを通した値になる。
+        on_progress を渡すと通知の代わりにそれを呼び出す。
+        実行時間はジョブの計測値の phase (encode / pass1 / pass2 など) に加算する。
+        stderr は末尾の STDERR_TAIL_LINES 行だけを保持し、エラー表示に使うほか戻り値として返す。
+        複数のスレッドから同時に呼び出してよい。
+        """
+        program = (ffmpeg_binary() or command[0]) if command[0] == "ffmpeg" else command[0]
+        command = [program, "-progress", "pipe:1", "-nostats"] + command[1:]
+        stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', creationflags=CREATE_NO_WINDOW)
+        with self._process_lock:
+            self._processes.add(process)
+            self.encode_count += 1
+            self.ffmpeg_runs += 1
+        started = time.perf_counter()
+        try:
+            if self.cancel_requested:
+                # cancel() が Popen より先に呼ばれた場合
+                process.kill()
+            stderr_thread = threading.Thread(target=stderr_tail.extend, args=(process.stderr,), daemon=True)
+            stderr_thread.start()
+
+            # 残り時間の見積もりに使う経過時間
+            eta_started = time.monotonic()
+            values = {}
+            for line in process.stdout:
+                key, sep, value = line.strip().partition("=")
+                if not sep:
+                    continue
+                values[key] = value
+                if key == "progress":
+                    progress = parse_ffmpeg_progress(values, duration, stage, encoder, time.monotonic() - eta_started)
+                    if on_progress:
+                        on_progress(progress)
+                    else:
+                        self.emit("progress", progress)
+                    values = {}
+
+            process.wait()
+            stderr_thread.join()
+            if process.returncode != 0:
+                if not self.cancel_requested:
+                    raise RuntimeError(f"{error_label}:\n" + "".join(stderr_tail))
+            return "".join(stderr_tail)
+        finally:
+            self._add_time(phase, time.perf_counter() - started)
+            with self._process_lock:
+                self._processes.discard(process)
+
+    def _process_video(self, job, output_path):
+        if self.cancel_requested: return
+        if job.mode == "compress":
+            self._compress_video(job, output_path)
+            return
+
+        try:
+            duration = self._probe(job.input_path).duration
+        except (RuntimeError, OSError):
+            # 長さが分からなくても変換はできる (進捗率が表示されないだけ)
+            duration = None
+
+        command = ["ffmpeg", "-i", job.input_path, "-y"]
+        if job.quality:
+            command.extend(quality_video_args(job.quality, output_path.split('.')[-1].lower()))
+        else:
+            command.extend(self._stream_copy_args(job.input_path, output_path))
+
+        command.append(output_path)
+
+        self.run_ffmpeg(command, "FFmpegエラー", duration)
+
+    def _convert_video_targets(self, job, jobs):
+        """1回の FFmpeg の実行で jobs のすべての形式に出力する。
+
+        FFmpeg は入力のストリームを1回だけデコードし、各出力のエンコーダーに渡す。
+        """
+        try:
+            info = self._probe(job.input_path)
+        except (RuntimeError, OSError):
+            info = None
+        duration = info.duration if info else None
+        video = info.video if info else None
+
+        command = ["ffmpeg", "-i", job.input_path, "-y"]
+        for target in jobs:
+            output_path = target.resolve_output_path()
+            size = None
+            if video is not None and target.max_dimension:
+                size = plan_video_size(video.width, video.height, video.fps, 0, target.max_dimension, auto_resize=False)
+            if job.quality:
+                command.extend(quality_video_args(job.quality, target.target_format))
+            elif size is None:
+                command.extend(self._stream_copy_args(job.input_path, output_path))
+            command.extend(scale_args(size))
+            command.append(output_path)
+
+        self.run_ffmpeg(command, "FFmpegエラー", duration)
+
+    def _animation_to_video(self, job, output_path):
+        """アニメーション画像 (GIF / WebP / APNG など) を動画に変換する"""
+        from PIL import ImageSequence
+
+        with image_io.load_image(job.input_path, memory_limit_mb=job.memory_limit_mb) as img:
+            if not image_io.is_animated(img):
+                raise ValueError("アニメーションではない画像は動画に変換できません。")
+            width, height = image_io.scaled_size(img.size, job.max_dimension)
+            fmt = img.format
+
+            with tempfile.TemporaryDirectory() as tempdir:
+                if fmt in FFMPEG_ANIMATION_FORMATS:
+                    input_args = ["-f", fmt.lower().replace("png", "apng"), "-i", job.input_path]
+                    try:
+                        duration = self._probe(job.input_path).duration
+                    except (RuntimeError, OSError):
+                        duration = None
+                else:
+                    # FFmpeg が読めない形式は、フレームを PNG に書き出して表示時間付きの concat で読み込む
+                    self.emit("status", "フレームを書き出しています...")
+                    list_path = os.path.join(tempdir, "frames.txt")
+                    duration = 0.0
+                    with open(list_path, "w", encoding="utf-8") as f:
+                        f.write("ffconcat version 1.0\n")
+                        for index, frame in enumerate(ImageSequence.Iterator(img)):
+                            if self.cancel_requested: return
+                            name = f"frame{index:06d}.png"
+                            self._save_image(frame, os.path.join(tempdir, name), compress_level=1)
+                            frame_seconds = (frame.info.get("duration") or image_io.DEFAULT_FRAME_DURATION_MS) / 1000
+                            duration += frame_seconds
+                            f.write(f"file '{name}'\nduration {frame_seconds:.3f}\n")
+                        # 最後のフレームの表示時間を有効にするため、最後のファイルをもう一度書く
+                        f.write(f"file '{name}'\n")
+                    input_args = ["-f", "concat", "-safe", "0", "-i", list_path]
+
+                # 画質の指定が無ければ Medium にする (エンコーダーの既定の設定は WebM では画質が低い)
+                container = output_path.split('.')[-1].lower()
+                command = [
+                    "ffmpeg", *input_args, "-vf", f"scale={_even(width)}:{_even(height)}:flags=bilinear",
+                    "-pix_fmt", "yuv420p", "-an", *quality_video_args(job.quality or "Medium", container)
+                ]
+                if output_path.lower().endswith((".mp4", ".mov")):
+                    command.extend(["-movflags", "+faststart"])
+                command.extend(["-y", output_path])
+                self.run_ffmpeg(command, "FFmpegエラー (アニメーション画像の変換)", duration)
+
+    def _video_to_animation(self, job, output_path):
+        """動画を GIF (パレットを生成して減色) または WebP アニメーションに変換する"""
+        output_ext = output_path.split('.')[-1].lower()
+        if output_ext not in VIDEO_TO_ANIMATION_FORMATS:
+            raise ValueError("動画から変換できる画像形式は GIF と WebP です。")
+        try:
+            info = self._probe(job.input_path)
+        except (RuntimeError, OSError):
+            info = None
+        duration = info.duration if info else None
+        video = info.video if info else None
+
+        fps = min(video.fps, ANIMATION_MAX_FPS) if video is not None and video.fps else ANIMATION_MAX_FPS
+        filters = [f"fps={fps:g}"]
+        size = None
+        if video is not None:
+            size = plan_video_size(video.width, video.height, None, 0,
+                                   job.max_dimension or ANIMATION_DEFAULT_MAX_DIMENSION, auto_resize=False)
+        if size is not None:
+            filters.append(f"scale={size[0]}:{size[1]}:flags=lanczos")
+        elif video is None:
+            filters.append(f"scale='min(iw,{job.max_dimension or ANIMATION_DEFAULT_MAX_DIMENSION})':-2:flags=lanczos")
+
+        command = ["ffmpeg", "-i", job.input_path, "-an"]
+        if output_ext == "gif":
+            # 動画全体から256色のパレットを作り、それを使って減色する
+            graph = ",".join(filters) + (
+                ",split[a][b];[a]palettegen=stats_mode=diff[p];"
+                "[b][p]paletteuse=dither=bayer:bayer_scale=5:diff_mode=rectangle")
+            command.extend(["-filter_complex", graph, "-loop", "0"])
+        else:
+            command.extend(["-vf", ",".join(filters), "-c:v", "libwebp_anim", "-lossless", "0",
+                            "-q:v", str(image_quality_value(job.quality)), "-loop", "0"])
+        command.extend(["-y", output_path])
+        self.run_ffmpeg(command, "FFmpegエラー (アニメーションへの変換)", duration)
+
+    def _compress_video(self, job, output_path):
+        input_path = job.input_path
+        target_size_mb = job.target_size_mb
+        container = output_path.split('.')[-1].lower()
+        try:
+            info = self._probe(input_path)
+            duration = info.duration
+            if not duration or duration <= 0:
+                raise RuntimeError("動画の長さが0秒か、取得できませんでした。")
+        except Exception as e:
+            raise RuntimeError(f"動画情報の取得に失敗しました:\n{e}")
+
+        # 元の音声より高いビットレートにしても画質 (音質) は上がらないので、元の値を上限にする
+        audio_bitrate_kbps = 0
+        if info.audio is not None:
+            source_kbps = info.audio_bitrate_kbps(default=MAX_AUDIO_BITRATE_KBPS)
+            audio_bitrate_kbps = int(min(MAX_AUDIO_BITRATE_KBPS, max(MIN_AUDIO_BITRATE_KBPS, source_kbps)))
+        if job.target_quality is not None:
+            self._compress_video_to_quality(job, output_path, info, audio_bitrate_kbps)
+            return
+        target_total_bitrate_kbps = (target_size_mb * 1024 * 8) / duration
+        target_video_bitrate_kbps = target_total_bitrate_kbps - audio_bitrate_kbps
+
+        if target_video_bitrate_kbps <= 100:
+            self.emit("warning", "目標ファイルサイズが小さすぎるため、品質が著しく低下する可能性があります。")
+            target_video_bitrate_kbps = 100
+
+        video = info.video
+        spec = self._resolve_encoder(job.encoder or "libx264", container, video, job.max_dimension,
+                                     target_video_bitrate_kbps)
+        encoder = spec.name
+        if self.metrics is not None:
+            self.metrics.encoder = encoder
+
+        # ビットレートに対して画素数が多すぎる場合は解像度を下げる (圧縮効率の良いエンコーダーほど下げない)
+        output_size = None
+        if video is not None:
+            output_size = plan_video_size(video.width, video.height, video.fps, target_video_bitrate_kbps,
+                                          job.max_dimension, job.auto_resize, spec.efficiency)
+        if output_size:
+            self.emit("status", f"目標サイズに合わせて解像度を {output_size[0]}x{output_size[1]} に縮小します...")
+
+        rate_control = resolve_rate_control(job.rate_control, encoder)
+
+        # ハードウェアエンコーダーではデコードと縮小も GPU で行い、失敗したら CPU でやり直す
+        pipelines = [video_pipeline_args(encoder, output_size, job.hwaccel)]
+        cpu_pipeline = ([], scale_args(output_size))
+        if pipelines[0] != cpu_pipeline:
+            pipelines.append(cpu_pipeline)
+        for attempt, (input_args, video_filter) in enumerate(pipelines):
+            try:
+                self._encode_to_target(job, output_path, encoder, rate_control, duration, target_total_bitrate_kbps,
+                                       target_video_bitrate_kbps, audio_bitrate_kbps, input_args, video_filter)
+                return
+            except RuntimeError as e:
+                if self.cancel_requested or attempt == len(pipelines) - 1:
+                    raise
+                self.emit("warning", f"GPUでのデコードに失敗したため、CPUでデコードしてやり直します。\n{str(e).strip().splitlines()[-1]}")
+
+    def _resolve_encoder(self, encoder, container, video, max_dimension, video_bitrate_kbps):
+        """目標サイズ圧縮に使うエンコーダーの EncoderSpec を返す。
+
+        "auto" の場合と、指定されたエンコーダーが container に出力できない場合は、
+        使えるエンコーダーから choose_encoder で選ぶ。
+        """
+        spec = get_encoder(encoder)
+        if encoder != AUTO_ENCODER and spec.supports_container(container):
+            return spec
+
+        available = load_capabilities().usable_encoders or ["libx264"]
+        width = height = fps = None
+        if video is not None and video.width and video.height:
+            (width, height), fps = image_io.scaled_size((video.width, video.height), max_dimension), video.fps
+        chosen = choose_encoder(available, container, video_bitrate_kbps, width, height, fps)
+        if chosen is None:
+            raise RuntimeError(f"{container} 形式に出力できる動画エンコーダーが見つかりません。")
+        if encoder == AUTO_ENCODER:
+            self.emit("status", f"エンコーダーを自動で選択しました: {chosen.label}")
+        else:
+            self.emit("warning", f"{encoder} は {container} 形式に出力できないため、{chosen.name} を使います。")
+        return chosen
+
+    def _compress_video_to_quality(self, job, output_path, info, audio_bitrate_kbps):
+        """サンプル区間の画質の指標が target_quality 以上になる最も大きい -crf でエンコードする"""
+        container = output_path.split('.')[-1].lower()
+        metric, floor = job.quality_metric, job.target_quality
+        spec = self._resolve_crf_encoder(job.encoder or "libx264", container)
+        if self.metrics is not None:
+            self.metrics.encoder = spec.name
+
+        output_size = None
+        if info.video is not None:
+            output_size = plan_video_size(info.video.width, info.video.height, info.video.fps, 0,
+                                          job.max_dimension, auto_resize=False)
+        video_filter = scale_args(output_size)
+
+        crf, score = self._search_crf(job.input_path, spec, container, info.duration, video_filter, metric, floor)
+        if self.cancel_requested: return
+        if score < floor:
+            self.emit("warning", f"目標画質 ({format_quality_score(metric, floor)}) に到達できませんでした。"
+                                 f"探索した範囲で最も高い画質で圧縮します (CRF {crf}, {format_quality_score(metric, score)})。")
+        if self.metrics is not None:
+            self.metrics.quality_score = score
+
+        self.emit("status", f"圧縮中... (CRF {crf}, {spec.name})")
+        command = [
+            "ffmpeg", "-i", job.input_path, *video_filter,
+            *spec.crf_video_args(crf),
+            *spec.container_args(container),
+            *audio_args(audio_bitrate_kbps, container),
+            "-y", output_path
+        ]
+        self.run_ffmpeg(command, f"FFmpegエラー ({spec.name})", info.duration, encoder=spec.name)
+
+    def _resolve_crf_encoder(self, encoder, container):
+        """目標画質圧縮に使う (-crf に対応する) エンコーダーの EncoderSpec を返す"""
+        spec = get_encoder(encoder)
+        if encoder != AUTO_ENCODER and spec.crf and spec.supports_container(container):
+            return spec
+
+        available = [name for name in (load_capabilities().usable_encoders or ["libx264"]) if get_encoder(name).crf]
+        chosen = choose_encoder(available, container, 0)
+        if chosen is None:
+            raise RuntimeError(f"{container} 形式に画質を指定して出力できる動画エンコーダーが見つかりません。")
+        if encoder == AUTO_ENCODER:
+            self.emit("status", f"エンコーダーを自動で選択しました: {chosen.label}")
+        else:
+            self.emit("warning", f"{encoder} は画質を指定した圧縮 (-crf) に対応していないか {container} 形式に出力できないため、"
+                                 f"{chosen.name} を使います。")
+        return chosen
+
+    def _search_crf(self, input_path, spec, container, duration, video_filter, metric, floor):
+        """サンプル区間の画質の指標 (区間ごとの値の最小値) が floor 以上になる最も大きい -crf を二分探索する。
+
+        (crf, 指標の値) を返す。探索範囲のどの値でも届かなければ最も高画質の crf とその値。
+        各区間は最初に (出力と同じ大きさに縮小して) 可逆圧縮で切り出し、それを各 crf でエンコードして比べる。
+        """
+        low, high = spec.crf_search_range
+        best, last = None, None
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.emit("status", "画質を測定する区間を切り出し中...")
+            references = []
+            for index, (start, length) in enumerate(quality_sample_ranges(duration)):
+                reference_path = os.path.join(tempdir, f"reference{index}.mkv")
+                command = [
+                    "ffmpeg", "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", input_path, *video_filter,
+                    "-c:v", "ffv1", "-an", "-y", reference_path
+                ]
+                self.run_ffmpeg(command, "FFmpegエラー (画質の測定)", length, on_progress=lambda progress: None,
+                                phase="quality")
+                if self.cancel_requested:
+                    return None, None
+                references.append((reference_path, length))
+
+            while low <= high:
+                crf = (low + high) // 2
+                self.emit("status", f"画質を測定中... (CRF {crf}, {spec.name})")
+                scores = []
+                for index, (reference_path, length) in enumerate(references):
+                    scores.append(self._measure_video_sample(spec, crf, reference_path, length, metric,
+                                                             os.path.join(tempdir, f"sample{index}.mkv")))
+                    if self.cancel_requested:
+                        return None, None
+                last = (crf, min(scores))
+                if last[1] >= floor:
+                    best = last
+                    low = crf + 1
+                else:
+                    high = crf - 1
+        return best or last
+
+    def _measure_video_sample(self, spec, crf, reference_path, length, metric, sample_path):
+        """切り出した区間 reference_path を crf でエンコードし、reference_path に対する画質の指標を返す。
+
+        sample_path は MKV にする (MP4 は固定フレームレートにするためにフレームを複製し、
+        元の区間とフレームがずれる)。
+        """
+        encode = ["ffmpeg", "-i", reference_path, *spec.crf_video_args(crf), "-an", "-y", sample_path]
+        self.run_ffmpeg(encode, f"FFmpegエラー (画質の測定, {spec.name})", length, on_progress=lambda progress: None,
+                        phase="quality")
+        if self.cancel_requested:
+            return None
+        measure = [
+            "ffmpeg", "-i", reference_path, "-i", sample_path,
+            "-lavfi", ffmpeg_quality_filter(metric), "-f", "null", "-"
+        ]
+        stderr = self.run_ffmpeg(measure, "FFmpegエラー (画質の測定)", length, on_progress=lambda progress: None,
+                                 phase="quality")
+        score = parse_ffmpeg_quality(metric, stderr or "")
+        if score is None and not self.cancel_requested:
+            raise RuntimeError(f"画質 ({metric.upper()}) を測定できませんでした。")
+        return score
+
+    def _encode_to_target(self, job, output_path, encoder, rate_control, duration, target_total_bitrate_kbps,
+                          target_video_bitrate_kbps, audio_bitrate_kbps, input_args, video_filter):
+        """目標ビットレートで1回エンコードする (分割並列 / 2パス / 1パス+補正)"""
+        input_path = job.input_path
+        target_size_mb = job.target_size_mb
+
+        # 循環 import を避けるため、分割エンコードを使うときだけ読み込む
+        from segments import encode_segmented, plan_segment_count
+        segment_count = plan_segment_count(job.segments, duration)
+        if segment_count > 1:
+            encode_segmented(self, input_path, output_path, encoder, target_video_bitrate_kbps, audio_bitrate_kbps,
+                             duration, segment_count, rate_control, video_filter, input_args)
+            if self.cancel_requested: return
+
+            if os.path.exists(output_path):
+                final_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+                if final_size_mb > target_size_mb * (1 + job.size_tolerance):
+                    self.emit("warning", f"目標サイズ({target_size_mb:.2f}MB)を少し超えました (結果: {final_size_mb:.2f}MB)。")
+            return
+
+        if rate_control == "two_pass":
+            self._encode_two_pass(input_path, output_path, encoder, target_video_bitrate_kbps, audio_bitrate_kbps, duration,
+                                  video_filter, input_args)
+            if self.cancel_requested: return
+
+            if os.path.exists(output_path):
+                final_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+                if final_size_mb > target_size_mb * 1.1:
+                    self.emit("warning", f"目標サイズ({target_size_mb:.2f}MB)を少し超えました (結果: {final_size_mb:.2f}MB)。")
+            return
+
+        self._encode_single_pass(input_path, output_path, encoder, target_video_bitrate_kbps, audio_bitrate_kbps, duration, (1, 1),
+                                 video_filter, input_args)
+        if self.cancel_requested or not os.path.exists(output_path): return
+
+        # 目標サイズを許容範囲以上に超えた場合だけ、ビットレートを補正して1回だけ再エンコードする
+        target_bytes = target_size_mb * 1024 * 1024
+        final_bytes = os.path.getsize(output_path)
+        if final_bytes > target_bytes * (1 + job.size_tolerance):
+            ratio = target_bytes / final_bytes
+            corrected_kbps = max(100, (target_total_bitrate_kbps * ratio - audio_bitrate_kbps) * CORRECTION_MARGIN)
+            self.emit("status", f"目標サイズを超えたため再エンコードします... ({encoder}, {int(corrected_kbps)}k)")
+            self._encode_single_pass(input_path, output_path, encoder, corrected_kbps, audio_bitrate_kbps, duration, (2, 2),
+                                     video_filter, input_args)
+            if self.cancel_requested: return
+
+            final_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+            if final_size_mb > target_size_mb * (1 + job.size_tolerance):
+                self.emit("warning", f"目標サイズ({target_size_mb:.2f}MB)を少し超えました (結果: {final_size_mb:.2f}MB)。")
+
+    def _encode_single_pass(self, input_path, output_path, encoder, video_bitrate_kbps, audio_bitrate_kbps, duration, stage,
+                            video_filter=(), input_args=()):
+        """最大ビットレートを制限した1パスVBRでエンコードする"""
+        self.emit("status", f"圧縮中... (1パス, {encoder})")
+        spec = get_encoder(encoder)
+        container = output_path.split('.')[-1].lower()
+        command = [
+            "ffmpeg", *input_args, "-i", input_path, *video_filter,
+            *spec.video_args(video_bitrate_kbps, SINGLE_PASS_MAXRATE_FACTOR, SINGLE_PASS_BUFSIZE_FACTOR),
+            *spec.container_args(container),
+            *audio_args(audio_bitrate_kbps, container),
+            "-y", output_path
+        ]
+        self.run_ffmpeg(command, f"FFmpegエラー (1パス, {encoder})", duration, stage, encoder)
+
+    def _encode_two_pass(self, input_path, output_path, encoder, video_bitrate_kbps, audio_bitrate_kbps, duration,
+                         video_filter=(), input_args=()):
+        """2パスエンコードする。1パス目のログは PassLogCache から再利用する。"""
+        spec = get_encoder(encoder)
+        container = output_path.split('.')[-1].lower()
+        passlog_cache = PassLogCache()
+        # 1パス目の統計は解像度ごとに異なるので、縮小の指定もキーに含める
+        cache_key_parts = (file_fingerprint(input_path), encoder, *video_filter)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            log_prefix = passlog_cache.lookup(cache_key_parts, PASSLOG_NAME)
+            if log_prefix:
+                self.emit("status", f"1パス目のログをキャッシュから再利用します ({encoder})")
+                stage_count, stage_index = 1, 1
+            else:
+                log_prefix = os.path.join(tempdir, PASSLOG_NAME)
+                stage_count, stage_index = 2, 2
+
+                self.emit("status", f"圧縮中... (1/2 パス, {encoder})")
+
+                pass1_cmd = [
+                    "ffmpeg", "-y", *input_args, "-i", input_path, *video_filter,
+                    *spec.video_args(video_bitrate_kbps),
+                    "-pass", "1", "-passlogfile", log_prefix,
+                    "-an", "-f", "mp4", os.devnull
+                ]
+                self.run_ffmpeg(pass1_cmd, f"FFmpegエラー (パス1, {encoder})", duration, (1, 2), encoder, phase="pass1")
+
+                if self.cancel_requested: return
+                try:
+                    passlog_cache.store(cache_key_parts, log_prefix)
+                except OSError:
+                    # キャッシュに保存できなくても圧縮は続行できる
+                    pass
+
+            self.emit("status", f"圧縮中... ({stage_index}/{stage_count} パス, {encoder})")
+
+            pass2_cmd = [
+                "ffmpeg", *input_args, "-i", input_path, *video_filter,
+                *spec.video_args(video_bitrate_kbps),
+                "-pass", "2", "-passlogfile", log_prefix,
+                *spec.container_args(container),
+                *audio_args(audio_bitrate_kbps, container),
+                "-y", output_path
+            ]
+            self.run_ffmpeg(pass2_cmd, f"FFmpegエラー (パス2, {encoder})", duration, (stage_index, stage_count), encoder,
+                            phase="pass2")
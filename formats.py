@@ -0,0 +1,139 @@
+"""対応フォーマットとコンテナごとのコーデック対応表。"""
+
+
+IMAGE_FORMATS = [
+    "png", "jpg", "jpeg", "webp", "gif", "bmp", "tiff", "tif",
+    "ico", "tga", "pcx", "ppm", "pgm", "pbm"
+]
+VIDEO_FORMATS = [
+    "mp4", "mkv", "mov", "avi", "wmv", "webm", "flv", "mpg",
+    "mpeg", "vob", "ogv", "mts", "ts", "m2ts", "3gp", "f4v"
+]
+# 動画への変換先を表示する (アニメーションの多い) 画像形式と、動画から変換できる画像形式
+ANIMATION_SOURCE_FORMATS = ["gif", "webp"]
+VIDEO_TO_ANIMATION_FORMATS = ["gif", "webp"]
+
+_MP4_CODECS = {
+    "video": {"h264", "hevc", "mpeg4", "av1", "vp9", "mpeg2video", "mjpeg"},
+    "audio": {"aac", "mp3", "ac3", "eac3", "alac", "opus", "flac"},
+    "subtitle": {"mov_text"},
+}
+_MPEGTS_CODECS = {
+    "video": {"h264", "hevc", "mpeg2video", "mpeg1video"},
+    "audio": {"aac", "mp3", "mp2", "ac3", "eac3"},
+    "subtitle": {"dvb_subtitle", "hdmv_pgs_subtitle"},
+}
+_MPEG_PS_CODECS = {
+    "video": {"mpeg1video", "mpeg2video"},
+    "audio": {"mp2", "mp3", "ac3"},
+    "subtitle": set(),
+}
+
+# そのままコピー (-c copy) できるコーデック。None はすべてのコーデックを格納できることを表す。
+CONTAINER_CODECS = {
+    "mp4": _MP4_CODECS,
+    "mov": {
+        "video": _MP4_CODECS["video"] | {"prores"},
+        "audio": _MP4_CODECS["audio"] | {"pcm_s16le", "pcm_s24le"},
+        "subtitle": {"mov_text"},
+    },
+    "3gp": {"video": {"h264", "h263", "mpeg4"}, "audio": {"aac", "amr_nb", "amr_wb"}, "subtitle": {"mov_text"}},
+    "f4v": {"video": {"h264"}, "audio": {"aac", "mp3"}, "subtitle": set()},
+    "flv": {"video": {"h264", "flv1"}, "audio": {"aac", "mp3"}, "subtitle": set()},
+    "mkv": None,
+    "webm": {"video": {"vp8", "vp9", "av1"}, "audio": {"opus", "vorbis"}, "subtitle": {"webvtt"}},
+    "avi": {"video": {"mpeg4", "h264", "mjpeg", "msmpeg4v3"}, "audio": {"mp3", "ac3", "pcm_s16le"}, "subtitle": set()},
+    "wmv": {"video": {"wmv1", "wmv2", "vc1"}, "audio": {"wmav1", "wmav2"}, "subtitle": set()},
+    "ogv": {"video": {"theora"}, "audio": {"vorbis", "opus", "flac"}, "subtitle": set()},
+    "ts": _MPEGTS_CODECS,
+    "mts": _MPEGTS_CODECS,
+    "m2ts": _MPEGTS_CODECS,
+    "mpg": _MPEG_PS_CODECS,
+    "mpeg": _MPEG_PS_CODECS,
+    "vob": {"video": {"mpeg2video"}, "audio": {"mp2", "ac3"}, "subtitle": {"dvd_subtitle"}},
+}
+
+# コピーできないストリームを再エンコードするときのエンコーダー
+_H264_AAC = {"video": "libx264", "audio": "aac"}
+CONTAINER_DEFAULT_ENCODERS = {
+    "mp4": {**_H264_AAC, "subtitle": "mov_text"},
+    "mov": {**_H264_AAC, "subtitle": "mov_text"},
+    "3gp": {**_H264_AAC, "subtitle": "mov_text"},
+    "f4v": _H264_AAC,
+    "flv": _H264_AAC,
+    "mkv": {**_H264_AAC, "subtitle": "ass"},
+    "webm": {"video": "libvpx-vp9", "audio": "libopus", "subtitle": "webvtt"},
+    "avi": {"video": "mpeg4", "audio": "libmp3lame"},
+    "wmv": {"video": "wmv2", "audio": "wmav2"},
+    "ogv": {"video": "libtheora", "audio": "libvorbis"},
+    "ts": _H264_AAC,
+    "mts": _H264_AAC,
+    "m2ts": _H264_AAC,
+    "mpg": {"video": "mpeg2video", "audio": "mp2"},
+    "mpeg": {"video": "mpeg2video", "audio": "mp2"},
+    "vob": {"video": "mpeg2video", "audio": "ac3"},
+}
+
+# 再エンコードした映像を格納できるコーデックが限られているコンテナ。
+# CONTAINER_CODECS はコピーのための控えめな表なので、エンコーダーの選択には使わない。
+# ここに無いコンテナは、どのエンコーダーの出力も格納できるものとして扱う。
+CONTAINER_ENCODE_VIDEO_CODECS = {
+    "webm": {"vp8", "vp9", "av1"},
+    "ogv": {"theora", "vp8"},
+    "3gp": {"h264", "h263", "mpeg4"},
+    "f4v": {"h264"},
+}
+
+# テキスト字幕 (別の字幕形式に変換できるもの)
+TEXT_SUBTITLE_CODECS = {"subrip", "srt", "ass", "ssa", "webvtt", "mov_text", "text"}
+
+
+def can_copy(container, codec_type, codec_name):
+    """codec_name のストリームを container にそのままコピーできるか"""
+    codecs = CONTAINER_CODECS.get(container)
+    if codecs is None:
+        return container in CONTAINER_CODECS
+    return codec_name in codecs.get(codec_type, ())
+
+
+def can_encode(container, codec_name):
+    """codec_name でエンコードした映像を container に格納できるか (拒否すると分かっている場合だけ False)"""
+    codecs = CONTAINER_ENCODE_VIDEO_CODECS.get(container)
+    return codecs is None or codec_name in codecs
+
+
+def plan_stream_codecs(streams, container):
+    """ストリーム情報 (media_info.StreamInfo) から、コピーと再エンコードを組み合わせた引数を作る。
+
+    格納できるストリームは -c copy、できないものは CONTAINER_DEFAULT_ENCODERS で
+    再エンコードし、どちらもできない字幕・データストリームは出力しない。
+    (引数のリスト, コピーしたストリーム数, 再エンコードしたストリーム数) を返す。
+    """
+    encoders = CONTAINER_DEFAULT_ENCODERS.get(container, _H264_AAC)
+    args = []
+    copied = transcoded = 0
+    for stream in streams:
+        codec_type = stream.codec_type
+        codec_name = stream.codec_name
+        if codec_type not in ("video", "audio", "subtitle"):
+            # データ・添付ファイルのストリームは何でも格納できるコンテナ (mkv) でだけ残す
+            if CONTAINER_CODECS.get(container, {}) is not None:
+                continue
+            codec = "copy"
+        elif can_copy(container, codec_type, codec_name):
+            codec = "copy"
+        elif codec_type == "subtitle" and (codec_name not in TEXT_SUBTITLE_CODECS or "subtitle" not in encoders):
+            # 画像字幕はテキスト字幕に変換できない
+            continue
+        else:
+            codec = encoders.get(codec_type)
+            if codec is None:
+                continue
+
+        output_index = copied + transcoded
+        args += ["-map", f"0:{stream.index}", f"-c:{output_index}", codec]
+        if codec == "copy":
+            copied += 1
+        else:
+            transcoded += 1
+    return args, copied, transcoded
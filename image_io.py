@@ -0,0 +1,265 @@
+"""大きな画像やアニメーション画像をメモリを抑えて読み込む・保存するための処理。
+
+Pillow の既定の展開爆弾チェック (MAX_IMAGE_PIXELS) の代わりに、ジョブごとの
+メモリ上限で読み込みの可否を判定する。縮小が必要な場合は、JPEG は draft で
+デコード時に縮小し、無圧縮のストリップ形式 TIFF は数ストリップずつ読み込んで
+縮小するので、元の解像度の画像全体をメモリに展開しない。
+
+複数フレームの画像 (GIF / WebP / APNG / 複数ページの TIFF) は、保存時に
+フレームを1枚ずつ読み込み、各フレームの表示時間とループ回数を引き継ぐ。
+"""
+import math
+import threading
+
+# 複数フレームのまま保存できる形式 (拡張子 -> Pillow の形式名)
+ANIMATED_FORMATS = {"gif": "GIF", "webp": "WEBP", "png": "PNG", "tiff": "TIFF", "tif": "TIFF"}
+# 表示時間が記録されていないフレームの表示時間 (ミリ秒)
+DEFAULT_FRAME_DURATION_MS = 100
+# MAX_IMAGE_PIXELS を一時的に外している間に、他のスレッドが元に戻さないようにする
+_OPEN_LOCK = threading.Lock()
+# 1画素あたりのバイト数 (ここに無いモードはバンド数 x 1バイト)
+_BYTES_PER_PIXEL = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16B": 2, "I;16L": 2, "I": 4, "F": 4}
+# TIFF を分割して読み込むときに一度に展開する行数の目安
+TIFF_BAND_MIN_ROWS = 256
+# 行単位で読み込める TIFF の rawmode と1画素あたりのビット数
+_RAW_BITS_PER_PIXEL = {
+    "1": 1, "1;I": 1, "L": 8, "L;I": 8, "P": 8, "LA": 16, "I;16": 16, "I;16B": 16, "I;16N": 16,
+    "RGB": 24, "RGBA": 32, "RGBa": 32, "RGBX": 32, "CMYK": 32, "YCbCr": 24,
+}
+
+
+def estimate_image_bytes(mode, size):
+    """mode / size の画像を展開したときのおおよそのメモリ使用量"""
+    width, height = size
+    per_pixel = _BYTES_PER_PIXEL.get(mode, len(mode) if mode.isalpha() else 4)
+    if mode in ("RGB", "YCbCr", "LAB", "HSV"):
+        # Pillow は3バンドの画像も4バイト/画素で保持する
+        per_pixel = 4
+    return width * height * per_pixel
+
+
+def scaled_size(size, max_dimension):
+    """長辺が max_dimension 以下になるサイズ。縮小不要なら元のサイズ。"""
+    width, height = size
+    if not max_dimension or max(width, height) <= max_dimension:
+        return size
+    scale = max_dimension / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _raw_row_layout(img):
+    """無圧縮の TIFF を行単位で読めるように、(開始行, 終了行, オフセット, rawmode, 1行のバイト数) の一覧を返す。
+
+    ストリップが全幅でない (タイル形式) 場合や、圧縮されている場合は None。
+    """
+    if img.format != "TIFF":
+        return None
+    width = img.size[0]
+    layout = []
+    for tile in img.tile:
+        name, extents, offset, args = tile[0], tile[1], tile[2], tile[3]
+        if name != "raw" or extents[0] != 0 or extents[2] != width:
+            return None
+        rawmode, stride, ystep = (tuple(args) + (0, 1))[:3] if isinstance(args, tuple) else (args, 0, 1)
+        bits = _RAW_BITS_PER_PIXEL.get(rawmode)
+        if ystep != 1 or bits is None:
+            return None
+        layout.append((extents[1], extents[3], offset, rawmode, stride or (width * bits + 7) // 8))
+    return sorted(layout)
+
+
+def _reduce_raw_rows(path, layout, factor, memory_limit_mb=None):
+    """無圧縮の TIFF を数百行ずつ読み込み、1/factor に縮小した画像を返す。
+
+    縮小後の画像と、一度に展開する行の分のメモリしか使わない。
+    """
+    from PIL import Image
+
+    with _open_image(path, memory_limit_mb) as img:
+        mode, (width, height) = img.mode, img.size
+
+    result = Image.new(mode, (math.ceil(width / factor), math.ceil(height / factor)))
+    # 縮小の境目がずれないように、factor の倍数の行数ずつ読み込む
+    band_rows = max(TIFF_BAND_MIN_ROWS // factor, 1) * factor
+    with open(path, "rb") as f:
+        for band_top in range(0, height, band_rows):
+            band_bottom = min(band_top + band_rows, height)
+            band = Image.new(mode, (width, band_bottom - band_top))
+            for top, bottom, offset, rawmode, stride in layout:
+                first, last = max(top, band_top), min(bottom, band_bottom)
+                if first >= last:
+                    continue
+                f.seek(offset + (first - top) * stride)
+                data = f.read((last - first) * stride)
+                # ストリップの行をそのまま raw デコーダーで展開する
+                rows = Image.frombytes(mode, (width, last - first), data, "raw", rawmode, stride, 1)
+                band.paste(rows, (0, first - band_top))
+            result.paste(band.reduce(factor), (0, band_top // factor))
+    return result
+
+
+def _open_image(path, memory_limit_mb=None):
+    """Image.open で画像を開く。
+
+    メモリの上限を指定した場合は展開爆弾の判定を上限で行うので、この呼び出しでだけ
+    Pillow の画素数の上限 (MAX_IMAGE_PIXELS) を外す。指定が無ければ Pillow の判定に任せる。
+    """
+    from PIL import Image
+
+    if not memory_limit_mb:
+        return Image.open(path)
+    with _OPEN_LOCK:
+        saved = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            return Image.open(path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = saved
+
+
+def load_image(path, max_dimension=None, memory_limit_mb=None):
+    """画像を開き、必要なら長辺 max_dimension 以下に縮小して返す。
+
+    展開後のメモリ使用量が memory_limit_mb を超える場合は RuntimeError を送出する。
+    縮小しない場合は読み込みを遅延したままの画像を返す。
+    """
+    from PIL import Image
+
+    img = _open_image(path, memory_limit_mb)
+    try:
+        limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+        if is_animated(img):
+            # アニメーションはフレームごとに読み込む (縮小は resize_frames で行う)
+            needed = estimate_image_bytes("RGBA", img.size) * 2
+            if limit and needed > limit:
+                raise _too_large(needed, limit)
+            return img
+
+        target = scaled_size(img.size, max_dimension)
+        if target != img.size and img.format == "JPEG":
+            # デコード時に 1/2, 1/4, 1/8 に縮小する (target 以上の大きさは保たれる)
+            img.draft(img.mode if img.mode in ("RGB", "L") else None, target)
+
+        needed = estimate_image_bytes(img.mode, img.size)
+        layout = _raw_row_layout(img) if target != img.size else None
+        if layout:
+            factor = max(1, int(min(img.size[0] / target[0], img.size[1] / target[1])))
+            needed = estimate_image_bytes(img.mode, (img.size[0] // factor, img.size[1] // factor)) * 2
+            if limit and needed > limit:
+                raise _too_large(needed, limit)
+            img.close()
+            try:
+                img = _reduce_raw_rows(path, layout, factor, memory_limit_mb)
+            except (ValueError, OSError):
+                # ファイルが途中で切れている場合などは通常の読み込みに戻す
+                img = _open_image(path, memory_limit_mb)
+                needed = estimate_image_bytes(img.mode, img.size)
+
+        if limit and needed > limit:
+            raise _too_large(needed, limit)
+        if target != img.size:
+            img.thumbnail(target, Image.Resampling.BILINEAR, reducing_gap=2.0)
+        return img
+    except Exception:
+        img.close()
+        raise
+
+
+def _too_large(needed, limit):
+    return RuntimeError(
+        f"画像が大きすぎるため処理できません (必要なメモリ: 約{needed / (1024 * 1024):.0f}MB, "
+        f"上限: {limit / (1024 * 1024):.0f}MB)。\n最大サイズ (長辺) を指定して縮小するか、上限を引き上げてください。"
+    )
+
+
+def prepare_for_format(img, output_ext):
+    """保存形式が対応していないモードの場合だけ変換する"""
+    if output_ext in ("jpg", "jpeg") and img.mode not in ("RGB", "L", "CMYK"):
+        return img.convert("RGB")
+    return img
+
+
+def is_animated(img):
+    """複数フレーム (アニメーション・複数ページ) の画像か"""
+    return getattr(img, "n_frames", 1) > 1
+
+
+def first_frame(img, max_dimension=None):
+    """最初のフレームだけの画像を返す (必要なら長辺 max_dimension 以下に縮小する)"""
+    from PIL import Image
+
+    img.seek(0)
+    frame = img.copy()
+    size = scaled_size(frame.size, max_dimension)
+    if size != frame.size:
+        frame = frame.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return frame
+
+
+def resize_frames(img, max_dimension=None, memory_limit_mb=None):
+    """アニメーションを長辺 max_dimension 以下に縮小したフレームのリストを返す。
+
+    縮小が不要なら img をそのまま返す (保存時に1フレームずつ読み込まれる)。
+    縮小したフレームはすべてメモリに置くので、その合計を memory_limit_mb と比べる。
+    """
+    from PIL import Image, ImageSequence
+
+    size = scaled_size(img.size, max_dimension)
+    if size == img.size:
+        return img
+    needed = estimate_image_bytes("RGBA", size) * img.n_frames
+    limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+    if limit and needed > limit:
+        raise _too_large(needed, limit)
+    frames = []
+    for frame in ImageSequence.Iterator(img):
+        mode = "RGBA" if frame.mode in ("P", "PA", "LA", "RGBA") else "RGB"
+        # convert / resize はフレームの info (表示時間など) を引き継ぐ
+        frames.append(frame.convert(mode).resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0))
+    img.seek(0)
+    return frames
+
+
+def frame_durations(animation):
+    """各フレームの表示時間 (ミリ秒) のリスト"""
+    from PIL import ImageSequence
+
+    if isinstance(animation, list):
+        return [f.info.get("duration") or DEFAULT_FRAME_DURATION_MS for f in animation]
+    durations = []
+    for frame in ImageSequence.Iterator(animation):
+        # WebP はフレームを読み込むまで表示時間が分からない
+        frame.load()
+        durations.append(frame.info.get("duration") or DEFAULT_FRAME_DURATION_MS)
+    animation.seek(0)
+    return durations
+
+
+def has_frame_durations(animation):
+    """フレームの表示時間が記録されているか (複数ページの TIFF などには無い)"""
+    first = animation[0] if isinstance(animation, list) else animation
+    return "duration" in first.info
+
+
+def save_animation(animation, output, output_ext, loop=None, **options):
+    """resize_frames の結果 (複数フレームの画像かフレームのリスト) を output に保存する。
+
+    output はパスかファイルオブジェクト。loop は元画像の info["loop"] (None は1回だけ再生)。
+    """
+    fmt = ANIMATED_FORMATS[output_ext]
+    params = {"format": fmt, "save_all": True, **options}
+    if fmt == "GIF":
+        if loop is not None:
+            params["loop"] = loop
+    elif fmt in ("WEBP", "PNG"):
+        # WebP / APNG の loop は再生回数 (0 は無限)。GIF の loop が無いのは1回だけの再生
+        params["loop"] = loop if loop is not None else 1
+    if fmt == "WEBP" or (fmt in ("GIF", "PNG") and not has_frame_durations(animation)):
+        # WebP の保存処理はフレームごとの表示時間を読まないので、リストで渡す。
+        # 表示時間の無い画像 (複数ページの TIFF など) は 0ms のアニメーションにならないようにする
+        params["duration"] = frame_durations(animation)
+
+    if isinstance(animation, list):
+        animation[0].save(output, append_images=animation[1:], **params)
+    else:
+        animation.save(output, **params)
@@ -1,13 +1,27 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import os
+import time
 from time import sleep
 import sys
-import subprocess
-from PIL import Image
 import install_ffmpeg
 import threading
+import multiprocessing
 from queue import Queue, Empty
+from engine import IMAGE_FORMATS, VIDEO_FORMATS, ConversionEngine, ConversionJob
+from formats import ANIMATION_SOURCE_FORMATS, VIDEO_TO_ANIMATION_FORMATS
+from capabilities import Capabilities, load_capabilities
+from batch import BatchRunner, collect_jobs, default_journal
+from metrics import summary_text
+from quality import validate_quality_target
+
+
+# ワーカースレッドから UI を起こす仮想イベント
+WORKER_EVENT = "<<WorkerEvent>>"
+# 進捗表示を更新する間隔の下限 (秒)。これより速く届いた進捗は最新のものだけを表示する
+UI_UPDATE_INTERVAL = 1 / 30
+# 最新の値だけを表示すればよいメッセージ
+COALESCED_MESSAGES = ("status", "progress", "batch_progress")
 
 
 class ConverterApp(tk.Tk):
@@ -19,46 +33,87 @@ class ConverterApp(tk.Tk):
         # --- 変数定義 ---
         self.input_file_path = tk.StringVar()
         self.status_text = tk.StringVar(value="処理するファイルを選択してください。")
+        self.progress_value = tk.DoubleVar(value=0)
         self.mode = tk.StringVar(value="convert")
         self.selected_format = tk.StringVar()
-        self.target_size_mb = tk.StringVar(value="10")
+        self.extra_formats = tk.StringVar()
+        self.target_value = tk.StringVar(value="10")
+        self.compress_target = tk.StringVar()
         self.selected_encoder = tk.StringVar()
-        self.available_encoders = []
-        self.ffmpeg_available = False
+        self.rate_control = tk.StringVar()
+        self.auto_resize = tk.BooleanVar(value=True)
+        # FFmpeg の検出が終わるまでは CPU エンコーダーだけを表示する
+        self.available_encoders = Capabilities().encoder_choices()
+        # None は検出中 (動画の処理を始めた時点でエンジンが確認する)
+        self.ffmpeg_available = None
+        self.capability_queue = Queue()
         self.task_queue = Queue()
+        # ワーカースレッドが WORKER_EVENT を送った後、UI がまだキューを読んでいなければ True
+        self._wakeup_pending = False
+        self._wakeup_lock = threading.Lock()
+        # 表示待ちの進捗などのメッセージ (種類ごとに最新のものだけ) と、最後に表示した時刻
+        self._pending_updates = {}
+        self._last_ui_update = 0.0
+        self._flush_job = None
+        # 最後に終わったジョブの計測値 (完了メッセージに概要を表示する)
+        self.last_metrics = None
         self.worker_thread = None
-        self.current_process = None
-        self.cancel_requested = False
+        self.engine = None
 
         # --- フォーマット定義 ---
-        self.image_formats = [
-            "png", "jpg", "jpeg", "webp", "gif", "bmp", "tiff",
-            "ico", "tga", "pcx", "ppm", "pgm", "pbm"
-        ]
-        self.video_formats = [
-            "mp4", "mkv", "mov", "avi", "wmv", "webm", "flv", "mpg",
-            "mpeg", "vob", "ogv", "mts", "ts", "m2ts", "3gp", "f4v"
-        ]
-
-        # --- FFmpeg and UI setup ---
-        self.check_ffmpeg()  # Detect ffmpeg and encoders first
-        self.setup_ui()      # Then build the UI
+        self.image_formats = IMAGE_FORMATS
+        self.video_formats = VIDEO_FORMATS
+
+        self.rate_control_options = [("自動", "auto"), ("2パス", "two_pass"), ("1パス", "single_pass")]
+        # 圧縮の目標: 目標サイズ、または画質の下限 (それを満たす最も小さい出力にする) と既定値
+        self.compress_target_options = [("サイズ (MB)", "size"), ("画質 SSIM", "ssim"), ("画質 PSNR (dB)", "psnr")]
+        self.compress_target_defaults = {"size": "10", "ssim": "0.97", "psnr": "40"}
+
+        # --- UI and FFmpeg setup ---
+        self.setup_ui()      # Build the UI first so the window appears immediately
+        self.bind(WORKER_EVENT, lambda event: self.process_queue())
+        # mainloop の開始前に届いて UI を起こせなかったメッセージを処理する
+        self.after_idle(self.process_queue)
+        self.check_ffmpeg()  # Then detect ffmpeg and encoders in the background
 
     def check_ffmpeg(self):
-        """FFmpegが利用可能か確認し、利用不可の場合は警告を表示する"""
+        """FFmpegとエンコーダーをバックグラウンドで検出する"""
+        def detect():
+            self.capability_queue.put(load_capabilities())
+            self._wake_ui()
+
+        threading.Thread(target=detect, daemon=True).start()
+
+    def post_event(self, msg_type, payload):
+        """UI にメッセージを送る (ワーカースレッドから呼んでよい)"""
+        self.task_queue.put((msg_type, payload))
+        self._wake_ui()
+
+    def _wake_ui(self):
+        """UI スレッドで process_queue を実行させる。
+
+        UI がキューを読むまでの間に届いたメッセージでは、イベントを重ねて送らない。
+        """
+        with self._wakeup_lock:
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
         try:
-            subprocess.run(
-                ["ffmpeg", "-version"],
-                check=True,
-                capture_output=True,
-                text=True,
-                creationflags=subprocess.CREATE_NO_WINDOW
-            )
-            self.ffmpeg_available = True
-            self.detect_encoders()
-        except (FileNotFoundError, subprocess.CalledProcessError):
-            self.ffmpeg_available = False
-            self.detect_encoders() # Still try to set default
+            self.event_generate(WORKER_EVENT, when="tail")
+        except (tk.TclError, RuntimeError):
+            # mainloop の開始前やウィンドウが閉じられた後
+            with self._wakeup_lock:
+                self._wakeup_pending = False
+
+    def _apply_capabilities(self, capabilities):
+        """検出結果を反映し、FFmpegが利用不可の場合は警告を表示する"""
+        self.ffmpeg_available = capabilities.ffmpeg_available
+        self.available_encoders = capabilities.encoder_choices()
+        self.encoder_menu["values"] = [name for name, codec in self.available_encoders]
+        if self.selected_encoder.get() not in self.encoder_menu["values"]:
+            self.selected_encoder.set(self.encoder_menu["values"][0])
+
+        if not self.ffmpeg_available:
             if messagebox.askokcancel("FFmpegインストール", "FFmpegが見つかりません。FFmpegをインストールしますか？"):
                 install_ffmpeg.download_and_extract()
                 print("アプリケーションを再起動してください。")
@@ -70,32 +125,6 @@ class ConverterApp(tk.Tk):
                     "FFmpegが見つかりません。PCにインストールし、環境変数PATHに登録してください。\n動画の変換・圧縮機能は利用できません。"
                 )
 
-    def detect_encoders(self):
-        """Detect available H.264 hardware encoders in FFmpeg."""
-        self.available_encoders = [("CPU (libx264)", "libx264")]  # Default
-        if not self.ffmpeg_available:
-            return
-
-        try:
-            result = subprocess.run(
-                ["ffmpeg", "-encoders"],
-                capture_output=True, text=True, check=True,
-                creationflags=subprocess.CREATE_NO_WINDOW
-            )
-            output = result.stdout
-            
-            # Check for known H.264 encoders
-            if "h264_nvenc" in output:
-                self.available_encoders.append(("Nvidia GPU (nvenc)", "h264_nvenc"))
-            if "h264_qsv" in output:
-                self.available_encoders.append(("Intel GPU (qsv)", "h264_qsv"))
-            if "h264_amf" in output:
-                self.available_encoders.append(("AMD GPU (amf)", "h264_amf"))
-
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            # Silently fail and just use the default CPU encoder.
-            pass
-
     def setup_ui(self):
         # --- ファイル選択フレーム ---
         file_frame = ttk.LabelFrame(self, text="1. ファイル選択", padding=(10, 5))
@@ -107,6 +136,9 @@ class ConverterApp(tk.Tk):
         browse_button = ttk.Button(
             file_frame, text="選択...", command=self.select_file)
         browse_button.pack(side=tk.LEFT, padx=5, pady=5)
+        folder_button = ttk.Button(
+            file_frame, text="フォルダ...", command=self.select_folder)
+        folder_button.pack(side=tk.LEFT, padx=5, pady=5)
 
         # --- モード選択フレーム ---
         mode_frame = ttk.LabelFrame(self, text="2. モード選択", padding=(10, 5))
@@ -131,15 +163,25 @@ class ConverterApp(tk.Tk):
         self.format_menu = ttk.Combobox(
             self.convert_frame, textvariable=self.selected_format, state="disabled", width=10)
         self.format_menu.pack(side=tk.LEFT, padx=5)
+        extra_label = ttk.Label(self.convert_frame, text="同時に出力する形式 (カンマ区切り):")
+        extra_label.pack(side=tk.LEFT, padx=(10, 5))
+        self.extra_formats_entry = ttk.Entry(self.convert_frame, textvariable=self.extra_formats, width=16)
+        self.extra_formats_entry.pack(side=tk.LEFT, padx=5)
 
         # 圧縮オプション
         self.compress_frame = ttk.LabelFrame(
             self.options_container, text="3. 圧縮オプション", padding=(10, 5))
         
-        size_label = ttk.Label(self.compress_frame, text="目標ファイルサイズ(MB):")
+        size_label = ttk.Label(self.compress_frame, text="目標:")
         size_label.pack(side=tk.LEFT, padx=5, pady=5)
+        self.compress_target_menu = ttk.Combobox(
+            self.compress_frame, textvariable=self.compress_target, state="readonly", width=12,
+            values=[name for name, value in self.compress_target_options])
+        self.compress_target_menu.pack(side=tk.LEFT, padx=5, pady=5)
+        self.compress_target.set(self.compress_target_options[0][0])
+        self.compress_target_menu.bind("<<ComboboxSelected>>", self.on_compress_target_selected)
         self.size_entry = ttk.Entry(
-            self.compress_frame, textvariable=self.target_size_mb, width=10)
+            self.compress_frame, textvariable=self.target_value, width=10)
         self.size_entry.pack(side=tk.LEFT, padx=5, pady=5)
 
         encoder_label = ttk.Label(self.compress_frame, text="エンコーダー:")
@@ -152,6 +194,18 @@ class ConverterApp(tk.Tk):
         if self.encoder_menu["values"]:
             self.selected_encoder.set(self.encoder_menu["values"][0])
 
+        rate_control_label = ttk.Label(self.compress_frame, text="動画の圧縮方式:")
+        rate_control_label.pack(side=tk.LEFT, padx=(10, 5), pady=5)
+        self.rate_control_menu = ttk.Combobox(
+            self.compress_frame, textvariable=self.rate_control, state="readonly", width=8,
+            values=[name for name, value in self.rate_control_options])
+        self.rate_control_menu.pack(side=tk.LEFT, padx=5, pady=5)
+        self.rate_control.set(self.rate_control_options[0][0])
+
+        auto_resize_check = ttk.Checkbutton(
+            self.compress_frame, text="解像度を自動調整", variable=self.auto_resize)
+        auto_resize_check.pack(side=tk.LEFT, padx=(10, 5), pady=5)
+
         # --- 実行フレーム ---
         execute_frame = tk.Frame(self)
         execute_frame.pack(fill=tk.X, padx=10, pady=10)
@@ -167,9 +221,17 @@ class ConverterApp(tk.Tk):
         status_label = ttk.Label(
             self, textvariable=self.status_text, foreground="gray", anchor="w")
         status_label.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=5)
+        self.progress_bar = ttk.Progressbar(
+            self, variable=self.progress_value, maximum=100)
+        self.progress_bar.pack(side=tk.BOTTOM, fill=tk.X, padx=10)
 
         self.toggle_mode()  # 初期表示を設定
 
+    def on_compress_target_selected(self, event=None):
+        """目標の種類を切り替えたら、入力欄をその種類の既定値にする"""
+        target = dict(self.compress_target_options).get(self.compress_target.get(), "size")
+        self.target_value.set(self.compress_target_defaults[target])
+
     def toggle_mode(self):
         mode = self.mode.get()
         if mode == "convert":
@@ -199,13 +261,30 @@ class ConverterApp(tk.Tk):
         self.update_format_options()
         self.toggle_mode()
 
+    def select_folder(self):
+        folderpath = filedialog.askdirectory()
+        if not folderpath:
+            return
+
+        self.input_file_path.set(folderpath)
+        self.status_text.set(f"選択中のフォルダ: {os.path.basename(folderpath)}")
+
+        self.update_format_options()
+        self.toggle_mode()
+
     def update_format_options(self):
         ext = self.input_file_path.get().split('.')[-1].lower()
         target_formats = []
-        if ext in self.image_formats:
+        if os.path.isdir(self.input_file_path.get()):
+            # フォルダ選択時は、選んだ形式と同じ種類のファイルだけが変換される
+            target_formats = self.image_formats + self.video_formats
+        elif ext in self.image_formats:
             target_formats = [f for f in self.image_formats if f != ext]
+            if ext in ANIMATION_SOURCE_FORMATS:
+                # アニメーション画像は動画にも変換できる
+                target_formats += self.video_formats
         elif ext in self.video_formats:
-            target_formats = [f for f in self.video_formats if f != ext]
+            target_formats = [f for f in self.video_formats if f != ext] + VIDEO_TO_ANIMATION_FORMATS
 
         self.format_menu["values"] = target_formats
         if target_formats:
@@ -221,305 +300,250 @@ class ConverterApp(tk.Tk):
             messagebox.showerror("エラー", "ファイルが選択されていません。")
             return
 
+        input_path = self.input_file_path.get()
+        try:
+            options = self._read_job_options()
+            if os.path.isdir(input_path):
+                jobs = collect_jobs(input_path, **options)
+                if not jobs:
+                    raise ValueError("フォルダ内に処理対象のファイルがありません。")
+            else:
+                job = ConversionJob(input_path=input_path, **options)
+        except ValueError as e:
+            messagebox.showerror("エラー", str(e))
+            return
+
         self.execute_button["state"] = "disabled"
         self.cancel_button["state"] = "normal"
         self.status_text.set("処理を開始します...")
-        self.cancel_requested = False
-        
+
         while not self.task_queue.empty():
             try:
                 self.task_queue.get_nowait()
             except Empty:
                 break
 
-        self.worker_thread = threading.Thread(target=self._execute_task_threaded)
+        self.last_metrics = None
+        self._pending_updates.clear()
+        on_event = self.post_event
+        if os.path.isdir(input_path):
+            # 中止したフォルダを同じ設定でもう一度処理すると、終わったファイルは飛ばす
+            self.engine = BatchRunner(jobs, on_event=on_event, ffmpeg_available=self.ffmpeg_available,
+                                      journal=default_journal(input_path, **options))
+            self.worker_thread = threading.Thread(target=self._execute_batch_threaded, args=(self.engine,))
+        else:
+            self.engine = ConversionEngine(on_event=on_event, ffmpeg_available=self.ffmpeg_available)
+            self.worker_thread = threading.Thread(target=self._execute_task_threaded, args=(self.engine, job))
         self.worker_thread.daemon = True
         self.worker_thread.start()
-        self.process_queue()
+
+    def _read_job_options(self):
+        """UIの入力値からジョブの設定を読み取る (メインスレッドで呼ぶ)"""
+        if self.mode.get() == "convert":
+            if not self.selected_format.get():
+                raise ValueError("変換後のフォーマットが選択されていません。")
+            target_format = self.selected_format.get()
+            extras = [f.strip().lower().lstrip(".") for f in self.extra_formats.get().split(",") if f.strip()]
+            for fmt in extras:
+                if fmt not in self.format_menu["values"]:
+                    raise ValueError(f"同時に出力する形式に対応していない形式があります: {fmt}")
+            targets = [target_format] + [f for f in extras if f != target_format]
+            if len(targets) > 1:
+                return {"mode": "convert", "target_format": target_format, "targets": targets}
+            return {"mode": "convert", "target_format": target_format}
+
+        target = dict(self.compress_target_options).get(self.compress_target.get(), "size")
+        try:
+            target_value = float(self.target_value.get())
+        except ValueError:
+            raise ValueError("目標ファイルサイズには数値を入力してください。" if target == "size" else "目標画質には数値を入力してください。")
+        if target == "size":
+            if target_value <= 0:
+                raise ValueError("目標ファイルサイズは0より大きい値を入力してください。")
+            target_options = {"target_size_mb": target_value}
+        else:
+            validate_quality_target(target, target_value)
+            target_options = {"target_quality": target_value, "quality_metric": target}
+
+        selected_encoder_name = self.selected_encoder.get()
+        encoder_codec = "libx264"
+        for name, codec in self.available_encoders:
+            if name == selected_encoder_name:
+                encoder_codec = codec
+                break
+
+        rate_control = dict(self.rate_control_options).get(self.rate_control.get(), "auto")
+
+        return {"mode": "compress", **target_options, "encoder": encoder_codec, "rate_control": rate_control,
+                "auto_resize": self.auto_resize.get()}
 
     def cancel_task(self):
         if messagebox.askokcancel("確認", "処理を中止しますか？"):
-            self.cancel_requested = True
-            if self.current_process:
-                try:
-                    self.current_process.kill()
-                except Exception:
-                    pass
-            self.task_queue.put(("cancelled", None))
-
-    def _execute_task_threaded(self):
+            if self.engine:
+                self.engine.cancel()
+            self.post_event("cancelled", None)
+
+    def _execute_task_threaded(self, engine, job):
         """This runs in a separate thread."""
         try:
-            if self.mode.get() == "convert":
-                self.convert_file()
-            else:
-                self.compress_file()
+            output_path = engine.run(job)
         except Exception as e:
-            if not self.cancel_requested:
-                self.task_queue.put(("error", e))
+            if not engine.cancel_requested:
+                self.post_event("error", e)
+            return
+
+        if output_path is None or engine.cancel_requested:
+            return
+        if isinstance(output_path, list):
+            output_path = "\n".join(output_path)
+        if job.mode == "convert":
+            success_msg = f"ファイルの変換が完了しました。\n保存先: {output_path}"
+        else:
+            success_msg = f"ファイルの圧縮が完了しました。\n保存先: {output_path}"
+        self.post_event("success", (job.mode, success_msg))
+
+    def _execute_batch_threaded(self, runner):
+        """This runs in a separate thread."""
+        try:
+            results = runner.run()
+        except Exception as e:
+            if not runner.cancel_requested:
+                self.post_event("error", e)
+            return
+
+        if not runner.cancel_requested:
+            if all(r.ok for r in results):
+                runner.journal.remove()
+            self.post_event("batch_done", results)
+
+    def _show_batch_summary(self, results):
+        failures = [r for r in results if not r.ok]
+        warned = [r for r in results if r.ok and r.warnings]
+        lines = [f"一括処理が完了しました。\n成功: {len(results) - len(failures)} / 全体: {len(results)}"]
+        if warned:
+            lines.append(f"警告あり: {len(warned)}件")
+        resumed = [r for r in results if r.resumed]
+        if resumed:
+            lines.append(f"前回完了済みのため飛ばしたファイル: {len(resumed)}件")
+        timed = [r for r in results if r.metrics and r.metrics["wall_time"] is not None]
+        if timed:
+            slowest = max(timed, key=lambda r: r.metrics["wall_time"])
+            lines.append(f"合計処理時間: {sum(r.metrics['wall_time'] for r in timed):.1f}秒 "
+                         f"(最長: {os.path.basename(slowest.job.input_path)} {slowest.metrics['wall_time']:.1f}秒)")
+        if failures:
+            lines.append("\n失敗したファイル:")
+            for r in failures[:10]:
+                lines.append(f"- {os.path.basename(r.job.input_path)}: {r.error.splitlines()[0] if r.error else ''}")
+            if len(failures) > 10:
+                lines.append(f"...ほか{len(failures) - 10}件")
+            messagebox.showwarning("処理終了", "\n".join(lines))
+        else:
+            messagebox.showinfo("処理終了", "\n".join(lines))
+
+    def _show_progress(self, progress):
+        """FFmpegの進捗情報をプログレスバーとステータスに表示する"""
+        stage_index, stage_count = progress["stage"]
+        parts = [f"処理中... ({stage_index}/{stage_count} パス)" if stage_count > 1 else "処理中..."]
+        if progress["percent"] is not None:
+            self.progress_value.set(progress["percent"])
+            parts.append(f"{progress['percent']:.1f}%")
+        if progress["fps"]:
+            parts.append(f"{progress['fps']:.0f}fps")
+        if progress["speed"]:
+            parts.append(f"x{progress['speed']:.2f}")
+        if progress["eta"] is not None:
+            minutes, seconds = divmod(int(progress["eta"]), 60)
+            parts.append(f"残り {minutes}:{seconds:02d}")
+        self.status_text.set(" ".join(parts))
 
     def _reset_ui_after_task(self, status_message="処理するファイルを選択してください。", success=False):
         self.status_text.set(status_message)
         self.execute_button["state"] = "normal"
         self.cancel_button["state"] = "disabled"
-        self.current_process = None
+        self.engine = None
         self.worker_thread = None
-        self.cancel_requested = False
+        self.progress_value.set(0)
         if success:
             self.input_file_path.set("")
 
     def process_queue(self):
-        """Process messages from the worker thread."""
+        """ワーカースレッドからのメッセージをすべて処理する (WORKER_EVENT で呼ばれる)。
+
+        進捗・ステータスは種類ごとに最新のものだけを残し、UI_UPDATE_INTERVAL に1回まで表示する。
+        """
+        with self._wakeup_lock:
+            self._wakeup_pending = False
         try:
-            message = self.task_queue.get_nowait()
-            msg_type, msg_payload = message
+            self._apply_capabilities(self.capability_queue.get_nowait())
+        except Empty:
+            pass
 
-            if msg_type == "status":
-                self.status_text.set(msg_payload)
+        while True:
+            try:
+                msg_type, msg_payload = self.task_queue.get_nowait()
+            except Empty:
+                break
+            if self.execute_button["state"] != "disabled":
+                # 終了・中止の後に届いた古いメッセージ
+                continue
+
+            if msg_type in COALESCED_MESSAGES:
+                # 届いた順に表示するため、入れ直して最後に置く
+                self._pending_updates.pop(msg_type, None)
+                self._pending_updates[msg_type] = msg_payload
             elif msg_type == "error":
+                self._pending_updates.clear()
                 messagebox.showerror("処理エラー", f"処理中にエラーが発生しました:\n{msg_payload}")
                 self._reset_ui_after_task(f"エラー: {msg_payload}", success=False)
-                return
             elif msg_type == "success":
+                self._pending_updates.clear()
                 mode, msg = msg_payload
+                if self.last_metrics:
+                    msg += "\n\n" + summary_text(self.last_metrics)
                 messagebox.showinfo("処理終了", msg)
                 self._reset_ui_after_task(f"{mode.capitalize()}完了", success=True)
-                return
             elif msg_type == "cancelled":
+                self._pending_updates.clear()
                 messagebox.showwarning("中止", "処理がユーザーによって中断されました。")
                 self._reset_ui_after_task("処理が中断されました。", success=False)
-                return
+            elif msg_type == "batch_done":
+                self._pending_updates.clear()
+                self._show_batch_summary(msg_payload)
+                self._reset_ui_after_task("一括処理完了", success=True)
+            elif msg_type == "metrics":
+                self.last_metrics = msg_payload
             elif msg_type == "warning":
-                 messagebox.showwarning("警告", msg_payload)
-            
-        except Empty:
-            pass
-        
-        if self.execute_button["state"] == "disabled":
-            self.after(100, self.process_queue)
-
-    def convert_file(self):
-        input_path = self.input_file_path.get()
-        target_ext = self.selected_format.get()
-        if not target_ext:
-            raise ValueError("変換後のフォーマットが選択されていません。")
-
-        directory, filename = os.path.split(input_path)
-        name_without_ext = os.path.splitext(filename)[0]
-        output_path = os.path.join(
-            directory, f"{name_without_ext}.{target_ext}")
-
-        self.task_queue.put(("status", f"変換中... -> {os.path.basename(output_path)}"))
-
-        self._run_process(input_path, output_path)
-        
-        if self.cancel_requested:
-            return
-
-        success_msg = f"ファイルの変換が完了しました。\n保存先: {output_path}"
-        self.task_queue.put(("success", ("convert", success_msg)))
-
-    def compress_file(self):
-        try:
-            target_size = float(self.target_size_mb.get())
-            if target_size <= 0:
-                raise ValueError("目標ファイルサイズは0より大きい値を入力してください。")
-        except ValueError:
-            raise ValueError("目標ファイルサイズには数値を入力してください。")
-
-        selected_encoder_name = self.selected_encoder.get()
-        encoder_codec = "libx264"
-        for name, codec in self.available_encoders:
-            if name == selected_encoder_name:
-                encoder_codec = codec
-                break
-        
-        input_path = self.input_file_path.get()
-        directory, filename = os.path.split(input_path)
-        name, ext = os.path.splitext(filename)
-        output_path = os.path.join(directory, f"{name}_compressed{ext}")
-
-        self.task_queue.put(("status", f"圧縮中... -> {os.path.basename(output_path)}"))
-
-        self._run_process(input_path, output_path, target_size_mb=target_size, encoder=encoder_codec)
-
-        if self.cancel_requested:
-            return
-
-        if os.path.exists(output_path):
-            final_size_mb = os.path.getsize(output_path) / (1024 * 1024)
-            self.task_queue.put(("status", f"圧縮完了: {os.path.basename(output_path)} ({final_size_mb:.2f}MB)"))
-            success_msg = f"ファイルの圧縮が完了しました。\n保存先: {output_path}"
-            self.task_queue.put(("success", ("compress", success_msg)))
-        else:
-            if not self.cancel_requested:
-                raise RuntimeError("圧縮ファイルの生成に失敗しました。詳細は警告メッセージを確認してください。")
-
-    def _run_process(self, input_path, output_path, quality=None, target_size_mb=None, encoder=None):
-        input_ext = input_path.split('.')[-1].lower()
-        if input_ext in self.image_formats:
-            self._process_image(input_path, output_path, quality, target_size_mb=target_size_mb)
-        elif input_ext in self.video_formats:
-            if not self.ffmpeg_available:
-                raise RuntimeError("FFmpegが利用できないため、動画処理を実行できません。")
-            self._process_video(input_path, output_path, quality, target_size_mb=target_size_mb, encoder=encoder)
-        else:
-            raise ValueError("対応していないファイル形式です。")
-
-    def _process_image(self, input_path, output_path, quality, target_size_mb=None):
-        # Image processing is fast, so we don't add cancellation logic here.
-        with Image.open(input_path) as img:
-            if target_size_mb is not None:
-                target_bytes = target_size_mb * 1024 * 1024
-                output_ext = output_path.split('.')[-1].lower()
-
-                if output_ext not in ('jpg', 'jpeg', 'webp'):
-                    self.task_queue.put(("warning", f"目標サイズ指定圧縮はJPG/JPEG/WEBP形式でのみ有効です。他の形式ではファイルサイズが変わりません。\nファイルをそのままコピーします。"))
-                    img.save(output_path)
-                    return
-
-                if output_ext in ('jpg', 'jpeg') and img.mode == 'RGBA':
-                    img = img.convert('RGB')
-
-                for q in range(95, 5, -5):
-                    if self.cancel_requested: return
-                    try:
-                        from io import BytesIO
-                        buffer = BytesIO()
-                        img_format = 'JPEG' if output_ext in ('jpg', 'jpeg') else output_ext.upper()
-                        img.save(buffer, format=img_format, quality=q)
-                        if buffer.tell() <= target_bytes:
-                            with open(output_path, 'wb') as f:
-                                f.write(buffer.getvalue())
-                            return
-                    except Exception as e:
-                        self.task_queue.put(("warning", f".{output_ext} 形式は品質指定による圧縮に失敗しました。\n{e}"))
-                        img.save(output_path)
-                        return
-                
-                img.save(output_path, quality=5)
-                final_size_mb = os.path.getsize(output_path) / (1024 * 1024)
-                self.task_queue.put(("warning", f"目標サイズ({target_size_mb:.2f}MB)に到達できませんでした。可能な限り低い品質で圧縮しました (結果: {final_size_mb:.2f}MB)。"))
-                return
-
-            options = {}
-            output_ext = output_path.split('.')[-1].lower()
-            if quality:
-                quality_map = {"High": 90, "Medium": 75, "Low": 50}
-                options['quality'] = quality_map.get(quality, 75)
-
-            if output_ext in ('jpg', 'jpeg') and img.mode == 'RGBA':
-                img = img.convert('RGB')
+                self._flush_updates()
+                messagebox.showwarning("警告", msg_payload)
 
-            img.save(output_path, **options)
-
-    def _get_video_duration(self, input_path):
-        """Get video duration in seconds using ffprobe."""
-        command = [
-            "ffprobe", "-v", "error", "-show_entries",
-            "format=duration", "-of", "default=noprint_wrappers=1:nokey=1",
-            input_path
-        ]
-        try:
-            result = subprocess.run(
-                command, check=True, capture_output=True, text=True,
-                creationflags=subprocess.CREATE_NO_WINDOW
-            )
-            return float(result.stdout.strip())
-        except (FileNotFoundError, subprocess.CalledProcessError, ValueError) as e:
-            raise RuntimeError(f"動画の長さの取得に失敗しました: {e}\nffprobeがPATHに設定されているか確認してください。")
-
-    def _process_video(self, input_path, output_path, quality, target_size_mb=None, encoder=None):
-        if self.cancel_requested: return
-        if target_size_mb is not None:
-            encoder = encoder or "libx264"
-            try:
-                duration = self._get_video_duration(input_path)
-                if duration <= 0:
-                    raise RuntimeError("動画の長さが0秒か、取得できませんでした。")
-            except Exception as e:
-                 raise RuntimeError(f"動画情報の取得に失敗しました:\n{e}")
-
-            audio_bitrate_kbps = 128
-            target_total_bitrate_kbps = (target_size_mb * 1024 * 8) / duration
-            target_video_bitrate_kbps = target_total_bitrate_kbps - audio_bitrate_kbps
-
-            if target_video_bitrate_kbps <= 100:
-                self.task_queue.put(("warning", "目標ファイルサイズが小さすぎるため、品質が著しく低下する可能性があります。"))
-                target_video_bitrate_kbps = 100
-
-            target_video_bitrate_str = f"{int(target_video_bitrate_kbps)}k"
-            audio_bitrate_str = f"{audio_bitrate_kbps}k"
-            
-            import tempfile
-            with tempfile.TemporaryDirectory() as tempdir:
-                log_prefix = os.path.join(tempdir, "ffmpeg2pass")
-
-                self.task_queue.put(("status", f"圧縮中... (1/2 パス, {encoder})"))
-                
-                pass1_cmd = [
-                    "ffmpeg", "-y", "-i", input_path,
-                    "-c:v", encoder, "-b:v", target_video_bitrate_str,
-                    "-pass", "1", "-passlogfile", log_prefix,
-                    "-an", "-f", "mp4", "NUL"
-                ]
-                
-                try:
-                    self.current_process = subprocess.Popen(pass1_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', creationflags=subprocess.CREATE_NO_WINDOW)
-                    _, stderr = self.current_process.communicate()
-                    if self.current_process.returncode != 0:
-                        if not self.cancel_requested:
-                            raise RuntimeError(f"FFmpegエラー (パス1, {encoder}):\n{stderr}")
-                finally:
-                    self.current_process = None
-
-                if self.cancel_requested: return
-
-                self.task_queue.put(("status", f"圧縮中... (2/2 パス, {encoder})"))
-
-                pass2_cmd = [
-                    "ffmpeg", "-i", input_path,
-                    "-c:v", encoder, "-b:v", target_video_bitrate_str,
-                    "-pass", "2", "-passlogfile", log_prefix,
-                    "-c:a", "aac", "-b:a", audio_bitrate_str,
-                    "-y", output_path
-                ]
-                
-                try:
-                    self.current_process = subprocess.Popen(pass2_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', creationflags=subprocess.CREATE_NO_WINDOW)
-                    _, stderr = self.current_process.communicate()
-                    if self.current_process.returncode != 0:
-                        if not self.cancel_requested:
-                            raise RuntimeError(f"FFmpegエラー (パス2, {encoder}):\n{stderr}")
-                finally:
-                    self.current_process = None
-            
-            if self.cancel_requested: return
-
-            if os.path.exists(output_path):
-                final_size_mb = os.path.getsize(output_path) / (1024 * 1024)
-                if final_size_mb > target_size_mb * 1.1:
-                     self.task_queue.put(("warning", f"目標サイズ({target_size_mb:.2f}MB)を少し超えました (結果: {final_size_mb:.2f}MB)。"))
+        if self._pending_updates and self._flush_job is None:
+            wait = self._last_ui_update + UI_UPDATE_INTERVAL - time.monotonic()
+            if wait > 0:
+                self._flush_job = self.after(int(wait * 1000) + 1, self._flush_updates)
+            else:
+                self._flush_updates()
+
+    def _flush_updates(self):
+        """表示待ちの進捗・ステータスを表示する"""
+        if self._flush_job is not None:
+            self.after_cancel(self._flush_job)
+            self._flush_job = None
+        updates, self._pending_updates = self._pending_updates, {}
+        if self.execute_button["state"] != "disabled":
             return
-
-        command = ["ffmpeg", "-i", input_path, "-y"]
-        if quality:
-            crf_map = {"High": 20, "Medium": 25, "Low": 30}
-            command.extend(["-c:v", "libx264", "-crf",
-                           str(crf_map.get(quality, 25))])
-
-        command.append(output_path)
-
-        try:
-            self.current_process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', creationflags=subprocess.CREATE_NO_WINDOW)
-            _, stderr = self.current_process.communicate()
-            if self.current_process.returncode != 0:
-                if not self.cancel_requested:
-                    raise RuntimeError(f"FFmpegエラー:\n{stderr}")
-        finally:
-            self.current_process = None
-
+        for msg_type, msg_payload in updates.items():
+            if msg_type == "status":
+                self.status_text.set(msg_payload)
+            elif msg_type == "progress":
+                self._show_progress(msg_payload)
+            elif msg_type == "batch_progress":
+                done, total, failed = msg_payload
+                self.progress_value.set(done / total * 100 if total else 0)
+                self.status_text.set(f"一括処理中... {done}/{total} (失敗: {failed})")
+        self._last_ui_update = time.monotonic()
 
 if __name__ == "__main__":
+    # 一括処理のプロセスプールを PyInstaller でビルドした exe でも動かすため
+    multiprocessing.freeze_support()
     app = ConverterApp()
     app.mainloop()
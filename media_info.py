@@ -0,0 +1,214 @@
+"""ffprobe によるメディア情報の取得とキャッシュ。
+
+1ファイルにつき ffprobe を1回だけ (-show_format -show_streams) 実行し、
+必要な項目だけを MediaInfo にまとめる。結果はパス・更新日時・サイズを
+キーにしてメモリ (LRU) とディスクにキャッシュするので、同じフォルダを
+何度処理しても ffprobe は再実行されない。
+"""
+import json
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+
+from cache import cache_dir, cache_key, temp_path
+from capabilities import CREATE_NO_WINDOW, ffmpeg_binary
+
+
+MEMORY_CACHE_SIZE = 1024
+# ディスクキャッシュの形式を変えたら上げる
+CACHE_VERSION = 1
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_rate(value):
+    """"30000/1001" 形式のフレームレートを数値に変換する"""
+    if not value:
+        return None
+    num, _, den = value.partition("/")
+    try:
+        return float(num) / float(den or 1) if float(den or 1) else None
+    except ValueError:
+        return None
+
+
+@dataclass
+class StreamInfo:
+    index: int
+    codec_type: str
+    codec_name: str = None
+    bit_rate: int = None
+    width: int = None
+    height: int = None
+    fps: float = None
+    channels: int = None
+    sample_rate: int = None
+
+
+@dataclass
+class MediaInfo:
+    """ffprobe の結果のうち、変換処理で使う項目"""
+    path: str
+    duration: float = None
+    size: int = None
+    format_name: str = None
+    bit_rate: int = None
+    streams: list = field(default_factory=list)
+
+    @classmethod
+    def from_ffprobe(cls, path, data):
+        fmt = data.get("format", {})
+        streams = []
+        for s in data.get("streams", []):
+            streams.append(StreamInfo(
+                index=s.get("index"),
+                codec_type=s.get("codec_type"),
+                codec_name=s.get("codec_name"),
+                bit_rate=_to_int(s.get("bit_rate")),
+                width=_to_int(s.get("width")),
+                height=_to_int(s.get("height")),
+                fps=_parse_rate(s.get("avg_frame_rate")) or _parse_rate(s.get("r_frame_rate")),
+                channels=_to_int(s.get("channels")),
+                sample_rate=_to_int(s.get("sample_rate")),
+            ))
+        return cls(
+            path=path,
+            duration=_to_float(fmt.get("duration")),
+            size=_to_int(fmt.get("size")),
+            format_name=fmt.get("format_name"),
+            bit_rate=_to_int(fmt.get("bit_rate")),
+            streams=streams,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["streams"] = [StreamInfo(**s) for s in data.get("streams", [])]
+        return cls(**data)
+
+    def to_dict(self):
+        return asdict(self)
+
+    @property
+    def video(self):
+        """最初の映像ストリーム (無ければ None)"""
+        return next((s for s in self.streams if s.codec_type == "video"), None)
+
+    @property
+    def audio(self):
+        """最初の音声ストリーム (無ければ None)"""
+        return next((s for s in self.streams if s.codec_type == "audio"), None)
+
+    def audio_bitrate_kbps(self, default=128):
+        """音声のビットレート (kbps)。音声が無ければ 0、不明なら default。"""
+        if self.audio is None:
+            return 0
+        if self.audio.bit_rate:
+            return self.audio.bit_rate / 1000
+        return default
+
+
+class ProbeCache:
+    """MediaInfo をメモリ (LRU) とディスクにキャッシュする"""
+
+    def __init__(self, maxsize=MEMORY_CACHE_SIZE, disk_dir=None, use_disk=True):
+        self.maxsize = maxsize
+        self.use_disk = use_disk
+        self._disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def disk_dir(self):
+        if self._disk_dir is None:
+            self._disk_dir = cache_dir("probe")
+        return self._disk_dir
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(path)
+        return cache_key(CACHE_VERSION, os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    def get(self, key):
+        with self._lock:
+            info = self._entries.get(key)
+            if info is not None:
+                self._entries.move_to_end(key)
+                return info
+        if not self.use_disk:
+            return None
+        try:
+            with open(os.path.join(self.disk_dir, f"{key}.json"), encoding="utf-8") as f:
+                info = MediaInfo.from_dict(json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+        self._remember(key, info)
+        return info
+
+    def put(self, key, info):
+        self._remember(key, info)
+        if not self.use_disk:
+            return
+        path = os.path.join(self.disk_dir, f"{key}.json")
+        tmp_path = temp_path(path)
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(info.to_dict(), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # キャッシュに書けなくても処理は続けられる
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _remember(self, key, info):
+        with self._lock:
+            self._entries[key] = info
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+_default_cache = ProbeCache(use_disk=os.environ.get("CONVERTER_PROBE_CACHE", "1") != "0")
+
+
+def run_ffprobe(path):
+    """ffprobe を1回実行してフォーマットとストリームの情報を返す"""
+    command = [
+        ffmpeg_binary("ffprobe") or "ffprobe", "-v", "error", "-show_format", "-show_streams",
+        "-of", "json", path
+    ]
+    try:
+        result = subprocess.run(
+            command, check=True, capture_output=True, text=True,
+            encoding="utf-8", errors="replace", creationflags=CREATE_NO_WINDOW
+        )
+        return json.loads(result.stdout)
+    except (FileNotFoundError, subprocess.CalledProcessError, ValueError) as e:
+        raise RuntimeError(f"メディア情報の取得に失敗しました: {e}\nffprobeがPATHに設定されているか確認してください。")
+
+
+def probe(path, cache=None):
+    """path の MediaInfo を返す。キャッシュにあれば ffprobe を実行しない。"""
+    cache = cache or _default_cache
+    key = cache.key(path)
+    info = cache.get(key)
+    if info is None:
+        info = MediaInfo.from_ffprobe(path, run_ffprobe(path))
+        cache.put(key, info)
+    return info
@@ -0,0 +1,182 @@
+"""ジョブごとの計測値 (処理時間・サイズなど) とその書き出し。
+
+ConversionEngine は1ジョブの終了ごとに ("metrics", dict) を通知する。
+計測値は1ジョブ1行の JSON (JSONL) として書き出せるほか、Prometheus の
+textfile collector で読み込める形式に集計して書き出せる。どのファイル・形式・
+エンコーダーに処理時間がかかっているかを調べるために使う。
+"""
+import json
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+
+from quality import format_quality_score
+
+
+# 処理の段階の表示名 (GUI の概要表示用)
+PHASE_LABELS = {
+    "probe": "解析", "decode": "読み込み", "encode": "エンコード",
+    "pass1": "1パス目", "pass2": "2パス目", "split": "分割", "concat": "結合", "quality": "画質の測定",
+}
+PROMETHEUS_PREFIX = "converter"
+
+
+@dataclass
+class JobMetrics:
+    """1ジョブ分の計測値"""
+    input_path: str
+    mode: str
+    input_format: str = None
+    # 複数の形式に出力したジョブはカンマ区切り
+    output_format: str = None
+    encoder: str = None
+    # "ok" / "failed" / "cancelled"
+    status: str = "running"
+    # 変換結果のキャッシュから出力した
+    cached: bool = False
+    error: str = None
+    started_at: float = field(default_factory=time.time)
+    wall_time: float = None
+    # 段階 (probe / decode / encode / pass1 / pass2 など) ごとの処理時間 (秒)
+    phase_times: dict = field(default_factory=dict)
+    image_encodes: int = 0
+    ffmpeg_runs: int = 0
+    bytes_in: int = None
+    bytes_out: int = None
+    target_bytes: int = None
+    # 目標画質圧縮の指標 ("ssim" / "psnr") と、出力の指標の値
+    quality_metric: str = None
+    quality_score: float = None
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def add_time(self, phase, seconds):
+        """段階ごとの処理時間を加算する (複数のスレッドから呼び出してよい)"""
+        with self._lock:
+            self.phase_times[phase] = self.phase_times.get(phase, 0.0) + seconds
+
+    @property
+    def size_ratio(self):
+        """目標サイズに対する出力サイズの比。目標が無ければ None。"""
+        if not self.target_bytes or self.bytes_out is None:
+            return None
+        return self.bytes_out / self.target_bytes
+
+    def to_dict(self):
+        with self._lock:
+            phase_times = {phase: round(seconds, 4) for phase, seconds in self.phase_times.items()}
+        return {
+            "input_path": self.input_path,
+            "mode": self.mode,
+            "input_format": self.input_format,
+            "output_format": self.output_format,
+            "encoder": self.encoder,
+            "status": self.status,
+            "cached": self.cached,
+            "error": self.error,
+            "started_at": round(self.started_at, 3),
+            "wall_time": round(self.wall_time, 4) if self.wall_time is not None else None,
+            "phase_times": phase_times,
+            "image_encodes": self.image_encodes,
+            "ffmpeg_runs": self.ffmpeg_runs,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "target_bytes": self.target_bytes,
+            "size_ratio": round(self.size_ratio, 4) if self.size_ratio is not None else None,
+            "quality_metric": self.quality_metric,
+            "quality_score": round(self.quality_score, 4) if self.quality_score is not None else None,
+        }
+
+
+def summary_text(record):
+    """計測値 (to_dict の結果) の短い説明 (GUI の完了メッセージ用)"""
+    if record.get("cached"):
+        return "前回の結果を再利用しました。"
+    parts = [f"処理時間: {record['wall_time']:.1f}秒"]
+    phases = [f"{PHASE_LABELS.get(phase, phase)} {seconds:.1f}秒"
+              for phase, seconds in record["phase_times"].items() if seconds >= 0.05]
+    if phases:
+        parts[0] += f" ({' / '.join(phases)})"
+    if record["bytes_in"] is not None and record["bytes_out"] is not None:
+        parts.append(f"サイズ: {record['bytes_in'] / (1024 * 1024):.2f}MB → {record['bytes_out'] / (1024 * 1024):.2f}MB")
+    if record["size_ratio"] is not None:
+        parts.append(f"目標サイズの {record['size_ratio'] * 100:.0f}%")
+    if record.get("quality_score") is not None:
+        parts.append(f"画質: {format_quality_score(record['quality_metric'], record['quality_score'])}")
+    return "\n".join(parts)
+
+
+class MetricsLog:
+    """計測値を1行1ジョブの JSON としてファイル (- なら標準エラー出力) に追記する"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self.path == "-":
+                sys.stderr.write(line)
+                sys.stderr.flush()
+                return
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+
+def _label_value(value):
+    return str(value if value is not None else "").replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{_label_value(value)}"' for key, value in labels.items()) + "}"
+
+
+def prometheus_text(records):
+    """計測値の一覧を Prometheus のテキスト形式に集計する。
+
+    ジョブ数・処理時間・入出力のバイト数を (mode, 出力形式, エンコーダー) ごとに、
+    段階ごとの処理時間を (段階, 出力形式, エンコーダー) ごとに合計する。
+    """
+    jobs, seconds, bytes_in, bytes_out, phases = {}, {}, {}, {}, {}
+    for record in records:
+        key = (record["mode"], record["output_format"], record["encoder"])
+        status_key = key + (record["status"],)
+        jobs[status_key] = jobs.get(status_key, 0) + 1
+        seconds[key] = seconds.get(key, 0.0) + (record["wall_time"] or 0.0)
+        bytes_in[key] = bytes_in.get(key, 0) + (record["bytes_in"] or 0)
+        bytes_out[key] = bytes_out.get(key, 0) + (record["bytes_out"] or 0)
+        for phase, phase_seconds in record["phase_times"].items():
+            phase_key = (phase, record["output_format"], record["encoder"])
+            phases[phase_key] = phases.get(phase_key, 0.0) + phase_seconds
+
+    lines = []
+
+    def metric(name, help_text, values, label_names):
+        full_name = f"{PROMETHEUS_PREFIX}_{name}"
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} gauge")
+        for key, value in sorted(values.items(), key=lambda item: tuple(map(str, item[0]))):
+            lines.append(f"{full_name}{_labels(**dict(zip(label_names, key)))} {value:g}")
+
+    group = ("mode", "format", "encoder")
+    metric("jobs", "Number of jobs in the last run", jobs, group + ("status",))
+    metric("job_seconds", "Total wall time of jobs in the last run", seconds, group)
+    metric("phase_seconds", "Total time per processing phase in the last run", phases, ("phase", "format", "encoder"))
+    metric("input_bytes", "Total input bytes in the last run", bytes_in, group)
+    metric("output_bytes", "Total output bytes in the last run", bytes_out, group)
+    lines.append(f"# HELP {PROMETHEUS_PREFIX}_last_run_timestamp_seconds Time the last run finished")
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_last_run_timestamp_seconds gauge")
+    lines.append(f"{PROMETHEUS_PREFIX}_last_run_timestamp_seconds {time.time():.3f}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, records):
+    """prometheus_text の結果を path に書き出す (途中の内容を読まれないように置き換える)"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(prometheus_text(records))
+    os.replace(tmp_path, path)
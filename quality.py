@@ -0,0 +1,118 @@
+"""画質の指標 (SSIM / PSNR) と、目標画質圧縮のための計測。
+
+圧縮モードで target_quality を指定すると、目標サイズの代わりに「画質の指標が
+target_quality 以上になる最も小さい出力」を探す。画像は元画像とエンコード結果の
+SSIM / PSNR を Pillow だけでメモリ上で計算し、動画は FFmpeg の ssim / psnr フィルタで
+いくつかの区間を計測した結果を読み取る。
+"""
+import math
+import re
+
+
+QUALITY_METRICS = ("ssim", "psnr")
+# 指標ごとの目標値の範囲 (SSIM は 0〜1, PSNR は dB)
+_TARGET_RANGES = {"ssim": (0.0, 1.0), "psnr": (0.0, 100.0)}
+# 完全に一致する画像の PSNR (無限大の代わり)
+MAX_PSNR = 100.0
+# SSIM を計算する窓の大きさ (ピクセル)。重ならない 8x8 の窓の平均をとる
+SSIM_BLOCK = 8
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+# 動画で画質を計測する区間の数と長さ (秒)
+SAMPLE_COUNT = 3
+SAMPLE_SECONDS = 3.0
+
+_FFMPEG_PATTERNS = {
+    "ssim": re.compile(r"SSIM .*All:\s*([0-9.]+|inf)"),
+    "psnr": re.compile(r"PSNR .*average:\s*([0-9.]+|inf)"),
+}
+
+
+def validate_quality_target(metric, value):
+    """目標画質の指定が正しくなければ ValueError を送出する"""
+    if metric not in QUALITY_METRICS:
+        raise ValueError(f"不明な画質の指標です: {metric} ({' / '.join(QUALITY_METRICS)} を指定してください)")
+    low, high = _TARGET_RANGES[metric]
+    if not low < value <= high:
+        raise ValueError(f"目標画質 ({metric.upper()}) は {low:g} より大きく {high:g} 以下の値を指定してください。")
+
+
+def format_quality_score(metric, value):
+    """指標の値の表示用の文字列"""
+    if metric == "psnr":
+        return f"PSNR {value:.2f}dB"
+    return f"SSIM {value:.4f}"
+
+
+def _mean(img):
+    """F モードの画像の画素値の平均"""
+    from PIL import Image
+
+    return img.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+
+
+def _luma(img):
+    return img.convert("L").convert("F")
+
+
+def image_ssim(reference, candidate):
+    """2枚の画像の輝度の SSIM (重ならない SSIM_BLOCK 四方の窓の平均)"""
+    from PIL import ImageMath
+
+    x, y = _luma(reference), _luma(candidate)
+    mx, my = x.reduce(SSIM_BLOCK), y.reduce(SSIM_BLOCK)
+    xx = ImageMath.lambda_eval(lambda a: a["x"] * a["x"], x=x).reduce(SSIM_BLOCK)
+    yy = ImageMath.lambda_eval(lambda a: a["y"] * a["y"], y=y).reduce(SSIM_BLOCK)
+    xy = ImageMath.lambda_eval(lambda a: a["x"] * a["y"], x=x, y=y).reduce(SSIM_BLOCK)
+    ssim_map = ImageMath.lambda_eval(
+        lambda a: ((a["mx"] * a["my"] * 2 + _SSIM_C1) * ((a["xy"] - a["mx"] * a["my"]) * 2 + _SSIM_C2))
+        / ((a["mx"] * a["mx"] + a["my"] * a["my"] + _SSIM_C1)
+           * (a["xx"] - a["mx"] * a["mx"] + a["yy"] - a["my"] * a["my"] + _SSIM_C2)),
+        mx=mx, my=my, xx=xx, yy=yy, xy=xy)
+    return _mean(ssim_map)
+
+
+def image_psnr(reference, candidate):
+    """2枚の画像の RGB の PSNR (dB)"""
+    from PIL import ImageChops
+
+    diff = ImageChops.difference(reference.convert("RGB"), candidate.convert("RGB"))
+    histogram = diff.histogram()
+    squared = sum(count * (i % 256) ** 2 for i, count in enumerate(histogram))
+    mse = squared / (reference.width * reference.height * 3)
+    if mse == 0:
+        return MAX_PSNR
+    return min(MAX_PSNR, 10 * math.log10(255 ** 2 / mse))
+
+
+def measure_image_quality(metric, reference, candidate):
+    """reference に対する candidate の画質の指標"""
+    if candidate.size != reference.size:
+        raise ValueError("比較する画像の大きさが異なります。")
+    if metric == "psnr":
+        return image_psnr(reference, candidate)
+    return image_ssim(reference, candidate)
+
+
+def quality_sample_ranges(duration, count=SAMPLE_COUNT, length=SAMPLE_SECONDS):
+    """動画の画質を計測する区間 [(開始秒, 長さ)]。短い動画は全体を1区間にする。"""
+    if duration <= count * length:
+        return [(0.0, duration)]
+    return [(duration * (i + 0.5) / count - length / 2, length) for i in range(count)]
+
+
+def ffmpeg_quality_filter(metric):
+    """[0:v] (元の動画) に対する [1:v] (エンコード結果) の画質を計測する -lavfi の値"""
+    # フィルタはフレームを時刻で対応させるが、MKV の時刻はミリ秒に丸められていて
+    # エンコードの前後でずれることがあるので、フレームの番号を時刻にして対応させる
+    return (f"[0:v]settb=1,setpts=N,format=yuv420p[ref];"
+            f"[1:v]settb=1,setpts=N,format=yuv420p[main];[main][ref]{metric}")
+
+
+def parse_ffmpeg_quality(metric, stderr):
+    """ssim / psnr フィルタが FFmpeg の標準エラー出力に書く全体の値を読み取る。見つからなければ None。"""
+    matches = _FFMPEG_PATTERNS[metric].findall(stderr)
+    if not matches:
+        return None
+    value = matches[-1]
+    return MAX_PSNR if value == "inf" else min(MAX_PSNR, float(value))
@@ -0,0 +1,154 @@
+"""長い動画をキーフレームで分割し、区間ごとに並列エンコードする。
+
+1本の libx264 プロセスでは多コアのマシンを使い切れないため、入力を
+N 個の区間に無劣化で分割して同時にエンコードし、concat demuxer で
+再エンコードせずに結合する。音声は結合時に元ファイルから1回だけエンコードする。
+"""
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from encoders import get_encoder
+from engine import SINGLE_PASS_BUFSIZE_FACTOR, SINGLE_PASS_MAXRATE_FACTOR, audio_args
+
+
+# 区間が短すぎるとキーフレーム間隔より短くなり分割の効果が無いため
+MIN_SEGMENT_SECONDS = 30
+
+
+def default_segment_count():
+    """CPU コア数から分割数を決める (1プロセスあたり4スレッド程度)"""
+    return max(2, (os.cpu_count() or 1) // 4)
+
+
+def plan_segment_count(requested, duration):
+    """要求された分割数を動画の長さに合わせて調整する。1 以下なら分割しない。"""
+    if not requested or requested <= 1 or not duration:
+        return 1
+    return max(1, min(requested, int(duration // MIN_SEGMENT_SECONDS)))
+
+
+def _concat_list_line(path):
+    # concat demuxer のリストではシングルクォートを '\'' でエスケープする
+    escaped = path.replace("'", "'\\''")
+    return f"file '{escaped}'\n"
+
+
+class SegmentProgress:
+    """各区間の進捗をまとめて1つの進捗として通知する"""
+
+    def __init__(self, engine, count, encoder):
+        self.engine = engine
+        self.encoder = encoder
+        self.percents = [0.0] * count
+        self.fps = [0.0] * count
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def callback(self, index):
+        def on_progress(progress):
+            with self._lock:
+                if progress["percent"] is not None:
+                    self.percents[index] = progress["percent"]
+                self.fps[index] = progress["fps"] or 0.0
+                percent = sum(self.percents) / len(self.percents)
+                fps = sum(self.fps)
+            elapsed = time.monotonic() - self.started
+            eta = elapsed * (100 - percent) / percent if percent > 0 else None
+            self.engine.emit("progress", {
+                "percent": percent,
+                "eta": eta,
+                "fps": fps,
+                "speed": None,
+                "out_time": None,
+                "stage": (1, 1),
+                "encoder": self.encoder,
+                "finished": False,
+            })
+        return on_progress
+
+
+def encode_segmented(engine, input_path, output_path, encoder, video_bitrate_kbps, audio_bitrate_kbps,
+                     duration, segment_count, rate_control, video_filter=(), input_args=()):
+    """input_path を segment_count 個に分割して並列エンコードし、output_path に結合する。
+
+    各区間は同じビットレートでエンコードするので、区間ごとのサイズ配分は
+    区間の長さに比例する。video_filter と input_args (video_pipeline_args の結果) は
+    各区間のエンコードに使う。
+    エラー時は残りの FFmpeg プロセスをすべて終了する。
+    """
+    spec = get_encoder(encoder)
+    container = output_path.split('.')[-1].lower()
+    threads_per_segment = max(1, (os.cpu_count() or 1) // segment_count)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        engine.emit("status", f"動画を分割しています... ({segment_count}区間)")
+        split_cmd = [
+            "ffmpeg", "-i", input_path, "-map", "0:v:0", "-c", "copy",
+            "-f", "segment", "-segment_time", f"{duration / segment_count:.3f}",
+            "-reset_timestamps", "1", "-y", os.path.join(tempdir, "source%04d.mkv")
+        ]
+        engine.run_ffmpeg(split_cmd, "FFmpegエラー (分割)", duration, phase="split")
+        if engine.cancel_requested: return
+
+        sources = sorted(n for n in os.listdir(tempdir) if n.startswith("source"))
+        if not sources:
+            raise RuntimeError("動画の分割に失敗しました。")
+
+        engine.emit("status", f"圧縮中... ({len(sources)}区間を並列エンコード, {encoder})")
+        progress = SegmentProgress(engine, len(sources), encoder)
+        segment_duration = duration / len(sources)
+
+        def encode_segment(index, name):
+            source = os.path.join(tempdir, name)
+            encoded = os.path.join(tempdir, f"encoded{index:04d}.mkv")
+            common = [*video_filter, "-threads", str(threads_per_segment)]
+            if rate_control == "two_pass":
+                log_prefix = os.path.join(tempdir, f"pass{index:04d}")
+                engine.run_ffmpeg(
+                    ["ffmpeg", "-y", *input_args, "-i", source, *common, *spec.video_args(video_bitrate_kbps), "-pass", "1", "-passlogfile", log_prefix,
+                     "-an", "-f", "matroska", os.devnull],
+                    f"FFmpegエラー (区間{index + 1}, パス1, {encoder})",
+                    segment_duration, (1, 2), encoder, progress.callback(index), phase="pass1")
+                if engine.cancel_requested: return None
+                engine.run_ffmpeg(
+                    ["ffmpeg", "-y", *input_args, "-i", source, *common, *spec.video_args(video_bitrate_kbps),
+                     "-pass", "2", "-passlogfile", log_prefix, encoded],
+                    f"FFmpegエラー (区間{index + 1}, パス2, {encoder})",
+                    segment_duration, (2, 2), encoder, progress.callback(index), phase="pass2")
+            else:
+                engine.run_ffmpeg(
+                    ["ffmpeg", "-y", *input_args, "-i", source, *common,
+                     *spec.video_args(video_bitrate_kbps, SINGLE_PASS_MAXRATE_FACTOR, SINGLE_PASS_BUFSIZE_FACTOR), encoded],
+                    f"FFmpegエラー (区間{index + 1}, {encoder})",
+                    segment_duration, (1, 1), encoder, progress.callback(index))
+            return encoded
+
+        encoded_paths = [None] * len(sources)
+        with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+            futures = {pool.submit(encode_segment, i, name): i for i, name in enumerate(sources)}
+            try:
+                for future in as_completed(futures):
+                    encoded_paths[futures[future]] = future.result()
+            except Exception:
+                # 1区間でも失敗したら残りのエンコードを止める
+                for pending in futures:
+                    pending.cancel()
+                engine.kill_processes()
+                raise
+        if engine.cancel_requested: return
+
+        list_path = os.path.join(tempdir, "segments.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.writelines(_concat_list_line(p) for p in encoded_paths)
+
+        engine.emit("status", "区間を結合しています...")
+        concat_cmd = [
+            "ffmpeg", "-f", "concat", "-safe", "0", "-i", list_path, "-i", input_path,
+            "-map", "0:v", "-map", "1:a:0?", "-c:v", "copy", *spec.container_args(container),
+            *audio_args(audio_bitrate_kbps, container),
+            "-y", output_path
+        ]
+        engine.run_ffmpeg(concat_cmd, "FFmpegエラー (結合)", duration, phase="concat")
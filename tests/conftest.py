@@ -0,0 +1,79 @@
+import json
+import os
+import stat
+import sys
+import textwrap
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# 引数を記録し、出力ファイルを作って成功する FFmpeg の代わり。
+# -pass 1 では -passlogfile のログを書き、-progress には 5 秒地点 (2 倍速) と終了の2ブロックを出力する。
+# 出力が %04d の連番なら2区間分のファイルを作り、concat のリストは全ファイルの存在を確かめる。
+# STUB_FAIL_ON の引数を含む実行だけは失敗し、STUB_SLEEP を指定するとその秒数待ってから終わる。
+_STUB = textwrap.dedent('''\
+    import json, os, sys
+    args = sys.argv[1:]
+    with open(os.environ["STUB_LOG"], "a", encoding="utf-8") as f:
+        f.write(json.dumps(args) + "\\n")
+    if "-encoders" in args:
+        print(" V..... = Video\\n ------")
+        for name in os.environ.get("STUB_ENCODERS", "libx264").split(","):
+            print(f" V....D {name}  stub")
+        sys.exit(0)
+    fail_on = os.environ.get("STUB_FAIL_ON")
+    if fail_on and fail_on in args:
+        sys.stderr.write(f"stub: {fail_on} is not supported\\n")
+        sys.exit(1)
+    if os.environ.get("STUB_SLEEP"):
+        import time
+        time.sleep(float(os.environ["STUB_SLEEP"]))
+    if "-passlogfile" in args and args[args.index("-pass") + 1] == "1":
+        with open(args[args.index("-passlogfile") + 1] + "-0.log", "w") as f:
+            f.write("stub pass 1 stats\\n")
+    if "-f" in args and args[args.index("-f") + 1] == "concat":
+        with open(args[args.index("-i") + 1], encoding="utf-8") as f:
+            listed = [line.strip()[len("file '"):-1] for line in f if line.strip()]
+        if not listed or not all(os.path.exists(path) for path in listed):
+            sys.stderr.write("stub: missing concat input\\n")
+            sys.exit(1)
+    # 入力とログ以外の絶対パスの引数を出力とみなす (1回の実行で複数の出力を書く場合がある)
+    outputs = [arg for i, arg in enumerate(args)
+               if os.path.isabs(arg) and arg != os.devnull and args[i - 1] not in ("-i", "-passlogfile")]
+    for output in outputs:
+        for path in [output % index for index in range(2)] if "%04d" in output else [output]:
+            with open(path, "wb") as f:
+                f.write(b"\\0" * 1024)
+    print("out_time_us=5000000\\nspeed=2.0x\\nprogress=continue")
+    print("out_time_us=10000000\\nspeed=2.0x\\nprogress=end")
+''')
+
+
+class FFmpegStub:
+    def __init__(self, log_path):
+        self.log_path = log_path
+
+    @property
+    def calls(self):
+        """実行された FFmpeg の引数のリスト (実行順)"""
+        try:
+            with open(self.log_path, encoding="utf-8") as f:
+                return [json.loads(line) for line in f]
+        except FileNotFoundError:
+            return []
+
+
+@pytest.fixture
+def ffmpeg_stub(tmp_path, monkeypatch):
+    """CONVERTER_FFMPEG を引数を記録するだけのスタブにする"""
+    stub_path = tmp_path / "ffmpeg_stub.py"
+    stub_path.write_text(f"#!{sys.executable}\n" + _STUB, encoding="utf-8")
+    stub_path.chmod(stub_path.stat().st_mode | stat.S_IXUSR)
+    log_path = tmp_path / "ffmpeg_calls.jsonl"
+    monkeypatch.setenv("CONVERTER_FFMPEG", str(stub_path))
+    monkeypatch.setenv("STUB_LOG", str(log_path))
+    monkeypatch.setenv("CONVERTER_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("CONVERTER_OUTPUT_CACHE", "0")
+    return FFmpegStub(log_path)
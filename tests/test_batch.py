@@ -0,0 +1,68 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import media_info
+from batch import BatchRunner, collect_jobs, job_category
+from engine import ConversionJob
+
+
+def _animated_gif(path):
+    from PIL import Image
+
+    frames = [Image.new("RGB", (32, 32), color) for color in ("red", "blue", "green")]
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+    return str(path)
+
+
+def _no_probe(path):
+    raise RuntimeError("ffprobe is not available in tests")
+
+
+def test_job_category_uses_output_format(tmp_path):
+    gif = str(tmp_path / "anim.gif")
+    assert job_category(ConversionJob(input_path=gif, target_format="mp4")) == "video"
+    assert job_category(ConversionJob(input_path=gif, target_format="webp")) == "image"
+    assert job_category(ConversionJob(input_path=str(tmp_path / "movie.mp4"), target_format="gif")) == "video"
+
+
+def test_collect_jobs_includes_animations_for_video_targets(tmp_path):
+    gif = _animated_gif(tmp_path / "anim.gif")
+    (tmp_path / "still.png").write_bytes(b"")
+
+    jobs = collect_jobs(str(tmp_path), "convert", target_format="mp4")
+
+    assert [job.input_path for job in jobs] == [gif]
+
+
+def test_animation_to_video_runs_with_ffmpeg(tmp_path, ffmpeg_stub, monkeypatch):
+    monkeypatch.setattr(media_info, "probe", _no_probe)
+    gif = _animated_gif(tmp_path / "anim.gif")
+
+    results = BatchRunner([ConversionJob(input_path=gif, target_format="mp4")],
+                          image_workers=1, video_workers=1).run()
+
+    assert results[0].error is None
+    assert results[0].output_path == str(tmp_path / "anim.mp4")
+    assert any(call[-1].endswith("anim.part.mp4") for call in ffmpeg_stub.calls)
+
+
+def test_interrupt_cancels_running_ffmpeg_before_waiting(tmp_path, ffmpeg_stub, monkeypatch):
+    monkeypatch.setattr(media_info, "probe", _no_probe)
+    monkeypatch.setenv("STUB_SLEEP", "30")
+    source = tmp_path / "movie.mp4"
+    source.write_bytes(b"\0" * 1024)
+    runner = BatchRunner([ConversionJob(input_path=str(source), target_format="mkv")], video_workers=1,
+                         ffmpeg_available=True)
+    # 端末の Ctrl+C と同じく、プロセスに SIGINT を送る
+    threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT)).start()
+
+    started = time.monotonic()
+    with pytest.raises(KeyboardInterrupt):
+        runner.run()
+
+    assert runner.cancel_requested
+    assert time.monotonic() - started < 10
@@ -0,0 +1,58 @@
+import os
+import threading
+
+from cache import OutputCache, PassLogCache
+
+
+def _write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_restore_rejects_outputs_rewritten_in_place(tmp_path):
+    cache = OutputCache(root=str(tmp_path / "cache"))
+    output = _write(tmp_path / "out.png", b"a" * 100)
+    cache.store("key", output, ["warning"])
+
+    assert cache.restore("key", str(tmp_path / "copy.png")) == ["warning"]
+
+    # ハードリンクで共有している出力を、同じサイズのまま書き換える
+    with open(output, "r+b") as f:
+        f.write(b"b" * 100)
+
+    assert cache.restore("key", str(tmp_path / "again.png")) is None
+    assert not os.path.exists(tmp_path / "cache" / "key")
+
+
+def test_store_skips_outputs_too_large_for_the_cache(tmp_path):
+    cache = OutputCache(root=str(tmp_path / "cache"), max_bytes=1000)
+    cache.store("small", _write(tmp_path / "small.png", b"a" * 100))
+    cache.store("large", _write(tmp_path / "large.png", b"b" * 900))
+
+    assert cache.restore("large", str(tmp_path / "large_copy.png")) is None
+    assert cache.restore("small", str(tmp_path / "small_copy.png")) == []
+
+
+def test_concurrent_passlog_stores_do_not_collide(tmp_path):
+    cache = PassLogCache(root=str(tmp_path / "passlog"))
+    errors = []
+
+    def store(index):
+        directory = tmp_path / f"work{index}"
+        directory.mkdir()
+        (directory / "passlog-0.log").write_text("x" * 100000)
+        try:
+            cache.store(("same", "key"), str(directory / "passlog"))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=store, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    prefix = cache.lookup(("same", "key"), "passlog")
+    assert prefix and open(prefix + "-0.log").read() == "x" * 100000
+    assert not [name for name in os.listdir(tmp_path / "passlog") if name.endswith(".tmp")]
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from batch import BatchResult, BatchRunner
+from cli import UsageError, expand_inputs, result_record
+from engine import ConversionJob
+
+
+def test_result_record_reports_the_encoder_actually_used(tmp_path):
+    job = ConversionJob(input_path=str(tmp_path / "movie.mp4"), mode="compress", target_size_mb=1, encoder="auto")
+    result = BatchResult(job=job, error="failed", metrics={"encoder": "h264_nvenc"})
+
+    assert result_record(result)["encoder"] == "h264_nvenc"
+
+
+def test_result_record_falls_back_to_the_requested_encoder(tmp_path):
+    job = ConversionJob(input_path=str(tmp_path / "movie.mp4"), mode="compress", target_size_mb=1)
+
+    assert result_record(BatchResult(job=job, error="failed"))["encoder"] == "libx264"
+    assert result_record(BatchResult(job=ConversionJob(input_path=str(tmp_path / "a.png"), target_format="jpg"),
+                                     error="failed"))["encoder"] is None
+
+
+def test_expand_inputs_rejects_converting_a_file_onto_itself(tmp_path):
+    source = tmp_path / "s.jpg"
+    source.write_bytes(b"")
+
+    with pytest.raises(UsageError, match="入力ファイルと同じ"):
+        expand_inputs([str(source)], "convert", target_format="jpg")
+    assert [job.target_format for job in expand_inputs([str(source)], "convert", target_format="png")] == ["png"]
+
+
+def test_convert_to_the_same_format_does_not_touch_the_source(tmp_path, monkeypatch):
+    from PIL import Image
+
+    monkeypatch.setenv("CONVERTER_CACHE_DIR", str(tmp_path / "cache"))
+    source = tmp_path / "s.jpg"
+    Image.new("RGB", (16, 16), "red").save(source)
+    before = source.read_bytes()
+
+    results = BatchRunner([ConversionJob(input_path=str(source), target_format="jpg")], image_workers=1).run()
+
+    assert results[0].error and "入力ファイルと同じ" in results[0].error
+    assert source.read_bytes() == before
+    assert os.stat(source).st_nlink == 1
@@ -0,0 +1,389 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import media_info
+from engine import ConversionEngine, ConversionJob, parse_ffmpeg_progress, video_pipeline_args
+from media_info import MediaInfo, StreamInfo
+
+
+def _fake_probe(path):
+    return MediaInfo(path=path, duration=10.0, size=10 * 1024 * 1024, streams=[
+        StreamInfo(index=0, codec_type="video", codec_name="h264", width=640, height=360, fps=30.0),
+    ])
+
+
+def _run(job):
+    events = []
+    engine = ConversionEngine(on_event=lambda msg_type, payload: events.append((msg_type, payload)),
+                              ffmpeg_available=True)
+    return engine.run(job), events
+
+
+def _encoder_args(call):
+    return call[call.index("-c:v") + 1]
+
+
+@pytest.mark.parametrize("container", ["wmv", "mpg", "vob"])
+def test_compress_keeps_libx264_for_containers_without_known_restrictions(tmp_path, ffmpeg_stub, monkeypatch,
+                                                                          container):
+    monkeypatch.setattr(media_info, "probe", _fake_probe)
+    source = tmp_path / f"movie.{container}"
+    source.write_bytes(b"\0" * 4096)
+
+    output, events = _run(ConversionJob(input_path=str(source), mode="compress", target_size_mb=1,
+                                        rate_control="single_pass"))
+
+    assert output == str(tmp_path / f"movie_compressed.{container}")
+    encodes = [call for call in ffmpeg_stub.calls if "-c:v" in call]
+    assert encodes and all(_encoder_args(call) == "libx264" for call in encodes)
+    assert not [payload for msg_type, payload in events if msg_type == "warning" and "libx264" in payload]
+
+
+def test_compress_redirects_encoder_rejected_by_container(tmp_path, ffmpeg_stub, monkeypatch):
+    monkeypatch.setattr(media_info, "probe", _fake_probe)
+    monkeypatch.setenv("STUB_ENCODERS", "libx264,libvpx-vp9")
+    source = tmp_path / "movie.webm"
+    source.write_bytes(b"\0" * 4096)
+
+    output, events = _run(ConversionJob(input_path=str(source), mode="compress", target_size_mb=1,
+                                        rate_control="single_pass"))
+
+    assert output is not None
+    encodes = [call for call in ffmpeg_stub.calls if "-c:v" in call]
+    assert encodes and all(_encoder_args(call) == "libvpx-vp9" for call in encodes)
+    assert any(msg_type == "warning" and "libvpx-vp9" in payload for msg_type, payload in events)
+
+
+def test_importing_engine_does_not_load_pillow():
+    code = "import sys, engine, quality; sys.exit('PIL' in sys.modules)"
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert subprocess.run([sys.executable, "-c", code], cwd=repo_root).returncode == 0
+
+
+def test_convert_targets_keeps_animation_frames(tmp_path, monkeypatch):
+    from PIL import Image
+
+    monkeypatch.setenv("CONVERTER_OUTPUT_CACHE", "0")
+    frames = [Image.new("RGB", (32, 32), color) for color in ("red", "blue", "green")]
+    source = tmp_path / "anim.gif"
+    frames[0].save(source, save_all=True, append_images=frames[1:], duration=100, loop=0)
+
+    outputs, events = _run(ConversionJob(input_path=str(source), targets=["webp", "png", "jpg"]))
+
+    with Image.open(outputs[0]) as webp, Image.open(outputs[1]) as png:
+        assert webp.n_frames == 3 and png.n_frames == 3
+    with Image.open(outputs[2]) as jpg:
+        assert jpg.size == (32, 32)
+    assert any(msg_type == "warning" and ".jpg" in payload for msg_type, payload in events)
+
+
+def test_video_pipeline_args_decodes_on_gpu_for_hardware_encoders():
+    assert video_pipeline_args("h264_nvenc", (640, 360)) == (
+        ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"], ["-vf", "scale_cuda=640:360"])
+    assert video_pipeline_args("h264_nvenc") == (["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"], [])
+    assert video_pipeline_args("h264_nvenc", (640, 360), hwaccel=False) == (
+        [], ["-vf", "scale=640:360:flags=bilinear"])
+    assert video_pipeline_args("libx264", (640, 360)) == ([], ["-vf", "scale=640:360:flags=bilinear"])
+
+
+def test_compress_retries_on_cpu_when_gpu_decoding_fails(tmp_path, ffmpeg_stub, monkeypatch):
+    monkeypatch.setattr(media_info, "probe", _fake_probe)
+    monkeypatch.setenv("STUB_ENCODERS", "libx264,h264_nvenc")
+    monkeypatch.setenv("STUB_FAIL_ON", "-hwaccel")
+    source = tmp_path / "movie.mp4"
+    source.write_bytes(b"\0" * 4096)
+
+    output, events = _run(ConversionJob(input_path=str(source), mode="compress", target_size_mb=1,
+                                        encoder="h264_nvenc"))
+
+    assert output == str(tmp_path / "movie_compressed.mp4")
+    encodes = [call for call in ffmpeg_stub.calls if "-i" in call and "lavfi" not in call]
+    assert len(encodes) == 2
+    gpu, cpu = encodes
+    assert gpu[gpu.index("-hwaccel") + 1] == "cuda" and gpu.index("-hwaccel") < gpu.index("-i")
+    assert "-hwaccel" not in cpu
+    assert _encoder_args(gpu) == _encoder_args(cpu) == "h264_nvenc"
+    assert any(msg_type == "warning" and "CPUでデコードしてやり直します" in payload for msg_type, payload in events)
+
+
+def test_run_ffmpeg_records_encode_time_on_one_clock(tmp_path, ffmpeg_stub, monkeypatch):
+    monkeypatch.setattr(media_info, "probe", _fake_probe)
+    source = tmp_path / "movie.mp4"
+    source.write_bytes(b"\0" * 4096)
+
+    output, events = _run(ConversionJob(input_path=str(source), target_format="mkv"))
+
+    metrics = [payload for msg_type, payload in events if msg_type == "metrics"][-1]
+    assert output is not None
+    assert 0 <= metrics["phase_times"]["encode"] <= metrics["wall_time"]
+
+
+def _animated_gif(path):
+    from PIL import Image
+
+    frames = [Image.new("RGB", (32, 32), color) for color in ("red", "blue", "green")]
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+    return str(path)
+
+
+@pytest.mark.parametrize("target_format, video_args", [
+    ("mp4", ["-c:v", "libx264", "-crf", "20"]),
+    ("webm", ["-c:v", "libvpx-vp9", "-deadline", "good", "-cpu-used", "4", "-row-mt", "1", "-crf", "31", "-b:v", "0"]),
+])
+def test_animation_to_video_uses_container_encoder(tmp_path, ffmpeg_stub, monkeypatch, target_format, video_args):
+    monkeypatch.setattr(media_info, "probe", _fake_probe)
+    gif = _animated_gif(tmp_path / "anim.gif")
+
+    output, _ = _run(ConversionJob(input_path=gif, target_format=target_format, quality="High"))
+
+    assert output == str(tmp_path / f"anim.{target_format}")
+    call = ffmpeg_stub.calls[-1]
+    start = call.index("-c:v")
+    assert call[start:start + len(video_args)] == video_args
+
+
+def test_animation_to_video_checks_memory_limit(tmp_path, ffmpeg_stub):
+    gif = _animated_gif(tmp_path / "anim.gif")
+
+    with pytest.raises(RuntimeError):
+        _run(ConversionJob(input_path=gif, target_format="mp4", memory_limit_mb=0.001))
+    assert not ffmpeg_stub.calls
+
+
+def test_multipage_tiff_to_png_gets_frame_durations(tmp_path):
+    from PIL import Image
+
+    pages = [Image.new("RGB", (32, 32), color) for color in ("red", "blue")]
+    source = tmp_path / "pages.tiff"
+    pages[0].save(source, save_all=True, append_images=pages[1:])
+
+    output, events = _run(ConversionJob(input_path=str(source), target_format="png", use_cache=False))
+
+    with Image.open(output) as png:
+        assert png.n_frames == 2
+        assert png.info["duration"] == 100
+    assert any(msg_type == "warning" and "100ms" in payload for msg_type, payload in events)
+
+
+def _still_image(path):
+    from PIL import Image
+
+    Image.new("RGB", (64, 48), "red").save(path)
+    return str(path)
+
+
+@pytest.mark.parametrize("job_options", [
+    {"target_format": "png"},
+    {"target_format": "jpg", "quality": "Low"},
+    {"mode": "compress", "target_size_mb": 1},
+])
+def test_plain_image_jobs_count_their_encodes(tmp_path, monkeypatch, job_options):
+    monkeypatch.setenv("CONVERTER_OUTPUT_CACHE", "0")
+    source = _still_image(tmp_path / "still.bmp")
+    engine = ConversionEngine(ffmpeg_available=False)
+
+    assert engine.run(ConversionJob(input_path=source, **job_options)) is not None
+    assert engine.encode_count == 1
+
+
+def test_image_convert_metrics_report_image_encodes(tmp_path, monkeypatch):
+    monkeypatch.setenv("CONVERTER_OUTPUT_CACHE", "0")
+    source = _still_image(tmp_path / "still.bmp")
+
+    output, events = _run(ConversionJob(input_path=source, target_format="png"))
+
+    record = [payload for msg_type, payload in events if msg_type == "metrics"][-1]
+    assert output is not None
+    assert record["image_encodes"] >= 1 and record["ffmpeg_runs"] == 0
+
+
+def test_failed_job_keeps_the_previous_output(tmp_path, monkeypatch):
+    monkeypatch.setenv("CONVERTER_CACHE_DIR", str(tmp_path / "cache"))
+    source = tmp_path / "still.bmp"
+    _still_image(source)
+    engine = ConversionEngine(ffmpeg_available=False)
+    output = engine.run(ConversionJob(input_path=str(source), target_format="png"))
+    previous = open(output, "rb").read()
+
+    # 読めない入力で処理し直しても、前回の出力 (キャッシュとハードリンクで共有している) は残る
+    source.write_bytes(b"not an image")
+    with pytest.raises(Exception):
+        engine.run(ConversionJob(input_path=str(source), target_format="png"))
+
+    assert open(output, "rb").read() == previous
+
+
+def test_cancelled_image_compress_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.setenv("CONVERTER_OUTPUT_CACHE", "0")
+    source = _still_image(tmp_path / "still.bmp")
+    engine = ConversionEngine(ffmpeg_available=False)
+    engine.on_event = lambda msg_type, payload: msg_type == "status" and engine.cancel()
+
+    assert engine.run(ConversionJob(input_path=source, mode="compress", target_size_mb=0.001)) is None
+    assert engine.encode_count == 0
+    assert os.listdir(tmp_path) == ["still.bmp"]
+
+
+def _noise_image(path, size=(800, 600)):
+    from PIL import Image
+
+    img = Image.merge("RGB", [Image.effect_noise(size, 64) for _ in range(3)])
+    img.save(path)
+    return img
+
+
+def _jpeg_size(img, quality):
+    from io import BytesIO
+
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.tell()
+
+
+@pytest.mark.parametrize("fits_at_min_quality", [True, False])
+def test_image_compress_resizes_only_when_min_quality_misses(tmp_path, monkeypatch, fits_at_min_quality):
+    from PIL import Image
+
+    monkeypatch.setenv("CONVERTER_OUTPUT_CACHE", "0")
+    img = _noise_image(tmp_path / "noise.png")
+    min_bytes = _jpeg_size(img, 5)
+    target_bytes = min_bytes * 1.2 if fits_at_min_quality else min_bytes / 4
+    job = ConversionJob(input_path=str(tmp_path / "noise.png"), mode="compress", target_size_mb=target_bytes / 1024 / 1024,
+                        output_path=str(tmp_path / "out.jpg"))
+
+    output, _ = _run(job)
+
+    with Image.open(output) as result:
+        assert (result.size == img.size) == fits_at_min_quality
+    assert os.path.getsize(output) <= target_bytes
+
+
+def test_image_compress_bisects_to_the_highest_quality_under_target(tmp_path, monkeypatch):
+    monkeypatch.setenv("CONVERTER_OUTPUT_CACHE", "0")
+    img = _noise_image(tmp_path / "noise.png", size=(200, 150))
+    sizes = {q: _jpeg_size(img, q) for q in range(5, 96)}
+    target_bytes = (sizes[40] + sizes[41]) / 2
+    engine = ConversionEngine(ffmpeg_available=False)
+
+    output = engine.run(ConversionJob(input_path=str(tmp_path / "noise.png"), mode="compress",
+                                      target_size_mb=target_bytes / 1024 / 1024, auto_resize=False,
+                                      output_path=str(tmp_path / "out.jpg")))
+
+    assert os.path.getsize(output) == sizes[40]
+    # 5〜95 の線形探索ではなく二分探索 (約 log2(91) 回) で見つける
+    assert engine.encode_count <= 8
+
+
+def test_parse_ffmpeg_progress_spreads_percent_across_passes():
+    progress = parse_ffmpeg_progress({"out_time_us": "2500000", "speed": "1.0x", "progress": "continue"},
+                                     duration=10.0, stage=(2, 2))
+
+    assert progress["percent"] == 62.5
+    assert progress["eta"] == 7.5
+    assert not progress["finished"]
+    # speed が無いときは経過時間から見積もる
+    assert parse_ffmpeg_progress({"out_time_ms": "5000000"}, duration=10.0, elapsed=1.0)["eta"] == 1.0
+    assert parse_ffmpeg_progress({"out_time": "00:00:05.000000"})["percent"] is None
+
+
+def test_video_conversion_reports_progress_from_ffmpeg(tmp_path, ffmpeg_stub, monkeypatch):
+    monkeypatch.setattr(media_info, "probe", _fake_probe)
+    source = tmp_path / "movie.mp4"
+    source.write_bytes(b"\0" * 4096)
+
+    _, events = _run(ConversionJob(input_path=str(source), mode="compress", target_size_mb=1,
+                                   rate_control="single_pass"))
+
+    progress = [payload for msg_type, payload in events if msg_type == "progress"]
+    assert [p["percent"] for p in progress] == [50.0, 100.0]
+    assert progress[0]["eta"] == 2.5 and progress[-1]["finished"]
+
+
+def test_two_pass_compress_reuses_the_cached_first_pass(tmp_path, ffmpeg_stub, monkeypatch):
+    monkeypatch.setattr(media_info, "probe", _fake_probe)
+    source = tmp_path / "movie.mp4"
+    source.write_bytes(b"\0" * 4096)
+
+    for target_size_mb in (2, 1):
+        _, events = _run(ConversionJob(input_path=str(source), mode="compress", target_size_mb=target_size_mb,
+                                       rate_control="two_pass"))
+
+    passes = [call[call.index("-pass") + 1] for call in ffmpeg_stub.calls if "-pass" in call]
+    assert passes == ["1", "2", "2"]
+    # 2回目の2パス目は、キャッシュに保存したログを読む
+    reused_prefix = ffmpeg_stub.calls[-1][ffmpeg_stub.calls[-1].index("-passlogfile") + 1]
+    assert reused_prefix.startswith(str(tmp_path / "cache"))
+    assert os.path.exists(reused_prefix + "-0.log")
+    assert any(msg_type == "status" and "キャッシュから再利用" in payload for msg_type, payload in events)
+
+
+def test_segmented_compress_splits_encodes_and_concatenates(tmp_path, ffmpeg_stub, monkeypatch):
+    def probe(path):
+        return MediaInfo(path=path, duration=90.0, size=10 * 1024 * 1024, streams=[
+            StreamInfo(index=0, codec_type="video", codec_name="h264", width=640, height=360, fps=30.0),
+        ])
+
+    monkeypatch.setattr(media_info, "probe", probe)
+    source = tmp_path / "movie.mp4"
+    source.write_bytes(b"\0" * 4096)
+
+    output, _ = _run(ConversionJob(input_path=str(source), mode="compress", target_size_mb=1,
+                                   rate_control="single_pass", segments=2))
+
+    split, *encodes, concat = ffmpeg_stub.calls
+    assert "segment" in split and split[split.index("-segment_time") + 1] == "45.000"
+    # スタブは2区間を作るので、区間ごとに1回ずつエンコードする
+    assert sorted(os.path.basename(call[call.index("-i") + 1]) for call in encodes) == ["source0000.mkv", "source0001.mkv"]
+    assert all(_encoder_args(call) == "libx264" for call in encodes)
+    assert "concat" in concat and concat[concat.index("-c:v") + 1] == "copy"
+    assert os.path.exists(output) and not os.path.exists(concat[-1])
+
+
+def test_container_conversion_copies_streams_instead_of_reencoding(tmp_path, ffmpeg_stub, monkeypatch):
+    monkeypatch.setattr(media_info, "probe", _fake_probe)
+    source = tmp_path / "movie.mkv"
+    source.write_bytes(b"\0" * 4096)
+
+    output, events = _run(ConversionJob(input_path=str(source), target_format="mp4"))
+
+    [call] = ffmpeg_stub.calls
+    assert call[call.index("-c:0") + 1] == "copy" and "libx264" not in call
+    assert os.path.exists(output)
+    assert ("status", "変換中... (再エンコードせずにコンテナを変換)") in events
+
+
+def test_image_targets_decode_the_source_once(tmp_path, monkeypatch):
+    from PIL import Image
+
+    import image_io
+
+    monkeypatch.setenv("CONVERTER_OUTPUT_CACHE", "0")
+    source = _still_image(tmp_path / "photo.png")
+    loads = []
+    real_load_image = image_io.load_image
+    monkeypatch.setattr(image_io, "load_image", lambda *args, **kwargs: loads.append(args) or real_load_image(*args, **kwargs))
+
+    outputs, _ = _run(ConversionJob(input_path=source, targets=["webp", "jpg", "bmp"]))
+
+    assert len(loads) == 1
+    assert [os.path.splitext(output)[1] for output in outputs] == [".webp", ".jpg", ".bmp"]
+    for output in outputs:
+        with Image.open(output) as img:
+            assert img.size == (64, 48)
+
+
+def test_video_targets_share_one_ffmpeg_run(tmp_path, ffmpeg_stub, monkeypatch):
+    monkeypatch.setattr(media_info, "probe", _fake_probe)
+    source = tmp_path / "movie.mp4"
+    source.write_bytes(b"\0" * 4096)
+
+    outputs, _ = _run(ConversionJob(input_path=str(source), targets=["mkv", "mov"]))
+
+    [call] = ffmpeg_stub.calls
+    assert call.count("-i") == 1
+    assert [os.path.splitext(arg)[1] for arg in call if arg.startswith(str(tmp_path / "movie."))][1:] == [".mkv", ".mov"]
+    assert [os.path.splitext(output)[1] for output in outputs] == [".mkv", ".mov"]
+    assert all(os.path.exists(output) for output in outputs)
@@ -0,0 +1,29 @@
+from formats import plan_stream_codecs
+from media_info import StreamInfo
+
+
+def _streams():
+    return [
+        StreamInfo(index=0, codec_type="video", codec_name="h264"),
+        StreamInfo(index=1, codec_type="audio", codec_name="vorbis"),
+        StreamInfo(index=2, codec_type="subtitle", codec_name="subrip"),
+        StreamInfo(index=3, codec_type="subtitle", codec_name="hdmv_pgs_subtitle"),
+        StreamInfo(index=4, codec_type="attachment", codec_name="ttf"),
+    ]
+
+
+def test_plan_stream_codecs_copies_what_the_container_accepts():
+    args, copied, transcoded = plan_stream_codecs(_streams(), "mp4")
+
+    # 映像はコピー、音声と字幕は再エンコードし、画像字幕と添付ファイルは出力しない
+    assert args == ["-map", "0:0", "-c:0", "copy",
+                    "-map", "0:1", "-c:1", "aac",
+                    "-map", "0:2", "-c:2", "mov_text"]
+    assert (copied, transcoded) == (1, 2)
+
+
+def test_plan_stream_codecs_keeps_every_stream_in_mkv():
+    args, copied, transcoded = plan_stream_codecs(_streams(), "mkv")
+
+    assert args.count("copy") == 5
+    assert (copied, transcoded) == (5, 0)
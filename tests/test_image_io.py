@@ -0,0 +1,61 @@
+import pytest
+
+import image_io
+
+
+def _uncompressed_tiff(path, size=(600, 400)):
+    from PIL import Image
+
+    pattern = bytes((i * 7) % 256 for i in range(size[0] * size[1] * 3))
+    img = Image.frombytes("RGB", size, pattern)
+    img.save(path, compression="raw")
+    return img
+
+
+def test_load_image_reduces_uncompressed_tiff_by_strips(tmp_path, monkeypatch):
+    from PIL import Image, ImageChops
+
+    path = tmp_path / "large.tiff"
+    original = _uncompressed_tiff(path)
+    with Image.open(path) as img:
+        layout = image_io._raw_row_layout(img)
+    assert layout
+
+    reduced = []
+    real_reduce = image_io._reduce_raw_rows
+    monkeypatch.setattr(image_io, "_reduce_raw_rows", lambda *args: reduced.append(args) or real_reduce(*args))
+    img = image_io.load_image(str(path), max_dimension=150, memory_limit_mb=64)
+
+    assert reduced
+    assert img.size == (150, 100)
+    expected = original.reduce(4)
+    assert ImageChops.difference(img.convert("RGB"), expected).getbbox() is None
+
+
+def test_load_image_leaves_pillow_bomb_limit_alone(tmp_path, monkeypatch):
+    from PIL import Image
+
+    path = tmp_path / "small.png"
+    Image.new("RGB", (8, 8)).save(path)
+    default = 10_000
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", default)
+
+    image_io.load_image(str(path), memory_limit_mb=64).close()
+    image_io.load_image(str(path)).close()
+
+    assert Image.MAX_IMAGE_PIXELS == default
+
+
+def test_load_image_decodes_large_jpeg_at_reduced_scale_within_memory_limit(tmp_path):
+    from PIL import Image
+
+    path = tmp_path / "large.jpg"
+    Image.new("RGB", (4000, 3000), "red").save(path, quality=50)
+
+    # 展開すると約 34MB だが、draft で 1/8 にデコードすれば 8MB に収まる
+    img = image_io.load_image(str(path), max_dimension=500, memory_limit_mb=8)
+    assert img.size == (500, 375)
+    img.close()
+
+    with pytest.raises(RuntimeError, match="画像が大きすぎる"):
+        image_io.load_image(str(path), memory_limit_mb=8)
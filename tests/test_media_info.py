@@ -0,0 +1,53 @@
+import media_info
+from media_info import ProbeCache
+
+
+_FFPROBE_RESULT = {
+    "format": {"duration": "10.0", "size": "4096", "format_name": "mov,mp4"},
+    "streams": [{"index": 0, "codec_type": "video", "codec_name": "h264", "width": 640, "height": 360,
+                 "avg_frame_rate": "30/1"}],
+}
+
+
+def _count_ffprobe(monkeypatch):
+    calls = []
+
+    def run_ffprobe(path):
+        calls.append(path)
+        return _FFPROBE_RESULT
+
+    monkeypatch.setattr(media_info, "run_ffprobe", run_ffprobe)
+    return calls
+
+
+def test_probe_runs_ffprobe_once_per_file_version(tmp_path, monkeypatch):
+    calls = _count_ffprobe(monkeypatch)
+    source = tmp_path / "movie.mp4"
+    source.write_bytes(b"\0" * 4096)
+    monkeypatch.setenv("CONVERTER_CACHE_DIR", str(tmp_path / "cache"))
+
+    info = media_info.probe(str(source), ProbeCache())
+    cache = ProbeCache()
+    # 別のプロセス (新しいメモリキャッシュ) でもディスクのキャッシュを使う
+    assert media_info.probe(str(source), cache) == info
+    assert media_info.probe(str(source), cache).video.fps == 30.0
+    assert len(calls) == 1
+
+    source.write_bytes(b"\0" * 8192)
+    media_info.probe(str(source), cache)
+    assert len(calls) == 2
+
+
+def test_memory_cache_evicts_the_least_recently_used_file(tmp_path, monkeypatch):
+    calls = _count_ffprobe(monkeypatch)
+    cache = ProbeCache(maxsize=2, use_disk=False)
+    paths = []
+    for name in ("a.mp4", "b.mp4", "c.mp4"):
+        (tmp_path / name).write_bytes(b"\0")
+        paths.append(str(tmp_path / name))
+
+    for path in (paths[0], paths[1], paths[0], paths[2], paths[0], paths[1]):
+        media_info.probe(path, cache)
+
+    # a は直前に使われたので残り、b は c を追加したときに追い出される
+    assert [p[-5:] for p in calls] == ["a.mp4", "b.mp4", "c.mp4", "b.mp4"]
@@ -0,0 +1,42 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import media_info
+from watch import WatchRule, WatchService
+
+
+def _no_probe(path):
+    raise RuntimeError("ffprobe is not available in tests")
+
+
+def test_scan_waits_for_files_with_old_modification_times(tmp_path):
+    path = tmp_path / "still.png"
+    path.write_bytes(b"\0" * 16)
+    # コピーで元の更新日時を保ったまま書き込んでいる途中のファイル
+    os.utime(path, (0, 0))
+    service = WatchService([WatchRule(str(tmp_path), options={"target_format": "jpg"})], settle_seconds=0.0)
+
+    assert service._scan(None) == ([], True)
+    assert service._scan(None) == ([(str(path), service.rules[0])], False)
+
+
+def test_interrupt_cancels_running_ffmpeg_before_waiting(tmp_path, ffmpeg_stub, monkeypatch):
+    monkeypatch.setattr(media_info, "probe", _no_probe)
+    monkeypatch.setenv("STUB_SLEEP", "30")
+    (tmp_path / "movie.mp4").write_bytes(b"\0" * 1024)
+    service = WatchService([WatchRule(str(tmp_path), options={"target_format": "mkv"})], video_workers=1,
+                           ffmpeg_available=True, journal=None, settle_seconds=0.0, poll_interval=0.1,
+                           use_inotify=False)
+    threading.Timer(1.0, os.kill, (os.getpid(), signal.SIGINT)).start()
+
+    started = time.monotonic()
+    with pytest.raises(KeyboardInterrupt):
+        service.run()
+
+    assert service.cancel_requested
+    assert any(call[-1].endswith(".mkv") for call in ffmpeg_stub.calls)
+    assert time.monotonic() - started < 10
@@ -0,0 +1,296 @@
+"""フォルダを監視し、置かれたファイルを自動で変換・圧縮する (監視モード)。
+
+Linux では inotify でフォルダの変化を待ち、使えない環境では一定間隔でフォルダを調べる。
+書き込み中のファイルを処理しないように、サイズと更新日時が settle_seconds の間
+変わらなくなってからジョブにする。ジョブは BatchRunner と同じく数を制限したプールで
+実行するので、一度に大量のファイルが置かれても FFmpeg の同時実行数は増えない。
+
+処理したファイルはジャーナル (JobJournal) に記録し、再起動しても新しいファイルと
+変更されたファイルだけを処理する。
+"""
+import ctypes
+import ctypes.util
+import glob
+import os
+import queue
+import select
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from batch import (
+    BatchResult, BatchRunner, collect_jobs, ignore_interrupt, job_category, journal_key, list_input_files, run_image_job
+)
+from capabilities import check_ffmpeg
+
+
+DEFAULT_SETTLE_SECONDS = 5.0
+# inotify が使えない環境でフォルダを調べる間隔 (秒)
+DEFAULT_POLL_INTERVAL = 2.0
+# inotify で待っている間も、見落としに備えてフォルダを調べ直す間隔 (秒)
+RESCAN_INTERVAL = 60.0
+
+# inotify のイベント (sys/inotify.h)
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+
+@dataclass
+class WatchRule:
+    """監視するフォルダと、そこに置かれたファイルの処理方法"""
+    folder: str
+    mode: str = "convert"
+    # 出力先のフォルダ。省略すると入力ファイルと同じフォルダに出力する
+    output_dir: str = None
+    recursive: bool = False
+    # ConversionJob に渡す設定 (target_format, target_size_mb, encoder など)
+    options: dict = field(default_factory=dict)
+
+    def jobs_for(self, path):
+        """path のジョブの一覧を返す。対象外のファイル (以前の出力など) なら空。"""
+        jobs = collect_jobs(glob.escape(path), self.mode, **self.options)
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+            for job in jobs:
+                if job.targets:
+                    job.targets = [
+                        {"format": target.target_format, "max_dimension": target.max_dimension,
+                         "output_path": self._output_path(target.resolve_output_path())}
+                        for target in job.split_targets()
+                    ]
+                else:
+                    job.output_path = self._output_path(job.resolve_output_path())
+        return jobs
+
+    def _output_path(self, path):
+        return os.path.join(self.output_dir, os.path.basename(path))
+
+
+class _Inotify:
+    """inotify (Linux) でフォルダへのファイルの追加・書き込み完了を待つ"""
+
+    MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify を初期化できません")
+        self._watched = set()
+
+    def add(self, folder):
+        """folder を監視対象に加える (追加済みなら何もしない)"""
+        folder = os.path.abspath(folder)
+        if folder in self._watched:
+            return
+        if self._libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK) >= 0:
+            self._watched.add(folder)
+
+    def wait(self, timeout):
+        """イベントが届くまで最大 timeout 秒待ち、届いたイベントを読み捨てる。届いたら True。"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _open_inotify():
+    """inotify が使えれば _Inotify を、使えなければ None を返す"""
+    if not hasattr(select, "select") or not ctypes.util.find_library("c"):
+        return None
+    try:
+        return _Inotify()
+    except (OSError, AttributeError):
+        # Linux 以外 (inotify_init1 が無い) や監視数の上限など
+        return None
+
+
+class WatchService(BatchRunner):
+    """rules のフォルダを監視し、置かれたファイルを処理し続ける。
+
+    on_event には ("status", str)、ジョブが終わるごとに ("metrics", dict) と
+    ("watch_result", BatchResult) が送られる。stop() を呼ぶまで run() は戻らない。
+    Ctrl+C (KeyboardInterrupt) で run() を抜ける場合は、実行中のジョブを中断してから戻る。
+    """
+
+    def __init__(self, rules, on_event=None, image_workers=None, video_workers=None, ffmpeg_available=None,
+                 journal=None, settle_seconds=DEFAULT_SETTLE_SECONDS, poll_interval=DEFAULT_POLL_INTERVAL,
+                 use_inotify=True):
+        super().__init__([], on_event=on_event, image_workers=image_workers, video_workers=video_workers,
+                         ffmpeg_available=ffmpeg_available, journal=journal)
+        self.rules = list(rules)
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self._stop_event = threading.Event()
+        self._wakeup = threading.Event()
+        self._results = queue.Queue()
+        # 書き込みが終わるのを待っているファイル: パス -> ((サイズ, 更新日時), 最初にその状態を見た時刻)
+        self._pending = {}
+        # ジョブにしたファイル: パス -> (サイズ, 更新日時)。変わったら処理し直す
+        self._handled = {}
+        # 自分の出力 (監視するフォルダに出力した場合に処理し直さないように)
+        self._outputs = set()
+        self._entries = {}
+
+    def stop(self):
+        """監視を終える (実行中のジョブは終わるまで待つ。中断するなら cancel() も呼ぶ)"""
+        self._stop_event.set()
+        self._wakeup.set()
+
+    def run(self):
+        for rule in self.rules:
+            if not os.path.isdir(rule.folder):
+                raise ValueError(f"監視するフォルダが見つかりません: {rule.folder}")
+        if self.journal is not None:
+            self._entries = self.journal.load()
+            for entry in self._entries.values():
+                if entry.get("state") == "done" and entry.get("output"):
+                    outputs = entry["output"] if isinstance(entry["output"], list) else [entry["output"]]
+                    self._outputs.update(os.path.abspath(p) for p in outputs if isinstance(p, str))
+
+        inotify = _open_inotify() if self.use_inotify else None
+        watcher = None
+        if inotify is not None:
+            watcher = threading.Thread(target=self._watch_inotify, args=(inotify,), daemon=True)
+            watcher.start()
+        self.emit("status", "監視を開始しました ({})。".format("inotify" if inotify else f"{self.poll_interval:g}秒ごとに確認"))
+
+        image_pool = ProcessPoolExecutor(max_workers=self.image_workers, initializer=ignore_interrupt)
+        video_pool = ThreadPoolExecutor(max_workers=self.video_workers)
+        try:
+            while not self._stop_event.is_set():
+                self._collect_results()
+                ready, waiting = self._scan(inotify)
+                for path, rule in ready:
+                    self._submit(path, rule, image_pool, video_pool)
+                if waiting:
+                    timeout = min(self.settle_seconds, self.poll_interval) if inotify is None else self.settle_seconds / 2
+                else:
+                    timeout = RESCAN_INTERVAL if inotify is not None else self.poll_interval
+                self._wakeup.wait(timeout)
+                self._wakeup.clear()
+        except KeyboardInterrupt:
+            # 実行中の FFmpeg を止めてから、プールの終了を待つ
+            self.cancel()
+            raise
+        finally:
+            self._stop_event.set()
+            for pool in (image_pool, video_pool):
+                pool.shutdown(wait=True, cancel_futures=True)
+            self._collect_results()
+            if watcher is not None:
+                watcher.join()
+                inotify.close()
+
+    def _watch_inotify(self, inotify):
+        while not self._stop_event.is_set():
+            if inotify.wait(1.0):
+                self._wakeup.set()
+
+    def _scan(self, inotify):
+        """書き込みが終わったファイル [(パス, ルール)] と、待っているファイルがあるかを返す"""
+        now = time.monotonic()
+        ready, waiting, seen = [], False, set()
+        for rule in self.rules:
+            output_dir = os.path.abspath(rule.output_dir) if rule.output_dir else None
+            if inotify is not None:
+                folders = [dirpath for dirpath, _, _ in os.walk(rule.folder)] if rule.recursive else [rule.folder]
+                for folder in folders:
+                    inotify.add(folder)
+            for path in list_input_files(rule.folder, recursive=rule.recursive):
+                abspath = os.path.abspath(path)
+                if abspath in self._outputs or (output_dir and abspath.startswith(output_dir + os.sep)):
+                    continue
+                seen.add(abspath)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if self._handled.get(abspath) == signature:
+                    continue
+                pending = self._pending.get(abspath)
+                if pending is None or pending[0] != signature:
+                    # 更新日時は書き込み中でも古いことがある (コピーで元の日時を保つ場合など) ので、
+                    # 初めて見たファイルも settle_seconds の間は様子を見る
+                    self._pending[abspath] = (signature, now)
+                    waiting = True
+                elif now - pending[1] >= self.settle_seconds:
+                    del self._pending[abspath]
+                    self._handled[abspath] = signature
+                    ready.append((path, rule))
+                else:
+                    waiting = True
+        # 削除されたファイルは忘れる (同じ名前で置き直されたら処理する)
+        for known in (self._pending, self._handled):
+            for abspath in set(known) - seen:
+                del known[abspath]
+        return ready, waiting
+
+    def _submit(self, path, rule, image_pool, video_pool):
+        """path のジョブをプールに投入する"""
+        try:
+            jobs = rule.jobs_for(path)
+        except ValueError as e:
+            self.emit("status", f"処理できません: {path}: {e}")
+            return
+        for job in jobs:
+            key = journal_key(job)
+            output = self.journal.completed_output(self._entries, key) if self.journal is not None else None
+            if output is not None:
+                # 前回までに処理済み
+                continue
+            if job_category(job) == "video":
+                if self.ffmpeg_available is None:
+                    self.ffmpeg_available = check_ffmpeg()
+                future = video_pool.submit(self._run_video_job, job)
+            else:
+                future = image_pool.submit(run_image_job, job)
+            self._remember_outputs(job)
+            future.add_done_callback(lambda f, job=job, key=key: self._on_done(job, key, f))
+
+    def _remember_outputs(self, job):
+        try:
+            outputs = [target.resolve_output_path() for target in (job.split_targets() if job.targets else [job])]
+        except ValueError:
+            return
+        self._outputs.update(os.path.abspath(p) for p in outputs)
+
+    def _on_done(self, job, key, future):
+        self._results.put((job, key, future))
+        self._wakeup.set()
+
+    def _collect_results(self):
+        """終わったジョブの結果を通知・記録する"""
+        while True:
+            try:
+                job, key, future = self._results.get_nowait()
+            except queue.Empty:
+                return
+            if future.cancelled():
+                # 監視を終えたために着手しなかったジョブは、次に起動したときに処理する
+                continue
+            result = BatchResult(job=job)
+            try:
+                result.output_path, result.error, result.warnings, result.wall_time, result.metrics = future.result()
+            except Exception as e:
+                # プロセスプールが異常終了した場合など
+                result.error = str(e) or e.__class__.__name__
+            if result.metrics is not None:
+                self.emit("metrics", result.metrics)
+            if self.journal is not None and not (self.cancel_requested and not result.ok):
+                self.journal.record(key, "done" if result.ok else "failed", result.output_path)
+            self.emit("watch_result", result)